@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# per lock accounting of the radio usage.
+# Every connect, fragment and retransmission costs energy of the lock battery.
+# The LowerLayer counts them per lock, the totals are kept across restarts
+# when a path is given. Several processes may save into the same path, each
+# adds the counts since its last save to the stored totals under a flock.
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger("accounting")
+
+COUNTERS = [
+    'connects',
+    'connect_failures',
+    # seconds from the connect request until the connection was established
+    'connect_time',
+    # seconds connected
+    'connected_time',
+    # seconds connected without any transfer
+    'idle_time',
+    # pdus including FragmentAcks and retransmissions
+    'fragments_sent',
+    'fragments_received',
+    'retransmits',
+    # payload of the pdus
+    'bytes_sent',
+    'bytes_received',
+]
+
+class EnergyModel(object):
+    """ estimates the charge drawn from the lock battery.
+        The costs depend on the radio of the lock, measure them and pass them in.
+
+        :param connect charge of a connection setup
+        :param connected_second charge of each second connected (the connection events)
+        :param byte charge of each byte sent or received """
+    def __init__(self, connect, connected_second, byte):
+        self.connect = connect
+        self.connected_second = connected_second
+        self.byte = byte
+
+    def charge(self, usage):
+        """ usage is a dict like LockUsage.totals() """
+        return self.connect * usage['connects'] + \
+               self.connected_second * usage['connected_time'] + \
+               self.byte * (usage['bytes_sent'] + usage['bytes_received'])
+
+class LockUsage(object):
+    """ the counters of one lock. Updated by the LowerLayer.
+        The counters are persisted by the accounting at the end of each connection """
+    def __init__(self, mac, totals=None, accounting=None):
+        self.mac = mac
+        self._accounting = accounting
+        self._lock = threading.Lock()
+        self._totals = {counter: 0 for counter in COUNTERS}
+        if totals:
+            self._totals.update({counter: totals[counter] for counter in COUNTERS if counter in totals})
+
+    def _add(self, counter, value=1):
+        with self._lock:
+            self._totals[counter] += value
+
+    def totals(self):
+        with self._lock:
+            return dict(self._totals)
+
+    def connected(self, duration):
+        with self._lock:
+            self._totals['connects'] += 1
+            self._totals['connect_time'] += duration
+
+    def connect_failed(self):
+        self._add('connect_failures')
+
+    def disconnected(self, duration):
+        self._add('connected_time', duration)
+        if self._accounting:
+            self._accounting.save()
+
+    def idle(self, duration):
+        self._add('idle_time', duration)
+
+    def sent(self, length, retransmit=False):
+        with self._lock:
+            self._totals['fragments_sent'] += 1
+            self._totals['bytes_sent'] += length
+            if retransmit:
+                self._totals['retransmits'] += 1
+
+    def received(self, length):
+        with self._lock:
+            self._totals['fragments_received'] += 1
+            self._totals['bytes_received'] += length
+
+class Accounting(object):
+    """ the LockUsage of all locks """
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        # mac -> LockUsage
+        self._locks = {}
+        # mac -> totals stored in path at the last load or save, they are part of the counters
+        self._stored = {}
+        # macs reset since the last save, None for all
+        self._dropped = set()
+        if path and os.path.exists(path):
+            self._merge(self._load())
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as exp:
+            LOG.warning("Can not load accounting %s: %s", self._path, exp)
+            return {}
+
+    def _merge(self, entries):
+        """ add the stored totals {mac: totals} to the counters """
+        self._stored = {mac: dict(totals) for mac, totals in entries.items()}
+        for mac, totals in entries.items():
+            usage = self._locks.get(mac)
+            if usage is None:
+                self._locks[mac] = LockUsage(mac, totals, self)
+                continue
+            for counter in COUNTERS:
+                if counter in totals:
+                    usage._add(counter, totals[counter])
+
+    def set_path(self, path):
+        """ persist into path. Counters stored in path are added to the current ones """
+        with self._lock:
+            self._path = path
+            if os.path.exists(path):
+                self._merge(self._load())
+
+    def lock(self, mac):
+        """ returns the LockUsage of a lock """
+        with self._lock:
+            usage = self._locks.get(mac)
+            if usage is None:
+                usage = self._locks[mac] = LockUsage(mac, accounting=self)
+            return usage
+
+    def get(self, mac):
+        """ returns the totals of a lock as dict or None """
+        with self._lock:
+            usage = self._locks.get(mac)
+        return usage.totals() if usage else None
+
+    def totals(self):
+        """ returns {mac: totals} of all locks """
+        with self._lock:
+            locks = list(self._locks.values())
+        return {usage.mac: usage.totals() for usage in locks}
+
+    def reset(self, mac=None):
+        """ reset the counters of a lock or all locks """
+        with self._lock:
+            if mac is None:
+                self._locks.clear()
+                self._stored = {}
+                self._dropped = None
+            else:
+                self._locks.pop(mac, None)
+                self._stored.pop(mac, None)
+                if self._dropped is not None:
+                    self._dropped.add(mac)
+        self.save()
+
+    def save(self):
+        """ add the counts since the last save to the totals stored in path.
+            The counters take over what other processes saved meanwhile """
+        if not self._path:
+            return
+
+        try:
+            with open(self._path + '.lock', 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                with self._lock:
+                    stored = self._load() if os.path.exists(self._path) else {}
+                    self._update(stored)
+                    self._write(stored)
+        except OSError as exp:
+            LOG.warning("Can not save accounting %s: %s", self._path, exp)
+
+    def _update(self, stored):
+        """ add the counts since the last save to stored {mac: totals} and the ones of the
+            other processes to the counters """
+        if self._dropped is None:
+            stored.clear()
+        for mac in self._dropped or ():
+            stored.pop(mac, None)
+        for mac, usage in self._locks.items():
+            totals = usage.totals()
+            base = self._stored.get(mac, {})
+            current = stored.get(mac, {})
+            for counter in COUNTERS:
+                usage._add(counter, current.get(counter, 0) - base.get(counter, 0))
+            stored[mac] = {counter: current.get(counter, 0) + totals[counter] - base.get(counter, 0)
+                           for counter in COUNTERS}
+        for mac, totals in stored.items():
+            if mac not in self._locks:
+                self._locks[mac] = LockUsage(mac, totals, self)
+        self._stored = {mac: dict(totals) for mac, totals in stored.items()}
+        self._dropped = set()
+
+    def _write(self, entries):
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self._path) + '.',
+                                   dir=os.path.dirname(self._path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(entries, fp, indent=2)
+            os.replace(tmp, self._path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+# the accounting shared by all devices of this process
+ACCOUNTING = Accounting()
+
+def test_accounting():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'accounting.json')
+        accounting = Accounting(path)
+        usage = accounting.lock('mac')
+        usage.connected(0.5)
+        usage.sent(16)
+        usage.sent(16, retransmit=True)
+        usage.received(16)
+        usage.idle(2.0)
+        usage.disconnected(3.0)
+        accounting.save()
+
+        totals = Accounting(path).get('mac')
+        assert totals['connects'] == 1
+        assert totals['fragments_sent'] == 2
+        assert totals['retransmits'] == 1
+        assert totals['bytes_received'] == 16
+        assert totals['idle_time'] == 2.0
+
+        # counters of this process are added to the stored ones
+        other = Accounting()
+        other.lock('mac').connected(1.0)
+        other.set_path(path)
+        assert other.get('mac')['connects'] == 2
+
+        # processes saving into the same path add up their counts
+        first, second = Accounting(path), Accounting(path)
+        first.lock('mac').connected(1.0)
+        second.lock('mac').connected(1.0)
+        second.lock('other').connected(1.0)
+        first.save()
+        second.save()
+        assert Accounting(path).get('mac')['connects'] == 3
+        assert second.get('mac')['connects'] == 3
+        first.save()
+        assert first.get('other')['connects'] == 1
+        assert Accounting(path).get('mac')['connects'] == 3
+
+        first.reset('other')
+        assert Accounting(path).get('other') is None
+        assert sorted(os.listdir(tmpdir)) == ['accounting.json', 'accounting.json.lock']
+
+        # a path which can't be written is logged
+        Accounting(os.path.join(tmpdir, 'missing', 'accounting.json')).save()
+
+        model = EnergyModel(connect=10, connected_second=1, byte=0.5)
+        assert model.charge(totals) == 10 + 3.0 + 0.5 * 48
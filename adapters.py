@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Spread lock sessions over multiple bluetooth adapters (hci interfaces).
+# Each adapter tracks the RSSI it has seen of each lock and the number of
+# sessions running on it. A new session is placed on the adapter with the best
+# recent RSSI and the lowest load. Adapters failing to connect to locks other
+# adapters reach are put aside for a while.
+
+import glob
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger("adapters")
+
+# RSSI used for locks an adapter has never seen
+UNKNOWN_RSSI = -100
+# RSSI observations older than this are ignored
+RSSI_MAX_AGE = 300.0
+# each running session costs this much dB of RSSI when selecting an adapter
+LOAD_PENALTY = 6
+# how many failures in a row mark an adapter unresponsive
+FAILURE_THRESHOLD = 2
+# how long an unresponsive adapter is skipped
+UNRESPONSIVE_TIME = 60.0
+
+def find_adapters():
+    """ returns the index of all hci interfaces of the system """
+    ifaces = []
+    for path in glob.glob('/sys/class/bluetooth/hci*'):
+        name = os.path.basename(path)
+        if name[3:].isdigit():
+            ifaces.append(int(name[3:]))
+    return sorted(ifaces) or [0]
+
+class Adapter(object):
+    def __init__(self, iface):
+        # the hci number as used by bluepy (0 for hci0)
+        self.iface = iface
+        self.sessions = 0
+        self.failures = 0
+        self.unresponsive_until = 0
+        # mac -> (rssi, time)
+        self.rssi = {}
+
+    @property
+    def name(self):
+        return "hci%d" % self.iface
+
+    def responsive(self, now=None):
+        return (now or time.monotonic()) >= self.unresponsive_until
+
+    def recent_rssi(self, mac, now=None):
+        now = now or time.monotonic()
+        rssi, seen = self.rssi.get(mac.lower(), (UNKNOWN_RSSI, 0))
+        if now - seen > RSSI_MAX_AGE:
+            return UNKNOWN_RSSI
+        return rssi
+
+    def score(self, mac, now=None):
+        return self.recent_rssi(mac, now) - LOAD_PENALTY * self.sessions
+
+    def __repr__(self):
+        return "<Adapter %s sessions=%d failures=%d>" % (self.name, self.sessions, self.failures)
+
+class AdapterPool(object):
+    def __init__(self, ifaces=None):
+        if ifaces is None:
+            ifaces = find_adapters()
+        self._lock = threading.Lock()
+        self.adapters = [Adapter(iface) for iface in ifaces]
+
+    def observe(self, iface, mac, rssi):
+        """ record a RSSI observation (e.g. from a scan) """
+        with self._lock:
+            for adapter in self.adapters:
+                if adapter.iface == iface:
+                    adapter.rssi[mac.lower()] = (rssi, time.monotonic())
+
+    def select(self, mac, exclude=()):
+        """ returns the best adapter for the mac without acquiring it """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [adapter for adapter in self.adapters if adapter.iface not in exclude]
+            if not candidates:
+                return None
+            responsive = [adapter for adapter in candidates if adapter.responsive(now)]
+            # when all are unresponsive, try the one which recovers first
+            if not responsive:
+                return min(candidates, key=lambda adapter: adapter.unresponsive_until)
+            return max(responsive, key=lambda adapter: (adapter.score(mac, now), -adapter.iface))
+
+    def acquire(self, mac, exclude=()):
+        """ select an adapter for a new session of mac. It must be released with release() """
+        adapter = self.select(mac, exclude)
+        if adapter is None:
+            return None
+        with self._lock:
+            adapter.sessions += 1
+        LOG.info("Using adapter %s for %s", adapter.name, mac)
+        return adapter
+
+    def release(self, adapter):
+        with self._lock:
+            adapter.sessions = max(0, adapter.sessions - 1)
+
+    def succeeded(self, adapter):
+        with self._lock:
+            adapter.failures = 0
+            adapter.unresponsive_until = 0
+
+    def failed(self, adapter):
+        """ report an adapter failing on its own: a failed scan, a failed connect to a lock
+            another adapter reached. A lock no adapter reaches is not the fault of the adapters """
+        with self._lock:
+            adapter.failures += 1
+            if adapter.failures >= FAILURE_THRESHOLD:
+                LOG.warning("Adapter %s is unresponsive", adapter.name)
+                adapter.unresponsive_until = time.monotonic() + UNRESPONSIVE_TIME
+
+    def stats(self):
+        """ returns the state of all adapters """
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'adapter': adapter.name,
+                'sessions': adapter.sessions,
+                'failures': adapter.failures,
+                'responsive': adapter.responsive(now),
+                'locks': {mac: rssi for mac, (rssi, seen) in adapter.rssi.items() if now - seen <= RSSI_MAX_AGE},
+            } for adapter in self.adapters]
+
+    def scan(self, timeout=10.0):
+        """ scan on all adapters at the same time.
+            returns {mac: ScanEntry} with the entry of the adapter with the best RSSI """
+        from bluepy.btle import Scanner
+
+        found = {}
+        found_lock = threading.Lock()
+
+        def _scan(adapter):
+            try:
+                devices = Scanner(adapter.iface).scan(timeout)
+            except Exception as exp:
+                LOG.warning("Scan on %s failed: %s", adapter.name, exp)
+                self.failed(adapter)
+                return
+            for dev in devices:
+                self.observe(adapter.iface, dev.addr, dev.rssi)
+                with found_lock:
+                    if dev.addr not in found or found[dev.addr].rssi < dev.rssi:
+                        found[dev.addr] = dev
+
+        threads = [threading.Thread(target=_scan, args=(adapter,)) for adapter in self.adapters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return found
+
+def test_adapter_selection():
+    pool = AdapterPool([0, 1])
+    pool.observe(0, 'AA:BB:CC:DD:EE:FF', -80)
+    pool.observe(1, 'AA:BB:CC:DD:EE:FF', -60)
+    adapter = pool.acquire('aa:bb:cc:dd:ee:ff')
+    assert adapter.iface == 1
+
+    # hci1 is loaded now, but the RSSI difference is still bigger
+    assert pool.select('aa:bb:cc:dd:ee:ff').iface == 1
+    # an unknown lock goes to the idle adapter
+    assert pool.select('11:22:33:44:55:66').iface == 0
+
+    pool.failed(adapter)
+    pool.failed(adapter)
+    assert pool.select('aa:bb:cc:dd:ee:ff').iface == 0
+    assert pool.select('aa:bb:cc:dd:ee:ff', exclude=(0,)).iface == 1
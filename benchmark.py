@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# End-to-end latency benchmark of fsm.Device -> LowerLayer against fakelock.FakePeripheral.
+# Each cycle connects, exchanges the nonce, opens, locks, requests the status and
+# sets a user name (a message of two fragments).
+# Reports p50/p95/p99/max per phase and the throughput of all sessions.
+
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+from capabilities import Capabilities, WRITE_WITHOUT_RESPONSE
+from fakelock import FakeLock, FakePeripheral
+from fleet import percentile
+
+LOG = logging.getLogger("benchmark")
+
+USERKEY = bytearray(range(16))
+PHASES = ['setup', 'open', 'lock', 'status', 'rename', 'cycle']
+# --write-mode -> the write without response capability of the locks, None to find out
+WRITE_MODES = {'auto': None, 'with-response': False, 'without-response': True}
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1],
+    }
+
+class Session(object):
+    """ one simulated gateway session running cycles against its own lock """
+    def __init__(self, index, args, results):
+        self.index = index
+        self.args = args
+        self.results = results
+        self.mac = "00:1a:22:00:%02x:%02x" % (index >> 8, index & 0xff)
+        self.lock = FakeLock({1: USERKEY})
+        self.failures = 0
+        self.capabilities = Capabilities()
+        if WRITE_MODES[args.write_mode] is not None:
+            self.capabilities.put(self.mac, WRITE_WITHOUT_RESPONSE, WRITE_MODES[args.write_mode])
+
+    def _peripheral(self):
+        return FakePeripheral(self.lock,
+                              latency=self.args.latency,
+                              loss=self.args.loss,
+                              connect_time=self.args.connect_time,
+                              seed=None if self.args.seed is None else self.args.seed + self.index)
+
+    def _timed(self, timings, phase, func):
+        start = time.perf_counter()
+        result = func()
+        timings[phase] = time.perf_counter() - start
+        return result
+
+    def cycle(self):
+        from fsm import Device
+
+        device = Device(self.mac, 1, USERKEY, peripheral_factory=self._peripheral, capabilities=self.capabilities)
+        timings = {}
+        timeout = self.args.timeout
+        start = time.perf_counter()
+        try:
+            ok = self._timed(timings, 'setup', lambda: device._setup(timeout)) and \
+                 self._timed(timings, 'open', lambda: device.open(timeout)) and \
+                 self._timed(timings, 'lock', lambda: device.lock(timeout)) and \
+                 self._timed(timings, 'status', lambda: device.status(timeout)) is not None and \
+                 self._timed(timings, 'rename', lambda: device.set_user_name(1, 'benchmark', timeout))
+        finally:
+            device.disconnect()
+        timings['cycle'] = time.perf_counter() - start
+        return ok, timings
+
+    def run(self, cycles):
+        for _ in range(cycles):
+            ok, timings = self.cycle()
+            self.results.add(ok, timings)
+
+class Results(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {phase: [] for phase in PHASES}
+        self.failed = 0
+        self.done = 0
+
+    def add(self, ok, timings):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+                return
+            for phase, value in timings.items():
+                self.timings[phase].append(value)
+
+def run(args):
+    results = Results()
+    sessions = [Session(index, args, results) for index in range(args.sessions)]
+    threads = [threading.Thread(target=session.run, args=(args.cycles,)) for session in sessions]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    return {
+        'config': {
+            'cycles': args.cycles,
+            'sessions': args.sessions,
+            'latency': args.latency,
+            'loss': args.loss,
+            'connect_time': args.connect_time,
+            'write_mode': args.write_mode,
+        },
+        'duration': duration,
+        'cycles': results.done,
+        'failed': results.failed,
+        'throughput': results.done / duration if duration else None,
+        'phases': {phase: summarize(values) for phase, values in results.timings.items()},
+    }
+
+def print_report(report, fp=sys.stdout):
+    config = report['config']
+    print("%d sessions x %d cycles, latency %.1f ms, loss %.1f %%, write %s" % (
+        config['sessions'], config['cycles'], config['latency'] * 1000, config['loss'] * 100,
+        config.get('write_mode', 'with-response')), file=fp)
+    print("%-8s %8s %8s %8s %8s %8s" % ('phase', 'count', 'p50', 'p95', 'p99', 'max'), file=fp)
+    for phase in PHASES:
+        stats = report['phases'][phase]
+        if not stats['count']:
+            continue
+        print("%-8s %8d %6.1fms %6.1fms %6.1fms %6.1fms" % (
+            phase, stats['count'],
+            stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000, stats['max'] * 1000), file=fp)
+    print("%d cycles, %d failed, %.1f cycles/s" % (
+        report['cycles'], report['failed'], report['throughput']), file=fp)
+
+def main():
+    parser = argparse.ArgumentParser(description='keyble end-to-end benchmark against a fake lock')
+    parser.add_argument('--cycles', type=int, default=1000, help='Cycles per session')
+    parser.add_argument('--sessions', type=int, default=1, help='Concurrent sessions, each with its own lock')
+    parser.add_argument('--latency', type=float, default=0.0075, help='Duration of a connection event in seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability a pdu is lost')
+    parser.add_argument('--connect-time', dest='connect_time', type=float, default=0.0, help='Time to connect in seconds')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Timeout of each operation')
+    parser.add_argument('--write-mode', dest='write_mode', choices=sorted(WRITE_MODES), default='auto',
+                        help='Write the fragments with or without response. auto finds out on the first connect.')
+    parser.add_argument('--seed', type=int, help='Seed of the loss simulation')
+    parser.add_argument('--json', dest='json', help='Write the report as json into this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)-15s %(levelname)-8s %(name)-22s %(message)s", level=logging.CRITICAL)
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert summarize([])['count'] == 0
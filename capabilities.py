@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Per lock capabilities learned while talking to the lock.
+#
+# Whether the lock accepts write without response on its send characteristic is
+# only known after trying. The answer is kept per lock, so the following sessions
+# don't have to find out again. An entry older than max_age is tried again, the
+# firmware of the lock might have changed. A single failed try might be a lost
+# or late reply, a capability is only stored as missing after `confirm` failed
+# tries in a row.
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger("capabilities")
+
+# the lock reacts on fragments written without response
+WRITE_WITHOUT_RESPONSE = 'write_without_response'
+
+class Capabilities(object):
+    """ cache of the capabilities per lock (mac) """
+    def __init__(self, path=None, max_age=7 * 24 * 3600):
+        self._path = path
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        # mac -> {capability: [value, time, failed tries in a row]}
+        self._entries = {}
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as fp:
+                self._entries = json.load(fp)
+        except (OSError, ValueError) as exp:
+            LOG.warning("Can not load the capabilities %s: %s", self._path, exp)
+
+    def _save(self):
+        if not self._path:
+            return
+
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self._path) + '.',
+                                       dir=os.path.dirname(self._path) or '.')
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(self._entries, fp, indent=2)
+                os.replace(tmp, self._path)
+            except OSError:
+                os.unlink(tmp)
+                raise
+        except OSError as exp:
+            # learned again by the next session
+            LOG.warning("Can not save the capabilities %s: %s", self._path, exp)
+
+    def set_path(self, path):
+        """ persist into path. Loads the capabilities stored in path """
+        with self._lock:
+            self._path = path
+            if os.path.exists(path):
+                self._load()
+
+    def get(self, mac, capability):
+        """ returns True or False or None when not known (yet) """
+        with self._lock:
+            value, learned = self._entries.get(mac.lower(), {}).get(capability, (None, 0))[:2]
+            if self._max_age and time.time() - learned > self._max_age:
+                return None
+            return value
+
+    def put(self, mac, capability, value):
+        with self._lock:
+            entry = self._entries.setdefault(mac.lower(), {})
+            if entry.get(capability, (None, 0))[0] != value:
+                LOG.info("%s %s: %s", mac, capability, value)
+            entry[capability] = [value, time.time(), 0]
+            self._save()
+
+    def failed(self, mac, capability, confirm=2):
+        """ a try of the capability failed. Stores it as missing after confirm failed tries in a row.
+            returns True when stored as missing """
+        with self._lock:
+            entry = self._entries.setdefault(mac.lower(), {})
+            stored = entry.get(capability, [None, 0])
+            value, learned = stored[:2]
+            failures = (stored[2] if len(stored) > 2 else 0) + 1
+            if failures < confirm:
+                LOG.info("%s %s: failed %d of %d times", mac, capability, failures, confirm)
+                entry[capability] = [value, learned, failures]
+                self._save()
+                return False
+        self.put(mac, capability, False)
+        return True
+
+# the capabilities of the locks shared by all devices of this process
+CAPABILITIES = Capabilities()
+
+def test_capabilities():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'capabilities.json')
+        capabilities = Capabilities(path)
+        assert capabilities.get('AA:BB:CC:DD:EE:FF', WRITE_WITHOUT_RESPONSE) is None
+        capabilities.put('AA:BB:CC:DD:EE:FF', WRITE_WITHOUT_RESPONSE, False)
+        assert Capabilities(path).get('aa:bb:cc:dd:ee:ff', WRITE_WITHOUT_RESPONSE) is False
+        # expired, try again
+        assert Capabilities(path, max_age=-1).get('aa:bb:cc:dd:ee:ff', WRITE_WITHOUT_RESPONSE) is None
+
+        # a single failed try is not stored as missing
+        assert not capabilities.failed('AA:BB:CC:DD:EE:00', WRITE_WITHOUT_RESPONSE)
+        assert Capabilities(path).get('aa:bb:cc:dd:ee:00', WRITE_WITHOUT_RESPONSE) is None
+        assert Capabilities(path).failed('aa:bb:cc:dd:ee:00', WRITE_WITHOUT_RESPONSE)
+        assert Capabilities(path).get('aa:bb:cc:dd:ee:00', WRITE_WITHOUT_RESPONSE) is False
+
+        # a path which can't be written is logged
+        Capabilities(os.path.join(tmpdir, 'missing', 'capabilities.json')).put('aa:bb:cc:dd:ee:00',
+                                                                             WRITE_WITHOUT_RESPONSE, True)
+        assert sorted(os.listdir(tmpdir)) == ['capabilities.json']
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Collapse bursts of commands for one lock into the latest intent.
+#
+# A button pressed five times or a storm of MQTT toggles would send one
+# encrypted command after the other over the radio. The Coalescer waits `window`
+# seconds after the first command, the latest command submitted until then wins
+# and is executed once. Every caller gets the outcome of the executed command.
+# A command equal to the one in flight joins it instead of being sent again.
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from timerwheel import WHEEL
+
+LOG = logging.getLogger("coalesce")
+
+# executes the commands of all coalescers, the timer wheel must not block
+EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="coalesce")
+
+class _Batch(object):
+    def __init__(self, command):
+        self.command = command
+        self.futures = []
+
+class Coalescer(object):
+    """ coalesce the commands of one lock.
+
+        :param execute callable(command) -> result, e.g. Device.command. Called from a worker thread.
+        :param window seconds to collect commands before executing the latest """
+    def __init__(self, execute, window=0.3):
+        self.execute = execute
+        self.window = window
+        self._lock = threading.Lock()
+        # the batch collecting commands
+        self._pending = None
+        # the batch being executed
+        self._inflight = None
+        # statistics
+        self.submitted = 0
+        self.executed = 0
+
+    def submit(self, command):
+        """ returns a Future of the result of the command finally executed """
+        future = Future()
+        with self._lock:
+            self.submitted += 1
+            if self._pending is None and self._inflight and self._inflight.command == command:
+                self._inflight.futures.append(future)
+                return future
+
+            if self._pending is None:
+                self._pending = _Batch(command)
+                if self._inflight is None:
+                    self._schedule()
+            elif self._pending.command != command:
+                LOG.info("Replacing command %s by %s", self._pending.command, command)
+                self._pending.command = command
+            self._pending.futures.append(future)
+        return future
+
+    def __call__(self, command, timeout=None):
+        """ submit a command and wait for the result """
+        return self.submit(command).result(timeout)
+
+    def _schedule(self):
+        if self.window:
+            WHEEL.schedule(self.window, EXECUTOR.submit, self._run)
+        else:
+            EXECUTOR.submit(self._run)
+
+    def _run(self):
+        with self._lock:
+            batch = self._inflight = self._pending
+            self._pending = None
+            self.executed += 1
+
+        try:
+            result = self.execute(batch.command)
+        except Exception as exp:
+            LOG.warning("Command %s failed: %s", batch.command, exp)
+            self._finish(batch, exception=exp)
+        else:
+            self._finish(batch, result=result)
+
+    def _finish(self, batch, result=None, exception=None):
+        with self._lock:
+            self._inflight = None
+            futures = batch.futures
+            # commands collected while this one was executed
+            if self._pending is not None:
+                self._schedule()
+
+        for future in futures:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+def device_coalescer(device, window=0.3, timeout=10.0):
+    """ a Coalescer in front of Device.command. Submit COMMAND_* """
+    return Coalescer(lambda command: device.command(command, timeout), window)
+
+def test_coalescer():
+    executed = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def _execute(command):
+        executed.append(command)
+        started.set()
+        release.wait(2.0)
+        return command != 'fail'
+
+    coalescer = Coalescer(_execute, window=0.05)
+    futures = [coalescer.submit(command) for command in ['lock', 'unlock', 'lock']]
+    assert started.wait(2.0)
+    # joins the lock in flight
+    futures.append(coalescer.submit('lock'))
+    # collected while lock is in flight
+    later = [coalescer.submit('unlock'), coalescer.submit('open')]
+    release.set()
+
+    assert all(future.result(2.0) for future in futures + later)
+    assert executed == ['lock', 'open']
+    assert coalescer.submitted == 6
+    assert coalescer.executed == 2
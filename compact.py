@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Compact sessions to simulate thousands of locks in one process (capacity planning).
+#
+# A fsm.Device carries a transitions.Machine, Events, a Correlator and, once connected,
+# a LowerLayer with its own thread, queues and a Peripheral: about 40 kB idle and a
+# thread per connected lock. A CompactSession is a __slots__ record of the protocol state.
+# All sessions share one transition table and a few worker threads of a SessionHost,
+# a session is served by the worker of its shard, so the requests of a lock stay in order.
+# The workers share the fragment reassembly and the security counter checks with the
+# LowerLayer and Device, one request at a time per worker.
+#
+# ./compact.py --sessions 5000 compares the memory per session.
+
+import argparse
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from concurrent.futures import Future
+from datetime import datetime
+from queue import Queue
+
+from encrypt import encrypt_message, decrypt_answer
+from exceptions import CouldNotConnect, InvalidData
+from lowerlayer import LOCK_SERVICE, LOCK_SEND_CHAR, LOCK_RECV_CHAR, FragmentReceiver, acked_fragment
+from messages import AnswerWithSecurity, CommandMessage, ConnectionInfoMessage, ConnectionRequestMessage, \
+    StatusInfoMessage, StatusRequestMessage, encode_fragment
+
+LOG = logging.getLogger("compact")
+
+STATE_DISCONNECTED = 0
+STATE_CONNECTED = 1
+STATE_READY = 2
+
+STATE_NAMES = {
+    STATE_DISCONNECTED: 'disconnected',
+    STATE_CONNECTED: 'connected',
+    STATE_READY: 'exchanged_nonce',
+}
+
+# (state, event) -> state, shared by all sessions
+TRANSITIONS = {
+    (STATE_DISCONNECTED, 'connected'): STATE_CONNECTED,
+    (STATE_CONNECTED, 'nonce_received'): STATE_READY,
+    (STATE_DISCONNECTED, 'disconnected'): STATE_DISCONNECTED,
+    (STATE_CONNECTED, 'disconnected'): STATE_DISCONNECTED,
+    (STATE_READY, 'disconnected'): STATE_DISCONNECTED,
+}
+
+class CompactSession(object):
+    """ the state of the session with one lock. Only used by the worker of its shard """
+    __slots__ = ['mac', 'userid', 'userkey', 'shard', 'state', 'nonce', 'remote_nonce',
+                 'security_counter', 'remote_security_counter', 'peripheral', 'send', 'recv', 'inbox']
+
+    def __init__(self, mac, userid, userkey, shard):
+        self.mac = mac
+        self.userid = userid
+        self.userkey = userkey
+        self.shard = shard
+        self.state = STATE_DISCONNECTED
+        self.nonce = 0
+        self.remote_nonce = None
+        self.security_counter = 1
+        self.remote_security_counter = 0
+        # only while connected
+        self.peripheral = None
+        self.send = None
+        self.recv = None
+        self.inbox = None
+
+    def fire(self, event):
+        self.state = TRANSITIONS[(self.state, event)]
+
+    def handleNotification(self, handle, data):
+        """ called by the peripheral on the worker thread """
+        if self.inbox is not None and handle == self.recv.getHandle():
+            self.inbox.append(bytes(data))
+
+class SessionHost(object):
+    """ runs the sessions of many locks on a few shared worker threads.
+
+        :param peripheral_factory returns a new bluepy Peripheral (or fakelock.FakePeripheral)
+        :param workers number of worker threads, each serves its shard of the sessions """
+    def __init__(self, peripheral_factory, workers=1, timeout=5.0):
+        self.peripheral_factory = peripheral_factory
+        self.timeout = timeout
+        self._queues = [Queue() for _ in range(max(1, workers))]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.sessions = {}
+
+    def add(self, mac, userid, userkey):
+        """ returns the CompactSession of a lock """
+        with self._lock:
+            session = self.sessions[mac] = CompactSession(mac, userid, bytes(userkey),
+                                                          len(self.sessions) % len(self._queues))
+        return session
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for shard, queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._work, args=(queue,), name="compact-%d" % shard, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, session, operation, *args):
+        """ run operation(session, *args) on the worker of the session. returns a Future """
+        self._start()
+        future = Future()
+        self._queues[session.shard].put((future, operation, session, args))
+        return future
+
+    def _work(self, queue):
+        while True:
+            future, operation, session, args = queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(operation(session, *args))
+            except Exception as exp:
+                future.set_exception(exp)
+
+    # the api, each returns a Future
+    def connect(self, session):
+        return self.submit(session, self._connect)
+
+    def disconnect(self, session):
+        return self.submit(session, self._disconnect)
+
+    def status(self, session):
+        """ resolves with the StatusInfoMessage """
+        return self.submit(session, self._request, StatusRequestMessage(datetime.now()), StatusInfoMessage)
+
+    def command(self, session, command):
+        """ resolves with True when the lock accepted the fsm.COMMAND_* """
+        return self.submit(session, self._command, command)
+
+    # the worker side
+    def _connect(self, session):
+        if session.state == STATE_READY:
+            return True
+        try:
+            peripheral = self.peripheral_factory()
+            peripheral.setDelegate(session)
+            peripheral.connect(session.mac)
+            service = peripheral.getServiceByUUID(LOCK_SERVICE)
+        except Exception as exp:
+            raise CouldNotConnect("Can not connect to %s: %s" % (session.mac, exp))
+        session.peripheral = peripheral
+        session.send = service.getCharacteristics(LOCK_SEND_CHAR)[0]
+        session.recv = service.getCharacteristics(LOCK_RECV_CHAR)[0]
+        session.inbox = []
+        session.fire('connected')
+
+        session.nonce = self._random.getrandbits(64)
+        session.security_counter = 1
+        session.remote_security_counter = 0
+        answer = self._exchange(session, ConnectionRequestMessage(session.userid, session.nonce).encode())
+        if answer is None or answer[0] != ConnectionInfoMessage.msgtype:
+            self._disconnect(session)
+            raise CouldNotConnect("No ConnectionInfoMessage from %s" % session.mac)
+        session.remote_nonce = ConnectionInfoMessage.decode(answer).remote_session_nonce
+        session.fire('nonce_received')
+        return True
+
+    def _disconnect(self, session):
+        if session.peripheral is not None:
+            session.peripheral.disconnect()
+        session.peripheral = session.send = session.recv = session.inbox = None
+        session.fire('disconnected')
+
+    def _command(self, session, command):
+        answer = self._request(session, CommandMessage(command), AnswerWithSecurity)
+        return answer is not None and answer.success
+
+    def _request(self, session, message, answer_type):
+        """ send an encrypted message. returns the answer of answer_type or None """
+        self._connect(session)
+        pdu = encrypt_message(message, session.remote_nonce, session.security_counter, session.userkey)
+        session.security_counter += 1
+        data = self._exchange(session, pdu)
+        if data is None:
+            return None
+        try:
+            message_type, counter, pdu = decrypt_answer(data, session.nonce, session.userkey,
+                                                        session.remote_security_counter)
+        except InvalidData as exp:
+            LOG.info("Invalid message from %s: %s", session.mac, exp)
+            return None
+        session.remote_security_counter = counter
+        if message_type != answer_type.msgtype:
+            return None
+        return answer_type.decode(pdu)
+
+    def _wait(self, session, deadline):
+        """ returns the next pdu received or None on timeout """
+        while not session.inbox:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            session.peripheral.waitForNotifications(remaining)
+        return session.inbox.pop(0)
+
+    def _exchange(self, session, pdu):
+        """ send a message and return the answer message or None on timeout """
+        deadline = time.monotonic() + self.timeout
+        fragments = encode_fragment(pdu)
+        for index, fragment in enumerate(fragments):
+            session.send.write(fragment, True)
+            if index + 1 == len(fragments):
+                break
+            # wait for the FragmentAck
+            while True:
+                data = self._wait(session, deadline)
+                if data is None:
+                    return None
+                if acked_fragment(data) == fragment[0]:
+                    break
+
+        receiver = FragmentReceiver()
+        while True:
+            data = self._wait(session, deadline)
+            if data is None:
+                return None
+            if acked_fragment(data) is not None:
+                continue
+            message, ack = receiver.receive(data)
+            if message is not None:
+                return message
+            session.send.write(ack, True)
+
+def _sessions_memory(create, sessions):
+    """ returns the bytes allocated per session by create(index) """
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    created = [create(index) for index in range(sessions)]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del created
+    return used / sessions
+
+def benchmark_memory(sessions=1000, connected=0):
+    """ returns the memory per session of fsm.Device and CompactSession, idle and connected """
+    from fakelock import FakeLock, FakePeripheral
+    from fsm import Device
+
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+    macs = ['00:1a:%02x:%02x:%02x:%02x' % ((index >> 24) & 0xff, (index >> 16) & 0xff, (index >> 8) & 0xff,
+                                           index & 0xff) for index in range(sessions)]
+    host = SessionHost(lambda: FakePeripheral(lock, latency=0.0))
+    report = {
+        'sessions': sessions,
+        'device': _sessions_memory(lambda index: Device(macs[index], 1, userkey), sessions),
+        'compact': _sessions_memory(lambda index: host.add(macs[index], 1, userkey), sessions),
+    }
+
+    if connected:
+        def _connect_compact(index):
+            session = host.add(macs[index], 1, userkey)
+            host.connect(session).result(5.0)
+            return session
+
+        threads = threading.active_count()
+        report['compact_connected'] = _sessions_memory(_connect_compact, connected)
+        report['compact_threads'] = (threading.active_count() - threads) / connected
+
+        def _connect_device(index):
+            device = Device(macs[index], 1, userkey, peripheral_factory=lambda: FakePeripheral(lock, latency=0.0))
+            device.prepare(hold=3600, wait=5.0)
+            devices.append(device)
+
+        threads = threading.active_count()
+        devices = []
+        report['device_connected'] = _sessions_memory(_connect_device, connected)
+        report['device_threads'] = (threading.active_count() - threads) / connected
+        for device in devices:
+            device.disconnect()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory per session of fsm.Device and compact.CompactSession')
+    parser.add_argument('--sessions', dest='sessions', type=int, default=1000, help='Idle sessions')
+    parser.add_argument('--connected', dest='connected', type=int, default=100,
+                        help='Sessions connected to a fake lock (each Device starts a thread)')
+    args = parser.parse_args()
+
+    report = benchmark_memory(args.sessions, args.connected)
+    print("%d idle sessions" % report['sessions'])
+    print("fsm.Device      %8.0f bytes/session" % report['device'])
+    print("CompactSession  %8.0f bytes/session" % report['compact'])
+    if args.connected:
+        print("%d connected sessions" % args.connected)
+        print("fsm.Device      %8.0f bytes/session %.2f threads/session" % (
+            report['device_connected'], report['device_threads']))
+        print("CompactSession  %8.0f bytes/session %.2f threads/session" % (
+            report['compact_connected'], report['compact_threads']))
+
+if __name__ == '__main__':
+    main()
+
+def test_compact_sessions():
+    from fakelock import FakeLock, FakePeripheral
+    from messages import LOCK_STATUS_LOCKED
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+    host = SessionHost(lambda: FakePeripheral(lock, latency=0.0), workers=2)
+    sessions = [host.add('00:1a:22:00:00:%02x' % index, 1, userkey) for index in range(20)]
+
+    futures = [host.status(session) for session in sessions]
+    assert all(future.result(5.0).lock_status == lock.lock_status for future in futures)
+    assert all(session.state == STATE_READY for session in sessions)
+    # in order per session
+    first, second = host.command(sessions[0], 0), host.status(sessions[0])
+    assert first.result(5.0)
+    assert second.result(5.0).lock_status == LOCK_STATUS_LOCKED
+    host.disconnect(sessions[0]).result(5.0)
+    assert sessions[0].state == STATE_DISCONNECTED
+    assert len(host._threads) == 2
+
+    report = benchmark_memory(200)
+    assert report['compact'] * 10 < report['device']
@@ -9,6 +9,8 @@ GPIO.setup(27, GPIO.OUT)
 
 def trigger_door_close():
         print("Closing door by button")
+        # connect to the lock while blinking, the lock command takes a single round trip then
+        subprocess.run('mosquitto_pub -t door -m prepare'.split(), check=False)
         for i in range(0, 20):
             GPIO.output(27, GPIO.HIGH)
             time.sleep(0.25)
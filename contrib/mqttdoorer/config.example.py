@@ -2,3 +2,11 @@
 # logging_config can be a logging yaml file
 logging_config = None
 keyblecmd = '/usr/local/bin/keyble --device 00:ca:ff:ee:de:ad --user-id 1 --user-key 01234567890123456789012345678901'
+# actions within this many seconds are collapsed into the latest one
+coalesce_window = 0.5
+# control the lock in-process instead of calling keyblecmd. Required for the 'prepare' action
+# device = '00:ca:ff:ee:de:ad'
+# userid = 1
+# userkey = '01234567890123456789012345678901'
+# a prepared connection is dropped after this many seconds without a command
+prepare_hold = 15.0
@@ -2,36 +2,77 @@
 #
 # based on mqtt message it execute certain binaries.
 # the design is synchronous to ensure the executed binaries are only called once without calling parallel
+# Bursts of actions (toggle storms, repeated button presses) are coalesced into the latest one.
+# With `device` in the config the lock is controlled in-process instead, then the action
+# 'prepare' (a button was pressed, a person is approaching) connects ahead of the command.
 
+import binascii
 import logging
+import os
 import subprocess
+import sys
 import paho.mqtt.client as mqtt
 
+import config
 from config import keyblecmd, logging_config
 
+# keyblepy for the command coalescing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from coalesce import Coalescer
+
 LOG = logging.getLogger("mqttdoorer")
 
 # until keyblepy doesnt support toggle, track the state locally
 LAST_STATE = None
 
+# the in-process fsm.Device or None to call keyblecmd
+DEVICE = None
+if getattr(config, 'device', None):
+    from fsm import Device, COMMAND_LOCK, COMMAND_OPEN, COMMAND_UNLOCK
+    COMMANDS = {'lock': COMMAND_LOCK, 'unlock': COMMAND_UNLOCK, 'open': COMMAND_OPEN}
+    DEVICE = Device(config.device, config.userid, bytearray(binascii.unhexlify(config.userkey)))
+
 def keyble(action):
-    global LAST_STATE
     LOG.info("Calling for %s", action)
-    LAST_STATE = action
+    if DEVICE:
+        try:
+            return DEVICE.command(COMMANDS[action])
+        finally:
+            # like keyblecmd, don't keep the lock awake
+            DEVICE.disconnect()
+
     cmd = keyblecmd.split()
     cmd += ['--%s' % action]
     rc = subprocess.run(cmd, check=False)
     if rc.returncode:
         LOG.warning("keyble '%s' exited with %d", action, rc.returncode)
+    return rc.returncode == 0
+
+# actions arriving within the window collapse into the latest one, one keyble runs at a time
+COALESCER = Coalescer(keyble, getattr(config, 'coalesce_window', 0.5))
+
+def submit(action):
+    global LAST_STATE
+    LAST_STATE = action
+    future = COALESCER.submit(action)
+    future.add_done_callback(lambda future: LOG.info("'%s' finished: %s", action,
+                                                     future.exception() or future.result()))
 
 def lock():
-    keyble('lock')
+    submit('lock')
 
 def unlock():
-    keyble('unlock')
+    submit('unlock')
 
 def _open():
-    keyble('open')
+    submit('open')
+
+def prepare():
+    """ a command is expected soon, connect and exchange the nonce ahead """
+    if DEVICE is None:
+        LOG.info("Ignoring prepare, it requires device in the config")
+        return
+    DEVICE.prepare(getattr(config, 'prepare_hold', 15.0))
 
 def toggle():
     LOG.info("toggle from %s", LAST_STATE)
@@ -45,6 +86,7 @@ ACTIONS = {
         'unlock': unlock,
         'open': _open,
         'toggle': toggle,
+        'prepare': prepare,
         }
 
 def on_connect(client, userdata, flags, rc):
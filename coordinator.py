@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Coordinate several gateways in range of the same locks.
+#
+# A lock accepts only one connection. Gateways hearing the same lock collide on
+# the connects and waste their attempts. The gateways announce the RSSI they see of
+# each lock and the locks they own to each other over UDP every second.
+# Each lock is owned by one gateway through a lease: the gateway with the best RSSI,
+# less LEASE_PENALTY dB for each lock it owns already, takes the lease when no other
+# gateway holds it. The owner renews the lease with every announcement and releases it
+# when another gateway is better by more than HYSTERESIS dB. The lease of a gateway
+# gone silent expires after LEASE_TIME. When two gateways claim the same lock, the one
+# with the smaller id keeps it.
+# Requests for a lock are forwarded to its owner, only the owner connects to the lock.
+#
+# Every datagram carries a HMAC-SHA256 with a secret shared by the gateways, a timestamp
+# and a nonce. Datagrams with a wrong HMAC, an old timestamp or a nonce seen before are
+# dropped, so nobody else on the network can send requests or fake leases.
+#
+# Run a gateway with
+#     ./coordinator.py gateway fleet.txt --secret-file secret --id gw1 --listen 10.0.0.1:7468 --peers 10.0.0.2:7468
+# and send requests to any gateway with
+#     ./coordinator.py send 00:1a:22:33:44:55 status --secret-file secret --peers 10.0.0.2:7468
+
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from adapters import RSSI_MAX_AGE
+from exceptions import CouldNotConnect
+from timerwheel import WHEEL
+
+LOG = logging.getLogger("coordinator")
+
+DEFAULT_PORT = 7468
+# how often a gateway announces its RSSI observations and leases
+ANNOUNCE_INTERVAL = 1.0
+# how long a lease is valid without being renewed
+LEASE_TIME = 10.0
+# a gateway takes a lock over when it is better by this many dB
+HYSTERESIS = 6
+# each lock owned costs this much dB of RSSI, spreads the locks over gateways with a similar signal
+LEASE_PENALTY = 1
+# a request is forwarded at most this often
+MAX_HOPS = 2
+MAX_DATAGRAM = 65507
+# datagrams with a timestamp differing more than this from the own clock are dropped
+MAX_SKEW = 30.0
+# the length of the HMAC-SHA256 in front of each datagram
+MAC_LENGTH = 32
+
+MSG_HELLO = 'hello'
+MSG_REQUEST = 'request'
+MSG_RESULT = 'result'
+
+OPERATIONS = ['status', 'open', 'unlock', 'lock']
+
+def parse_address(address, default_host='127.0.0.1'):
+    """ returns (host, port) of "host:port", "host" or ":port" """
+    host, _, port = address.rpartition(':')
+    if not _:
+        host, port = address, DEFAULT_PORT
+    return (host or default_host, int(port))
+
+def read_secret(path):
+    """ returns the shared secret stored in the file """
+    with open(path, 'rb') as fp:
+        secret = fp.read().strip()
+    if len(secret) < 16:
+        raise RuntimeError("The secret in %s is too short, use at least 16 bytes" % path)
+    return secret
+
+class Authenticator(object):
+    """ signs and verifies the datagrams with the shared secret """
+    def __init__(self, secret, max_skew=MAX_SKEW):
+        if not secret:
+            raise ValueError("A shared secret is required")
+        self._secret = secret if isinstance(secret, bytes) else secret.encode()
+        self.max_skew = max_skew
+        self._lock = threading.Lock()
+        # nonce -> timestamp of the datagrams accepted within the skew
+        self._seen = {}
+
+    def seal(self, message):
+        """ returns the datagram of a message (a dict) """
+        message = dict(message, ts=time.time(), nonce=os.urandom(12).hex())
+        payload = json.dumps(message).encode()
+        return hmac.new(self._secret, payload, hashlib.sha256).digest() + payload
+
+    def open(self, data):
+        """ returns the message of a datagram or None when it's not authentic or replayed """
+        mac, payload = data[:MAC_LENGTH], data[MAC_LENGTH:]
+        if not hmac.compare_digest(mac, hmac.new(self._secret, payload, hashlib.sha256).digest()):
+            return None
+        message = json.loads(payload.decode())
+        now = time.time()
+        timestamp = message.get('ts', 0)
+        if abs(now - timestamp) > self.max_skew:
+            return None
+        with self._lock:
+            nonce = message.get('nonce')
+            if not nonce or nonce in self._seen:
+                return None
+            self._seen[nonce] = timestamp
+            if len(self._seen) > 1024:
+                self._seen = {nonce: seen for nonce, seen in self._seen.items() if now - seen <= self.max_skew}
+        return message
+
+class Peer(object):
+    """ another gateway as seen by this gateway """
+    def __init__(self, gateway, address):
+        self.gateway = gateway
+        self.address = address
+        # mac -> rssi of its last announcement
+        self.rssi = {}
+        # mac -> time.monotonic() the lease expires
+        self.leases = {}
+        self.seen = 0.0
+
+    def holds(self, mac, now):
+        return self.leases.get(mac, 0.0) > now
+
+    def owned(self, now):
+        return sum(1 for expires in self.leases.values() if expires > now)
+
+class Coordinator(object):
+    def __init__(self, gateway, secret, listen=('127.0.0.1', DEFAULT_PORT), peers=(), handler=None,
+                 interval=ANNOUNCE_INTERVAL, lease_time=LEASE_TIME, hysteresis=HYSTERESIS, workers=4):
+        """ :param gateway the unique id of this gateway
+            :param secret the secret shared by all gateways (bytes), authenticates the datagrams
+            :param listen (host, port) of the UDP socket, port 0 picks a free port
+            :param peers [(host, port)] of other gateways. Gateways announcing themselves are added.
+            :param handler handler(mac, operation, args) runs a request on this gateway,
+                   returns a json serializable result. None when this gateway can't talk to locks. """
+        self.gateway = gateway
+        self._auth = Authenticator(secret)
+        self.handler = handler
+        self.interval = interval
+        self.lease_time = lease_time
+        self.hysteresis = hysteresis
+        # peers not announcing for this long don't take part in the election
+        self.peer_timeout = 3 * interval
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(listen)
+        self.address = self._sock.getsockname()
+        self._seeds = [tuple(peer) for peer in peers]
+
+        self._lock = threading.Lock()
+        # gateway id -> Peer
+        self._peers = {}
+        # mac -> (rssi, time.monotonic()) seen by this gateway
+        self._rssi = {}
+        # mac -> time.monotonic() the lease of this gateway expires
+        self._leases = {}
+        # request id -> (Future, timer) of requests forwarded to other gateways
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gateway")
+
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="coordinator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ stop announcing. The leases expire on the other gateways """
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        self._sock.close()
+        self._executor.shutdown(wait=False)
+
+    def observe(self, mac, rssi):
+        """ record a RSSI observation of this gateway (e.g. from a scan) """
+        with self._lock:
+            self._rssi[mac.lower()] = (rssi, time.monotonic())
+
+    def owns(self, mac):
+        with self._lock:
+            return self._leases.get(mac.lower(), 0.0) > time.monotonic()
+
+    def owner(self, mac):
+        """ returns the gateway id owning the lock, the gateway which takes the lease
+            when nobody holds it or None when no gateway hears the lock """
+        mac = mac.lower()
+        now = time.monotonic()
+        with self._lock:
+            if self._leases.get(mac, 0.0) > now:
+                return self.gateway
+            holders = sorted(peer.gateway for peer in self._peers.values() if peer.holds(mac, now))
+            if holders:
+                return holders[0]
+            candidates = self._candidates(mac, now)
+            if not candidates:
+                return None
+            return candidates[0][1]
+
+    def stats(self):
+        """ returns the peers and leases as seen by this gateway """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'gateway': self.gateway,
+                'leases': sorted(mac for mac, expires in self._leases.items() if expires > now),
+                'peers': [{
+                    'gateway': peer.gateway,
+                    'address': "%s:%d" % peer.address,
+                    'alive': now - peer.seen <= self.peer_timeout,
+                    'leases': sorted(mac for mac in peer.leases if peer.holds(mac, now)),
+                } for peer in self._peers.values()],
+            }
+
+    def submit(self, mac, operation, *args, timeout=10.0):
+        """ run an operation on the gateway owning the lock.
+            returns a concurrent.futures.Future of the result of the handler """
+        return self._submit(mac.lower(), operation, list(args), timeout, 0)
+
+    def _submit(self, mac, operation, args, timeout, hops):
+        future = Future()
+        owner = self.owner(mac)
+        peer = self._peers.get(owner)
+        if owner == self.gateway or peer is None:
+            # nobody else hears the lock, try it from here
+            if self.handler is None:
+                future.set_exception(CouldNotConnect("No gateway is in range of %s" % mac))
+            else:
+                self._executor.submit(self._run_local, future, mac, operation, args)
+            return future
+
+        request_id = "%s/%d" % (self.gateway, next(self._ids))
+        timer = WHEEL.schedule(timeout, self._expire, request_id)
+        with self._lock:
+            self._pending[request_id] = (future, timer)
+        LOG.debug("Forwarding %s of %s to %s", operation, mac, owner)
+        self._send({'t': MSG_REQUEST, 'id': request_id, 'mac': mac, 'op': operation, 'args': args,
+                    'timeout': timeout, 'hops': hops + 1}, peer.address)
+        return future
+
+    def _run_local(self, future, mac, operation, args):
+        try:
+            result = self.handler(mac, operation, args)
+        except Exception as exp:
+            LOG.info("%s of %s failed: %s", operation, mac, exp)
+            future.set_exception(exp)
+            return
+        if isinstance(result, dict):
+            result.setdefault('gateway', self.gateway)
+        future.set_result(result)
+
+    def _expire(self, request_id):
+        with self._lock:
+            future, _timer = self._pending.pop(request_id, (None, None))
+        if future is not None and not future.done():
+            future.set_exception(FutureTimeout("No answer of the owning gateway"))
+
+    def _candidates(self, mac, now):
+        """ returns [(-score, gateway)] of the gateways hearing the lock, the best first """
+        candidates = []
+        rssi, seen = self._rssi.get(mac, (None, 0.0))
+        if rssi is not None and now - seen <= RSSI_MAX_AGE:
+            owned = sum(1 for _mac, expires in self._leases.items() if expires > now and _mac != mac)
+            candidates.append((-(rssi - LEASE_PENALTY * owned), self.gateway))
+        for peer in self._peers.values():
+            if mac in peer.rssi and now - peer.seen <= self.peer_timeout:
+                owned = peer.owned(now) - peer.holds(mac, now)
+                candidates.append((-(peer.rssi[mac] - LEASE_PENALTY * owned), peer.gateway))
+        return sorted(candidates)
+
+    def _elect(self, now):
+        """ take, renew and release the leases of this gateway """
+        with self._lock:
+            macs = set(self._leases) | set(self._rssi)
+            for mac in macs:
+                candidates = self._candidates(mac, now)
+                scores = {gateway: -score for score, gateway in candidates}
+                if self.gateway not in scores:
+                    # out of range
+                    self._release(mac)
+                    continue
+                own = scores[self.gateway]
+                holders = [peer.gateway for peer in self._peers.values() if peer.holds(mac, now)]
+                if self._leases.get(mac, 0.0) > now:
+                    if any(gateway < self.gateway for gateway in holders):
+                        LOG.info("%s is claimed by %s as well, releasing it", mac, min(holders))
+                        self._release(mac)
+                    elif any(score > own + self.hysteresis for score in scores.values()):
+                        LOG.info("Handing %s over to %s", mac, candidates[0][1])
+                        self._release(mac)
+                    else:
+                        self._leases[mac] = now + self.lease_time
+                elif not holders and candidates[0][1] == self.gateway:
+                    LOG.info("Taking the lease of %s", mac)
+                    self._leases[mac] = now + self.lease_time
+
+    def _release(self, mac):
+        self._leases.pop(mac, None)
+
+    def _announce(self, now):
+        with self._lock:
+            rssi = {mac: value for mac, (value, seen) in self._rssi.items() if now - seen <= RSSI_MAX_AGE}
+            leases = {mac: round(expires - now, 3) for mac, expires in self._leases.items() if expires > now}
+            addresses = set(self._seeds) | {peer.address for peer in self._peers.values()
+                                             if now - peer.seen <= RSSI_MAX_AGE}
+        message = {'t': MSG_HELLO, 'gw': self.gateway, 'rssi': rssi, 'leases': leases}
+        for address in addresses:
+            if address != self.address:
+                self._send(message, address)
+
+    def _send(self, message, address):
+        try:
+            self._sock.sendto(self._auth.seal(message), address)
+        except OSError as exp:
+            LOG.debug("Can not send to %s: %s", address, exp)
+
+    def _run(self):
+        next_announce = 0.0
+        while self._running:
+            now = time.monotonic()
+            if now >= next_announce:
+                self._elect(now)
+                self._announce(now)
+                next_announce = now + self.interval
+            self._sock.settimeout(max(0.001, next_announce - time.monotonic()))
+            try:
+                data, address = self._sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                message = self._auth.open(data)
+                if message is None:
+                    LOG.debug("Dropping an unauthenticated datagram from %s", address)
+                    continue
+                self._receive(message, address)
+            except Exception:
+                LOG.exception("Invalid message from %s", address)
+
+    def _receive(self, message, address):
+        kind = message.get('t')
+        if kind == MSG_HELLO:
+            self._on_hello(message, address)
+        elif kind == MSG_REQUEST:
+            self._on_request(message, address)
+        elif kind == MSG_RESULT:
+            self._on_result(message)
+
+    def _on_hello(self, message, address):
+        gateway = message['gw']
+        if gateway == self.gateway:
+            return
+        now = time.monotonic()
+        with self._lock:
+            peer = self._peers.get(gateway)
+            if peer is None:
+                LOG.info("New gateway %s at %s:%d", gateway, *address)
+                peer = self._peers[gateway] = Peer(gateway, address)
+            peer.address = address
+            peer.seen = now
+            peer.rssi = message.get('rssi', {})
+            # the remaining lease time, the clocks of the gateways don't need to agree
+            peer.leases = {mac: now + remaining for mac, remaining in message.get('leases', {}).items()}
+
+    def _on_request(self, message, address):
+        request_id = message['id']
+        mac = message['mac']
+        hops = message.get('hops', MAX_HOPS)
+
+        def _reply(future):
+            try:
+                reply = {'result': future.result(), 'error': None}
+            except Exception as exp:
+                reply = {'result': None, 'error': str(exp) or type(exp).__name__}
+            reply.update({'t': MSG_RESULT, 'id': request_id, 'gw': self.gateway})
+            self._send(reply, address)
+
+        owner = self.owner(mac)
+        if owner not in (None, self.gateway) and hops >= MAX_HOPS:
+            future = Future()
+            future.set_exception(CouldNotConnect("%s is owned by %s" % (mac, owner)))
+        else:
+            future = self._submit(mac, message['op'], message.get('args', []), message.get('timeout', 10.0), hops)
+        future.add_done_callback(_reply)
+
+    def _on_result(self, message):
+        with self._lock:
+            future, timer = self._pending.pop(message['id'], (None, None))
+        if future is None:
+            return
+        timer.cancel()
+        if message.get('error'):
+            future.set_exception(RuntimeError(message['error']))
+        else:
+            future.set_result(message['result'])
+
+def request(address, secret, mac, operation, args=(), timeout=10.0):
+    """ send a request to the gateway at address, which forwards it to the owner of the lock.
+        returns the result """
+    auth = Authenticator(secret)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        request_id = "request/%s" % os.urandom(8).hex()
+        sock.sendto(auth.seal({'t': MSG_REQUEST, 'id': request_id, 'mac': mac.lower(), 'op': operation,
+                               'args': list(args), 'timeout': timeout, 'hops': 0}), address)
+        end = time.monotonic() + timeout
+        while True:
+            sock.settimeout(max(0.001, end - time.monotonic()))
+            try:
+                data, _address = sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                raise FutureTimeout("No answer of %s:%d" % address)
+            message = auth.open(data)
+            if message is None or message.get('t') != MSG_RESULT or message.get('id') != request_id:
+                continue
+            if message.get('error'):
+                raise RuntimeError(message['error'])
+            return message['result']
+    finally:
+        sock.close()
+
+class FleetHandler(object):
+    """ runs the requests for the locks of a fleet file (see fleet.py) on this gateway """
+    def __init__(self, entries, adapters=None, timeout=10.0):
+        self.entries = {entry.mac.lower(): entry for entry in entries}
+        self.adapters = adapters
+        self.timeout = timeout
+
+    def __call__(self, mac, operation, args):
+        from fleet import status_one, command_one
+        from fsm import COMMAND_OPEN, COMMAND_UNLOCK, COMMAND_LOCK
+
+        entry = self.entries.get(mac)
+        if entry is None:
+            raise RuntimeError("%s is not in the fleet of this gateway" % mac)
+        if operation == 'status':
+            return status_one(entry, self.timeout, self.adapters)
+        commands = {'open': COMMAND_OPEN, 'unlock': COMMAND_UNLOCK, 'lock': COMMAND_LOCK}
+        if operation in commands:
+            return command_one(entry, commands[operation], self.timeout, self.adapters)
+        raise RuntimeError("Unknown operation %s" % operation)
+
+def scan(adapters, timeout):
+    """ returns {mac: rssi} of the locks in range """
+    from bluepy.btle import Scanner
+
+    if adapters:
+        devices = adapters.scan(timeout).values()
+    else:
+        devices = Scanner().scan(timeout)
+    return {dev.addr.lower(): dev.rssi for dev in devices}
+
+def run_gateway(coordinator, entries, adapters=None, scan_interval=60.0, scan_time=5.0):
+    """ scan for the locks of the fleet forever and feed the RSSI into the coordinator """
+    macs = {entry.mac.lower() for entry in entries}
+    while True:
+        try:
+            for mac, rssi in scan(adapters, scan_time).items():
+                if mac in macs:
+                    coordinator.observe(mac, rssi)
+        except Exception as exp:
+            LOG.warning("Scan failed: %s", exp)
+        LOG.info("%s", json.dumps(coordinator.stats()))
+        time.sleep(scan_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description='Coordinate keyble gateways in range of the same locks')
+    parser.add_argument('command', choices=['gateway', 'send'])
+    parser.add_argument('args', nargs='+', help='gateway: the fleet file. send: <mac> <%s>' % '|'.join(OPERATIONS))
+    parser.add_argument('--id', dest='gateway', default=socket.gethostname(), help='The unique id of this gateway. Default: the hostname')
+    parser.add_argument('--secret-file', dest='secret_file', required=True, help='File with the secret shared by all gateways (at least 16 bytes). Authenticates every datagram.')
+    parser.add_argument('--listen', dest='listen', default='127.0.0.1:%d' % DEFAULT_PORT, help='host:port of the UDP socket of this gateway. Default: only the local host')
+    parser.add_argument('--peers', dest='peers', default='', help='Comma separated host:port of other gateways. send uses the first one.')
+    parser.add_argument('--adapters', dest='adapters', help='Comma separated list of hci interfaces to use (e.g. 0,1) or "all".')
+    parser.add_argument('--scan-interval', dest='scan_interval', type=float, default=60.0, help='Seconds between the scans for the RSSI of the locks')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=10.0, help='Timeout of a request')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='Enable debug logging.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)-15s %(levelname)-8s %(name)-22s %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    peers = [parse_address(peer) for peer in args.peers.split(',') if peer.strip()]
+    secret = read_secret(args.secret_file)
+
+    if args.command == 'send':
+        if len(args.args) != 2 or args.args[1] not in OPERATIONS or not peers:
+            parser.error("send requires <mac> <%s> and --peers" % '|'.join(OPERATIONS))
+        result = request(peers[0], secret, args.args[0], args.args[1], timeout=args.timeout)
+        print(json.dumps(result))
+        sys.exit(0 if not isinstance(result, dict) or result.get('success') else 1)
+
+    from adapters import AdapterPool, find_adapters
+    from fleet import read_fleet
+
+    with open(args.args[0], 'r') as fp:
+        entries = read_fleet(fp)
+    adapters = None
+    if args.adapters == 'all':
+        adapters = AdapterPool(find_adapters())
+    elif args.adapters:
+        adapters = AdapterPool([int(iface.strip().replace('hci', '')) for iface in args.adapters.split(',')])
+
+    coordinator = Coordinator(args.gateway, secret, parse_address(args.listen), peers,
+                              FleetHandler(entries, adapters, args.timeout)).start()
+    try:
+        run_gateway(coordinator, entries, adapters, args.scan_interval)
+    except KeyboardInterrupt:
+        coordinator.stop()
+
+if __name__ == '__main__':
+    main()
+
+def test_coordinator():
+    mac = '00:1a:22:33:44:55'
+    handled = []
+
+    def _handler(gateway):
+        def _handle(_mac, operation, args):
+            handled.append((gateway, operation))
+            return {'mac': _mac, 'success': True}
+        return _handle
+
+    def _wait(condition, timeout=3.0):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    local = ('127.0.0.1', 0)
+    secret = b'0123456789abcdef'
+    gw_a = Coordinator('a', secret, local, handler=_handler('a'), interval=0.05, lease_time=0.3).start()
+    gw_b = Coordinator('b', secret, local, [gw_a.address], handler=_handler('b'), interval=0.05, lease_time=0.3).start()
+    try:
+        gw_a.observe(mac, -80)
+        gw_b.observe(mac, -60)
+        # b hears the lock better
+        assert _wait(lambda: gw_b.owns(mac) and gw_a.owner(mac) == 'b')
+        assert not gw_a.owns(mac)
+
+        # forwarded to the owner
+        assert gw_a.submit(mac, 'status').result(2.0)['gateway'] == 'b'
+        # relayed by a gateway for a client
+        assert request(gw_a.address, secret, mac, 'open', timeout=2.0)['gateway'] == 'b'
+        assert handled == [('b', 'status'), ('b', 'open')]
+        # a wrong secret is dropped
+        try:
+            request(gw_a.address, b'fedcba9876543210', mac, 'open', timeout=0.2)
+            assert False
+        except FutureTimeout:
+            pass
+        assert len(handled) == 2
+
+        # a small difference doesn't move the lock
+        gw_a.observe(mac, -58)
+        time.sleep(0.2)
+        assert gw_b.owns(mac)
+        # a big one hands it over
+        gw_a.observe(mac, -40)
+        assert _wait(lambda: gw_a.owns(mac) and gw_b.owner(mac) == 'a')
+        assert not gw_b.owns(mac)
+
+        # the lease of a silent gateway expires
+        gw_a.stop()
+        assert _wait(lambda: gw_b.owns(mac))
+    finally:
+        gw_b.stop()
+        if gw_a._running:
+            gw_a.stop()
+
+def test_authenticator():
+    auth = Authenticator(b'0123456789abcdef')
+    datagram = auth.seal({'t': MSG_HELLO, 'gw': 'a'})
+    assert auth.open(datagram)['gw'] == 'a'
+    # replayed
+    assert auth.open(datagram) is None
+    # modified
+    datagram = bytearray(auth.seal({'t': MSG_HELLO, 'gw': 'a'}))
+    datagram[-3] ^= 1
+    assert auth.open(bytes(datagram)) is None
+    # another secret
+    assert Authenticator(b'fedcba9876543210').open(auth.seal({'t': MSG_HELLO})) is None
+    # too old
+    old = Authenticator(b'0123456789abcdef', max_skew=-1)
+    assert old.open(old.seal({'t': MSG_HELLO})) is None
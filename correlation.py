@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Match the answers of the lock to the requests.
+# The lock handles one request after the other and answers in the same order.
+# A request is registered when it goes on air (not when it's enqueued, the send
+# queue may reorder by priority). An answer resolves the oldest request waiting
+# for this type of answer.
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+LOG = logging.getLogger("correlation")
+
+class Correlator(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (answer_types, future) in the order the requests were sent
+        self._pending = deque()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def sent(self, answer_types, future):
+        """ register a request which has been sent and waits for an answer of answer_types.
+            A request sent again (its answer got lost) moves behind the requests sent meanwhile """
+        with self._lock:
+            for entry in self._pending:
+                if entry[1] is future:
+                    self._pending.remove(entry)
+                    break
+            self._pending.append((answer_types, future))
+
+    def resolve(self, message):
+        """ resolve the oldest request waiting for this message.
+            returns True when the message was an answer to a request """
+        with self._lock:
+            for entry in self._pending:
+                answer_types, future = entry
+                if isinstance(message, answer_types):
+                    self._pending.remove(entry)
+                    break
+            else:
+                return False
+
+        if not future.done():
+            future.set_result(message)
+        return True
+
+    def discard(self, future):
+        """ forget a request, e.g. the caller has given up """
+        with self._lock:
+            for entry in self._pending:
+                if entry[1] is future:
+                    self._pending.remove(entry)
+                    break
+        future.cancel()
+
+    def cancel_all(self):
+        """ cancel all pending requests, e.g. on disconnect """
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        for _answer_types, future in pending:
+            future.cancel()
+
+class Counter(object):
+    """ a thread-safe security counter """
+    def __init__(self, value=1):
+        self._lock = threading.Lock()
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    def next(self):
+        """ allocate a counter value """
+        with self._lock:
+            value = self._value
+            self._value += 1
+            return value
+
+def test_correlator_order():
+    class Answer(object):
+        pass
+    class Info(object):
+        pass
+
+    correlator = Correlator()
+    first, second, info = Future(), Future(), Future()
+    correlator.sent(Answer, first)
+    correlator.sent(Info, info)
+    correlator.sent(Answer, second)
+
+    answer = Answer()
+    assert correlator.resolve(answer)
+    assert first.result(0) is answer
+    assert not second.done()
+
+    assert correlator.resolve(Info())
+    assert info.done()
+    assert correlator.resolve(Answer())
+    assert second.done()
+    assert not correlator.resolve(Answer())
+
+def test_counter():
+    counter = Counter()
+    threads = [threading.Thread(target=lambda: [counter.next() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value == 4001
+
+def test_correlator_sent_again():
+    class Answer(object):
+        pass
+
+    correlator = Correlator()
+    first, second = Future(), Future()
+    correlator.sent(Answer, first)
+    correlator.sent(Answer, second)
+    # the answer to first got lost, it's sent again after second
+    correlator.sent(Answer, first)
+    assert len(correlator) == 2
+
+    answer = Answer()
+    assert correlator.resolve(answer)
+    assert second.result(0) is answer
+    assert correlator.resolve(Answer())
+    assert first.done()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# AES-128 backends for encrypt.py.
+# A backend provides the AES-ECB primitive, the CTR keystream and the CBC-MAC
+# used by the lock protocol. The keystream counter block is 0x01 | nonce | 16 bit index,
+# the index never overflows for a lock message, so a standard 128 bit CTR mode gives the same keystream.
+#
+# select() checks every installed backend against known answers and takes the fastest one.
+# KEYBLE_CRYPTO_BACKEND=<name> forces a backend.
+
+import binascii
+import logging
+import os
+import time
+
+LOG = logging.getLogger("cryptobackend")
+
+class Backend():
+    name = None
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def ecb(self, key, data):
+        """ encrypt data (multiple of 16 byte) with aes 128 ecb """
+        raise NotImplementedError()
+
+    def ctr(self, key, counter_block, length):
+        """ returns length bytes keystream starting with counter_block """
+        keystream = bytearray()
+        counter = int.from_bytes(counter_block, 'big')
+        blocks = bytearray()
+        for index in range((length + 15) // 16):
+            blocks.extend(((counter + index) & ((1 << 128) - 1)).to_bytes(16, 'big'))
+        keystream.extend(self.ecb(key, blocks))
+        return keystream[:length]
+
+    def cbc_mac(self, key, iv, data):
+        """ returns the last block of the cbc encryption of data (multiple of 16 byte) """
+        block = bytes(iv)
+        for i in range(0, len(data), 16):
+            block = self.ecb(key, bytes(a ^ b for a, b in zip(block, data[i:i+16])))
+        return bytearray(block)
+
+class PyCryptodomeBackend(Backend):
+    name = 'pycryptodome'
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        self._aes = AES
+
+    @classmethod
+    def available(cls):
+        try:
+            from Crypto.Cipher import AES
+        except ImportError:
+            return False
+        return True
+
+    def ecb(self, key, data):
+        return bytearray(self._aes.new(bytes(key), self._aes.MODE_ECB).encrypt(bytes(data)))
+
+    def ctr(self, key, counter_block, length):
+        cipher = self._aes.new(bytes(key), self._aes.MODE_CTR, nonce=b'', initial_value=bytes(counter_block))
+        return bytearray(cipher.encrypt(bytes(length)))
+
+    def cbc_mac(self, key, iv, data):
+        cipher = self._aes.new(bytes(key), self._aes.MODE_CBC, iv=bytes(iv))
+        return bytearray(cipher.encrypt(bytes(data))[-16:])
+
+class CryptographyBackend(Backend):
+    name = 'cryptography'
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self._cipher = Cipher
+        self._algorithms = algorithms
+        self._modes = modes
+
+    @classmethod
+    def available(cls):
+        try:
+            from cryptography.hazmat.primitives.ciphers import Cipher
+        except ImportError:
+            return False
+        return True
+
+    def _encrypt(self, key, mode, data):
+        encryptor = self._cipher(self._algorithms.AES(bytes(key)), mode).encryptor()
+        return encryptor.update(bytes(data)) + encryptor.finalize()
+
+    def ecb(self, key, data):
+        return bytearray(self._encrypt(key, self._modes.ECB(), data))
+
+    def ctr(self, key, counter_block, length):
+        return bytearray(self._encrypt(key, self._modes.CTR(bytes(counter_block)), bytes(length)))
+
+    def cbc_mac(self, key, iv, data):
+        return bytearray(self._encrypt(key, self._modes.CBC(bytes(iv)), data)[-16:])
+
+def _xtime(a):
+    a <<= 1
+    return (a ^ 0x11b) if a & 0x100 else a
+
+def _sbox():
+    """ build the aes sbox """
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # p * 3
+        p = p ^ _xtime(p)
+        # q / 3
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xff
+        if q & 0x80:
+            q ^= 0x09
+        x = q ^ (q << 1 | q >> 7) ^ (q << 2 | q >> 6) ^ (q << 3 | q >> 5) ^ (q << 4 | q >> 4)
+        sbox[p] = (x ^ 0x63) & 0xff
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    return sbox
+
+class PurePythonBackend(Backend):
+    """ AES-128 in python. Slow, but always available """
+    name = 'python'
+
+    SBOX = _sbox()
+    RCON = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1b, 0x36]
+
+    def __init__(self):
+        sbox = self.SBOX
+        # T-tables: sub bytes + shift rows + mix columns as lookups
+        self._t = [[], [], [], []]
+        for value in sbox:
+            s2 = _xtime(value)
+            s3 = s2 ^ value
+            word = (s2 << 24) | (value << 16) | (value << 8) | s3
+            for i in range(4):
+                self._t[i].append(((word >> (8 * i)) | (word << (32 - 8 * i))) & 0xffffffff)
+        self._keys = {}
+
+    def _expand(self, key):
+        key = bytes(key)
+        expanded = self._keys.get(key)
+        if expanded:
+            return expanded
+
+        sbox = self.SBOX
+        words = [int.from_bytes(key[i:i+4], 'big') for i in range(0, 16, 4)]
+        for i in range(4, 44):
+            temp = words[i - 1]
+            if i % 4 == 0:
+                temp = ((temp << 8) | (temp >> 24)) & 0xffffffff
+                temp = (sbox[temp >> 24] << 24) | (sbox[(temp >> 16) & 0xff] << 16) | \
+                       (sbox[(temp >> 8) & 0xff] << 8) | sbox[temp & 0xff]
+                temp ^= self.RCON[i // 4 - 1] << 24
+            words.append(words[i - 4] ^ temp)
+
+        if len(self._keys) > 64:
+            self._keys.clear()
+        self._keys[key] = words
+        return words
+
+    def _block(self, words, block):
+        t0, t1, t2, t3 = self._t
+        sbox = self.SBOX
+        s0 = int.from_bytes(block[0:4], 'big') ^ words[0]
+        s1 = int.from_bytes(block[4:8], 'big') ^ words[1]
+        s2 = int.from_bytes(block[8:12], 'big') ^ words[2]
+        s3 = int.from_bytes(block[12:16], 'big') ^ words[3]
+        for round_ in range(1, 10):
+            k = round_ * 4
+            n0 = t0[s0 >> 24] ^ t1[(s1 >> 16) & 0xff] ^ t2[(s2 >> 8) & 0xff] ^ t3[s3 & 0xff] ^ words[k]
+            n1 = t0[s1 >> 24] ^ t1[(s2 >> 16) & 0xff] ^ t2[(s3 >> 8) & 0xff] ^ t3[s0 & 0xff] ^ words[k + 1]
+            n2 = t0[s2 >> 24] ^ t1[(s3 >> 16) & 0xff] ^ t2[(s0 >> 8) & 0xff] ^ t3[s1 & 0xff] ^ words[k + 2]
+            n3 = t0[s3 >> 24] ^ t1[(s0 >> 16) & 0xff] ^ t2[(s1 >> 8) & 0xff] ^ t3[s2 & 0xff] ^ words[k + 3]
+            s0, s1, s2, s3 = n0, n1, n2, n3
+
+        out = bytearray()
+        for i, (a, b, c, d) in enumerate(((s0, s1, s2, s3), (s1, s2, s3, s0), (s2, s3, s0, s1), (s3, s0, s1, s2))):
+            word = (sbox[a >> 24] << 24) | (sbox[(b >> 16) & 0xff] << 16) | \
+                   (sbox[(c >> 8) & 0xff] << 8) | sbox[d & 0xff]
+            out.extend((word ^ words[40 + i]).to_bytes(4, 'big'))
+        return out
+
+    def ecb(self, key, data):
+        words = self._expand(key)
+        out = bytearray()
+        for i in range(0, len(data), 16):
+            out.extend(self._block(words, data[i:i+16]))
+        return out
+
+BACKENDS = [PyCryptodomeBackend, CryptographyBackend, PurePythonBackend]
+
+# NIST SP 800-38A, F.1.1 ECB, F.2.1 CBC, F.5.1 CTR (AES-128)
+_KEY = binascii.unhexlify('2b7e151628aed2a6abf7158809cf4f3c')
+_PLAIN = binascii.unhexlify('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51')
+_ECB = binascii.unhexlify('3ad77bb40d7a3660a89ecaf32466ef97')
+_CBC_IV = binascii.unhexlify('000102030405060708090a0b0c0d0e0f')
+_CBC_LAST = binascii.unhexlify('5086cb9b507219ee95db113a917678b2')
+_CTR_COUNTER = binascii.unhexlify('f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff')
+_CTR = binascii.unhexlify('874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff')
+
+def known_answer(backend):
+    """ check the primitives of a backend """
+    if backend.ecb(_KEY, _PLAIN[:16]) != _ECB:
+        return False
+    if backend.cbc_mac(_KEY, _CBC_IV, _PLAIN) != _CBC_LAST:
+        return False
+    keystream = backend.ctr(_KEY, _CTR_COUNTER, 32)
+    return bytes(a ^ b for a, b in zip(_PLAIN, keystream)) == _CTR
+
+def benchmark(backend, duration=0.02):
+    """ returns the operations per second of a typical message (keystream + mac of 16 byte) """
+    key = bytes(16)
+    block = bytes(16)
+    count = 0
+    end = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < end:
+        backend.ecb(key, block)
+        backend.ctr(key, block, 16)
+        backend.cbc_mac(key, block, block)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+def select(check=None, name=None):
+    """ returns the fastest installed backend passing the known answers.
+        :param check an additional callable(backend) -> bool, e.g. a known answer of the whole construction
+        :param name force this backend """
+    name = name or os.environ.get('KEYBLE_CRYPTO_BACKEND')
+    candidates = []
+    for cls in BACKENDS:
+        if name and cls.name != name:
+            continue
+        if not cls.available():
+            continue
+        try:
+            backend = cls()
+            if not known_answer(backend) or (check and not check(backend)):
+                LOG.warning("Crypto backend %s failed the known answer test", cls.name)
+                continue
+        except Exception as exp:
+            LOG.warning("Crypto backend %s failed: %s", cls.name, exp)
+            continue
+        candidates.append(backend)
+
+    if not candidates:
+        raise RuntimeError("No working crypto backend found")
+    if len(candidates) == 1:
+        return candidates[0]
+
+    speeds = [(benchmark(backend), backend) for backend in candidates]
+    speed, backend = max(speeds, key=lambda entry: entry[0])
+    LOG.info("Using crypto backend %s (%d ops/s)", backend.name, speed)
+    return backend
+
+def test_pure_python_backend():
+    assert known_answer(PurePythonBackend())
+
+def test_backends_agree():
+    reference = PurePythonBackend()
+    key = bytes(range(16))
+    data = bytes(range(48))
+    for cls in BACKENDS:
+        if not cls.available():
+            continue
+        backend = cls()
+        assert known_answer(backend)
+        assert backend.ecb(key, data) == reference.ecb(key, data)
+        assert backend.ctr(key, data[:16], 40) == reference.ctr(key, data[:16], 40)
+        assert backend.cbc_mac(key, data[:16], data[16:]) == reference.cbc_mac(key, data[:16], data[16:])
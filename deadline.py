@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# The time budget of one operation.
+#
+# A Deadline is created once per operation (a status request, a command, listing
+# the users) and passed through the connect, the GATT discovery, the nonce exchange,
+# the fragment acks and the wait for the answer. Each phase waits at most what
+# remains of the budget instead of its own fixed timeout. The phases record when
+# they were entered, so an operation running out of time reports how far it got.
+
+import time
+
+class Deadline(object):
+    """ the time budget of one operation """
+    def __init__(self, timeout):
+        """ :param timeout the budget in seconds """
+        self.timeout = timeout
+        self.started = time.monotonic()
+        # time.monotonic() based, like the deadlines of the sendqueue
+        self.expires = self.started + timeout
+        # [(phase, seconds since the start when entered)], the last one is in progress
+        self.phases = []
+        self.finished = None
+
+    def remaining(self, limit=None):
+        """ seconds left of the budget, at most limit """
+        remaining = max(0.0, self.expires - time.monotonic())
+        if limit is not None:
+            return min(limit, remaining)
+        return remaining
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def phase(self):
+        """ the phase in progress or None """
+        if self.finished is not None or not self.phases:
+            return None
+        return self.phases[-1][0]
+
+    def enter(self, phase):
+        """ the operation entered phase. Entering the current phase again has no effect """
+        if self.phase == phase:
+            return
+        self.finished = None
+        self.phases.append((phase, time.monotonic() - self.started))
+
+    def done(self):
+        """ the operation (or the part of it done so far) finished """
+        self.finished = time.monotonic()
+
+    def report(self):
+        """ returns the progress as dict: the completed phases with their duration and the pending phase """
+        elapsed = self.elapsed()
+        completed = []
+        for (phase, entered), (_next, left) in zip(self.phases, self.phases[1:] + [(None, elapsed)]):
+            completed.append({'phase': phase, 'duration': round(left - entered, 6)})
+        pending = self.phase
+        if pending is not None:
+            completed.pop()
+        return {
+            'timeout': self.timeout,
+            'elapsed': round(elapsed, 6),
+            'expired': elapsed >= self.timeout,
+            'completed': completed,
+            'pending': pending,
+        }
+
+    def __str__(self):
+        report = self.report()
+        phases = ", ".join("%s %.2f s" % (entry['phase'], entry['duration']) for entry in report['completed'])
+        if report['pending'] is None:
+            state = "finished"
+        elif report['expired']:
+            state = "timed out in %s" % report['pending']
+        else:
+            state = "stopped in %s" % report['pending']
+        return "%s after %.2f s of %.2f s (%s)" % (state, report['elapsed'], self.timeout, phases or "nothing completed")
+
+def as_deadline(timeout):
+    """ returns the Deadline of a timeout given in seconds. A Deadline is passed through """
+    if isinstance(timeout, Deadline):
+        return timeout
+    return Deadline(timeout)
+
+def test_deadline():
+    deadline = Deadline(0.05)
+    assert as_deadline(deadline) is deadline
+    assert 0.0 < deadline.remaining() <= 0.05
+    assert deadline.remaining(0.01) == 0.01
+    deadline.enter('connect')
+    deadline.enter('connect')
+    deadline.enter('services')
+    assert deadline.phase == 'services'
+    time.sleep(0.06)
+    assert deadline.expired()
+    assert deadline.remaining() == 0.0
+
+    report = deadline.report()
+    assert report['expired']
+    assert report['pending'] == 'services'
+    assert [entry['phase'] for entry in report['completed']] == ['connect']
+    assert str(deadline).startswith("timed out in services")
+
+    deadline.done()
+    report = deadline.report()
+    assert report['pending'] is None
+    assert [entry['phase'] for entry in report['completed']] == ['connect', 'services']
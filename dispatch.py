@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Ordered dispatch of the receive callbacks off the BLE thread.
+#
+# The LowerLayer worker thread reassembles fragments and sends the FragmentAcks.
+# A slow consumer of the messages (decryption, state changes, the callbacks of the
+# request futures) must not delay the next fragment or ack, else the lock times out.
+# An OrderedDispatcher runs the callbacks of one session one after the other in
+# the order they were submitted, on the threads of a pool shared by all sessions.
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger("dispatch")
+
+# runs the callbacks of all sessions
+DISPATCH = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dispatch")
+
+class OrderedDispatcher(object):
+    """ run callables in order on a shared executor, at most one at a time """
+    def __init__(self, executor=None):
+        self._executor = executor or DISPATCH
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._running = False
+
+    def submit(self, callback, *args):
+        with self._lock:
+            self._pending.append((callback, args))
+            if self._running:
+                return
+            self._running = True
+        self._executor.submit(self._drain)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                callback, args = self._pending.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                LOG.exception("Callback %s failed", callback)
+
+def test_ordered_dispatcher():
+    import time
+    executor = ThreadPoolExecutor(max_workers=2)
+    slow, fast = OrderedDispatcher(executor), OrderedDispatcher(executor)
+    received = []
+    done = threading.Event()
+
+    def _slow(value):
+        time.sleep(0.01)
+        received.append(('slow', value))
+
+    def _fail():
+        raise RuntimeError("consumer failed")
+
+    for value in range(5):
+        slow.submit(_slow, value)
+    slow.submit(_fail)
+    slow.submit(done.set)
+    start = time.monotonic()
+    fast.submit(received.append, ('fast', 0))
+    # submitting doesn't wait for the consumer
+    assert time.monotonic() - start < 0.01
+    assert done.wait(2.0)
+    assert [value for name, value in received if name == 'slow'] == list(range(5))
+    # not blocked by the slow session
+    assert received.index(('fast', 0)) < 4
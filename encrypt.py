@@ -3,18 +3,29 @@
 # License ISC
 #
 # a close 1:1 copy from the `keyble` code (coffe script code - isc)
-# TODO: check if we can use AES/ECB with PKCS7 padding.
+# The keystream is AES-CTR and the authentication value a CBC-MAC, both are
+# done by the fastest installed crypto backend (see cryptobackend.py).
 # TODO: do we have to support the 'other' encryption methods? In theory there might be other encryption than this one
 
 import math
+import threading
 from struct import pack, unpack
-from Crypto.Cipher import AES
 
-def _aes_encrypt(key, data):
+import cryptobackend
+from exceptions import InvalidData
+
+_BACKEND = None
+
+def get_backend():
+    """ returns the crypto backend, selected on first use """
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = cryptobackend.select(check=_known_answer)
+    return _BACKEND
+
+def _aes_encrypt(key, data, backend=None):
     """ encrypt data with key using aes 128 ecb """
-    mode = AES.MODE_ECB
-    encryptor = AES.new(bytes(key), mode)
-    return bytearray(encryptor.encrypt(bytes(data)))
+    return bytearray((backend or get_backend()).ecb(key, data))
 
 def _pad_array(data, step, minimum):
     _data = bytearray(data)
@@ -39,59 +50,137 @@ def xor_array(data, xor_data, xor_data_offset=0):
         xorred.append(data[i] ^ xor_data[(xor_data_offset + i) % len(xor_data)])
     return xorred
 
-def crypt_data(message_data, message_type_id, session_open_nonce, security_counter, key):
+def _counter_block(nonce, index):
+    """ the input block of the keystream: 0x01 | nonce | index """
+    block = bytearray()
+    block.append(0x01)
+    block.extend(nonce)
+    block.extend(pack('>H', index))
+    return block
+
+def _keystream(key, nonce, length, backend=None):
+    """ the keystream for length bytes. The keystream blocks are counted from 1 """
+    return (backend or get_backend()).ctr(key, _counter_block(nonce, 1), _padding_length(length, 16, 0))
+
+def _auth_header(key, nonce, length, backend=None):
+    """ the first block of the authentication (CBC-MAC) chain """
+    tmp = bytearray()
+    tmp.append(0x09)
+    tmp.extend(nonce)
+    tmp.extend(pack('>H', length))
+    return _aes_encrypt(key, tmp, backend)
+
+class Precomputed():
+    """ everything of the encryption which only depends on the key, nonce and length """
+    def __init__(self, key, nonce, length):
+        self.keystream = _keystream(key, nonce, length)
+        self.auth_header = _auth_header(key, nonce, length)
+        # the keystream block 0 encrypts the authentication value
+        self.auth_xor = _aes_encrypt(key, _counter_block(nonce, 0))
+
+def crypt_data(message_data, message_type_id, session_open_nonce, security_counter, key, precomputed=None):
     """ message_data does not contain the message_type_id """
+    if precomputed:
+        return xor_array(message_data, precomputed.keystream)
     nonce = compute_nonce(message_type_id, session_open_nonce, security_counter)
-    xor_data = bytearray()
-    # do 16 byte at once
-    for index in range(_padding_length(len(message_data), 16, 0) // 16):
-        tmp = bytearray()
-        tmp.append(0x01)
-        tmp.extend(nonce)
-        tmp.extend(pack('>H', index + 1))
-        tmp = _pad_array(tmp, 16, 0)
-        xor_data.extend(_aes_encrypt(key, tmp))
-    return xor_array(message_data, xor_data)
-
-def compute_authentication_value(message_data, message_type_id, session_nonce, security_counter, user_key):
+    return xor_array(message_data, _keystream(key, nonce, len(message_data)))
+
+def compute_authentication_value(message_data, message_type_id, session_nonce, security_counter, user_key, precomputed=None, backend=None):
     """ an auth is 4 byte long """
-    nonce = compute_nonce(message_type_id, session_nonce, security_counter)
+    backend = backend or get_backend()
+    nonce = None
+    if not precomputed:
+        nonce = compute_nonce(message_type_id, session_nonce, security_counter)
     length = len(message_data)
 
-    padded_length = _padding_length(length, 16, 0)
     padded_data = _pad_array(message_data, 16, 0)
 
-    tmp = bytearray()
-    tmp.append(0x09)
-    tmp.extend(nonce)
-    tmp.extend(pack('>H', length))
-    encrypted_xor_data = _aes_encrypt(user_key, tmp)
+    if precomputed:
+        encrypted_xor_data = precomputed.auth_header
+    else:
+        encrypted_xor_data = _auth_header(user_key, nonce, length, backend)
 
-    for i in range(0, padded_length, 16):
-        encrypted_xor_data = _aes_encrypt(user_key, xor_array(encrypted_xor_data, padded_data, i))
+    # CBC-MAC with the header as IV
+    encrypted_xor_data = backend.cbc_mac(user_key, encrypted_xor_data, padded_data)
 
-    # xor array
-    tmp = bytearray()
-    tmp.append(0x01)
-    tmp.extend(nonce)
-    tmp.append(0x00)
-    tmp.append(0x00)
-    tmp.extend(pack('>H', padded_length))
-    tmp = _pad_array(tmp, 16, 0)
-    return xor_array(
-        encrypted_xor_data[0:4],
-        _aes_encrypt(user_key, tmp)
-    )
-
-def encrypt_message(message, remote_nonce, local_security_counter, user_key):
+    if precomputed:
+        auth_xor = precomputed.auth_xor
+    else:
+        auth_xor = _aes_encrypt(user_key, _counter_block(nonce, 0), backend)
+    return xor_array(encrypted_xor_data[0:4], auth_xor)
+
+def _known_answer(backend):
+    """ the nodejs test data of test_compute_auth for the crypto backend selection """
+    nonce, = unpack('>Q', bytearray([1,2,3,4,5,6,7,8]))
+    ret = compute_authentication_value(
+            bytearray([1,2,3]),
+            23,
+            nonce,
+            1,
+            bytearray([1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16]),
+            backend=backend)
+    return ret == bytearray([ 219, 223, 137, 233 ])
+
+class KeystreamCache():
+    """ precomputed keystreams and authentication blocks of a session for the next security counters.
+        Everything besides the CBC-MAC over the payload is known before the message.
+        A cache belongs to one key and remote session nonce, create a new one when they change.
+    """
+    def __init__(self, key, session_nonce, depth=4):
+        self.key = bytes(key)
+        self.session_nonce = session_nonce
+        self.depth = depth
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (message_type_id, security_counter, length) -> Precomputed
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def precompute(self, message_type_ids, length, first_counter):
+        """ precompute the next depth counters for all message_type_ids. Entries of older counters are dropped """
+        with self._lock:
+            for entry in [entry for entry in self._entries if entry[1] < first_counter]:
+                del self._entries[entry]
+
+        for counter in range(first_counter, first_counter + self.depth):
+            for message_type_id in message_type_ids:
+                entry = (message_type_id, counter, length)
+                if entry in self._entries:
+                    continue
+                nonce = compute_nonce(message_type_id, self.session_nonce, counter)
+                precomputed = Precomputed(self.key, nonce, length)
+                with self._lock:
+                    self._entries[entry] = precomputed
+
+    def take(self, message_type_id, security_counter, length):
+        """ returns the Precomputed of the message or None """
+        with self._lock:
+            precomputed = self._entries.pop((message_type_id, security_counter, length), None)
+        if precomputed:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return precomputed
+
+    def matches(self, key, session_nonce):
+        return self.session_nonce == session_nonce and self.key == bytes(key)
+
+def encrypt_message(message, remote_nonce, local_security_counter, user_key, cache=None):
     encoded = message.encode()
     body = encoded[1:]
     msg_type_id = encoded[0]
 
     padded_body = _pad_array(body, 15, 8)
 
-    _crypt_data = crypt_data(padded_body, msg_type_id, remote_nonce, local_security_counter, user_key)
-    auth = compute_authentication_value(padded_body, msg_type_id, remote_nonce, local_security_counter, user_key)
+    precomputed = None
+    if cache is not None and cache.matches(user_key, remote_nonce):
+        precomputed = cache.take(msg_type_id, local_security_counter, len(padded_body))
+
+    _crypt_data = crypt_data(padded_body, msg_type_id, remote_nonce, local_security_counter, user_key, precomputed)
+    auth = compute_authentication_value(padded_body, msg_type_id, remote_nonce, local_security_counter, user_key, precomputed)
 
     tmp = bytearray()
     tmp.append(msg_type_id)
@@ -101,6 +190,38 @@ def encrypt_message(message, remote_nonce, local_security_counter, user_key):
 
     return tmp
 
+def decrypt_message(data, local_nonce, user_key):
+    """ decrypt a message with security received from the lock.
+        The lock encrypts with our (local) session nonce and its own security counter.
+        [1 byte id][x byte cryptdata][2 byte counter][4 byte auth]
+        returns (msg_type_id, security_counter, decrypted message including the msg_type_id)
+    """
+    if len(data) < 7:
+        raise InvalidData("Message to short")
+
+    msg_type_id = data[0]
+    security_counter, = unpack('>H', data[-6:-4])
+    auth = data[-4:]
+
+    body = crypt_data(data[1:-6], msg_type_id, local_nonce, security_counter, user_key)
+    computed = compute_authentication_value(body, msg_type_id, local_nonce, security_counter, user_key)
+    if computed != auth:
+        raise InvalidData("Invalid message authentication")
+
+    decrypted = bytearray()
+    decrypted.append(msg_type_id)
+    decrypted.extend(body)
+    return (msg_type_id, security_counter, decrypted)
+
+def decrypt_answer(data, local_nonce, user_key, remote_security_counter):
+    """ decrypt a message from the lock like decrypt_message(). The security counter of the message
+        must be above the last one received (remote_security_counter), the lock never repeats it.
+        Raise InvalidData for a replayed message """
+    msg_type_id, security_counter, decrypted = decrypt_message(data, local_nonce, user_key)
+    if security_counter <= remote_security_counter:
+        raise InvalidData("Invalid message counter")
+    return (msg_type_id, security_counter, decrypted)
+
 def test_pad_array():
     pad = bytearray(8)
     pad = _pad_array(pad, 15, 8)
@@ -172,3 +293,53 @@ def test_compute_nonce():
     ret = compute_nonce(23, nonce, 42)
     assert ret == bytearray([23, 1, 2, 3, 4, 5, 6, 7, 8, 0, 0, 0, 42])
 
+def test_decrypt_message():
+    class _Message():
+        def encode(self):
+            return bytearray([0x83, 1, 2, 3, 4, 5, 6])
+
+    key = bytearray(range(16))
+    encrypted = encrypt_message(_Message(), 42, 7, key)
+    msg_type_id, counter, decrypted = decrypt_message(encrypted, 42, key)
+    assert msg_type_id == 0x83
+    assert counter == 7
+    assert decrypted[0:7] == bytearray([0x83, 1, 2, 3, 4, 5, 6])
+
+    encrypted[-1] ^= 0xff
+    try:
+        decrypt_message(encrypted, 42, key)
+    except InvalidData:
+        pass
+    else:
+        assert False
+
+    try:
+        decrypt_answer(encrypt_message(_Message(), 42, 7, key), 42, key, 7)
+    except InvalidData:
+        pass
+    else:
+        assert False
+
+def test_keystream_cache():
+    class _Message():
+        def encode(self):
+            return bytearray([0x87, 0x02])
+
+    key = bytearray(range(16))
+    cache = KeystreamCache(key, 42)
+    cache.precompute([0x87, 0x82], 8, 5)
+    assert len(cache) == 8
+
+    assert encrypt_message(_Message(), 42, 5, key, cache) == encrypt_message(_Message(), 42, 5, key)
+    assert cache.hits == 1
+    # another nonce is never served from the cache
+    encrypt_message(_Message(), 43, 6, key, cache)
+    assert cache.hits == 1
+
+    cache.precompute([0x87], 8, 7)
+    assert not [entry for entry in cache._entries if entry[1] < 7]
+
+def test_backends_compute_auth():
+    for cls in cryptobackend.BACKENDS:
+        if cls.available():
+            assert _known_answer(cls())
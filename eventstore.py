@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# A local columnar store of the events of many locks (status changes, commands).
+#
+# Events are appended into an in-memory tail and sealed into immutable segment files
+# (flush(), close() or when the tail is full). A segment holds the events sorted by
+# lock and time: an index with the time range and rows of each lock, followed by the
+# columns. The lock is implicit by the index, so an event takes 6 bytes.
+# Segments are memory mapped, a range query is a binary search per lock and segment.
+# Each process seals its tail when it ends, so there are many small segments. They are
+# merged by size tiers: when the newest MERGE_SEGMENTS segments are in the same tier
+# (up to MERGE_SEGMENTS times the events of the tier below), they are merged into a
+# segment of the next tier. The big old segments are only rewritten when enough new
+# events add up to their tier.
+#
+# Layout (little endian):
+#   header: 'KBLEEVS' version(uint8) base(uint32) locks(uint32) events(uint32)
+#   index:  per lock mac(6 byte) status(uint8) pad(1) first row(uint32) events(uint32) first(uint32) last(uint32)
+#   columns: timestamp(uint32 seconds) * events, userid(uint8) * events, type(uint8) * events
+#
+# A merged segment replaces all segments from `base` up to its own number.
+# The status of the index is the latest status event of the lock in the segment
+# (0xff none), so the store knows the last status of a lock without reading its
+# events. Version 1 segments don't have it.
+
+import argparse
+import fcntl
+import logging
+import mmap
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+from struct import Struct
+
+from messages import AnswerWithSecurity, CommandMessage, LOCK_STATUS_NAMES, StatusInfoMessage
+
+LOG = logging.getLogger("eventstore")
+
+MAGIC = b'KBLEEVS'
+VERSION = 2
+HEADER = Struct('<7sBIII')
+INDEX = Struct('<6sBxIIII')
+SUFFIX = '.kev'
+
+# seal the tail into a segment when it holds that many events
+SEGMENT_EVENTS = 65536
+# merge the newest segments when there are that many of the same tier
+MERGE_SEGMENTS = 4
+
+# the userid is not known
+NO_USER = 0xff
+# the index status of a lock without status events in the segment
+NO_STATUS = 0xff
+
+# event types. The status events carry the lock status (messages.LOCK_STATUS_*)
+EVENT_STATUS = 0x00
+# the lock accepted (EVENT_COMMAND) or rejected (EVENT_COMMAND_FAILED) a fsm.COMMAND_*
+EVENT_COMMAND = 0x10
+EVENT_COMMAND_FAILED = 0x20
+
+STATUS_EVENTS = [EVENT_STATUS | status for status in range(8)]
+
+_COMMAND_NAMES = {0: 'lock', 1: 'unlock', 2: 'open'}
+
+Event = namedtuple('Event', ['mac', 'timestamp', 'userid', 'type'])
+
+def event_name(event_type):
+    base, value = event_type & 0xf0, event_type & 0x0f
+    if base == EVENT_STATUS:
+        return LOCK_STATUS_NAMES.get(value, 'status %d' % value)
+    if base == EVENT_COMMAND:
+        return _COMMAND_NAMES.get(value, 'command %d' % value)
+    if base == EVENT_COMMAND_FAILED:
+        return "%s failed" % _COMMAND_NAMES.get(value, 'command %d' % value)
+    return 'unknown 0x%02x' % event_type
+
+def events_from_message(message, request=None):
+    """ returns the event type of a decoded message or None when it isn't an event.
+        :param request the request answered by the message """
+    if isinstance(message, StatusInfoMessage):
+        return EVENT_STATUS | message.lock_status
+    if isinstance(message, AnswerWithSecurity) and isinstance(request, CommandMessage):
+        return (EVENT_COMMAND if message.success else EVENT_COMMAND_FAILED) | (request.command & 0x0f)
+    return None
+
+def _mac_bytes(mac):
+    return bytes(int(part, 16) for part in mac.split(':'))
+
+def _mac_str(mac):
+    return ':'.join('%02x' % byte for byte in mac)
+
+def _column(data, typecode):
+    """ a memoryview of the column as typecode """
+    if sys.byteorder == 'little':
+        return data.cast(typecode)
+    column = array(typecode, data)
+    column.byteswap()
+    return column
+
+class Segment(object):
+    """ a sealed segment, memory mapped """
+    def __init__(self, path):
+        self.path = path
+        self.number = int(os.path.basename(path)[:-len(SUFFIX)])
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            self._map = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, self.base, locks, self.events = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version not in (1, VERSION):
+            self._map.close()
+            raise RuntimeError("%s is not an event segment" % path)
+
+        # mac -> (first row, events, first timestamp, last timestamp, last status event or NO_STATUS)
+        self.index = {}
+        for lock in range(locks):
+            mac, status, first, events, start, end = INDEX.unpack_from(self._map, HEADER.size + lock * INDEX.size)
+            self.index[_mac_str(mac)] = (first, events, start, end, status if version > 1 else None)
+
+        view = memoryview(self._map)
+        offset = HEADER.size + locks * INDEX.size
+        self.timestamps = _column(view[offset:offset + 4 * self.events], 'I')
+        offset += 4 * self.events
+        self.userids = view[offset:offset + self.events]
+        offset += self.events
+        self.types = view[offset:offset + self.events]
+        if version == 1:
+            for mac, (first, events, start, end, _) in self.index.items():
+                self.index[mac] = (first, events, start, end, _last_status(self.types[first:first + events]))
+
+    def close(self):
+        # the views must be released before the map
+        self.timestamps = self.userids = self.types = None
+        try:
+            self._map.close()
+        except BufferError:
+            # a caller still holds a view, the map is closed when it's collected
+            pass
+
+    def rows(self, mac, start, end):
+        """ returns the range of rows of mac with start <= timestamp < end """
+        entry = self.index.get(mac)
+        if entry is None:
+            return range(0)
+        first, events, first_time, last_time, _ = entry
+        if last_time < start or first_time >= end:
+            return range(0)
+        lo = bisect_left(self.timestamps, start, first, first + events)
+        hi = bisect_left(self.timestamps, end, lo, first + events)
+        return range(lo, hi)
+
+    def lock_events(self, mac):
+        """ returns the columns (timestamps, userids, types) of a lock """
+        first, events, _, _, _ = self.index[mac]
+        return (self.timestamps[first:first + events], self.userids[first:first + events],
+                self.types[first:first + events])
+
+    def status(self, mac):
+        """ returns the latest status event of a lock in this segment or None """
+        entry = self.index.get(mac)
+        if entry is None or entry[4] == NO_STATUS:
+            return None
+        return entry[4]
+
+def _tier(events, factor):
+    """ the size tier of a segment, a tier holds up to factor times the events of the one below """
+    tier = 0
+    while events >= factor:
+        events //= factor
+        tier += 1
+    return tier
+
+def _last_status(types):
+    """ returns the last status event of the types or NO_STATUS """
+    for event_type in reversed(types):
+        if event_type in STATUS_EVENTS:
+            return event_type
+    return NO_STATUS
+
+def write_segment(path, base, locks):
+    """ write a segment. locks is {mac: (timestamps, userids, types)} """
+    index = []
+    timestamps = array('I')
+    userids = bytearray()
+    types = bytearray()
+    for mac in sorted(locks):
+        _timestamps, _userids, _types = locks[mac]
+        # stable, events of the same second stay in order
+        order = sorted(range(len(_timestamps)), key=_timestamps.__getitem__)
+        if not order:
+            continue
+        _types = bytes(_types[row] for row in order)
+        index.append(INDEX.pack(_mac_bytes(mac), _last_status(_types), len(timestamps), len(order),
+                                _timestamps[order[0]], _timestamps[order[-1]]))
+        timestamps.extend(_timestamps[row] for row in order)
+        userids.extend(_userids[row] for row in order)
+        types.extend(_types)
+
+    if sys.byteorder != 'little':
+        timestamps.byteswap()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, base, len(index), len(userids)))
+        fp.write(b''.join(index))
+        fp.write(timestamps.tobytes())
+        fp.write(userids)
+        fp.write(types)
+    os.replace(tmp, path)
+
+class EventStore(object):
+    """ without a path the store is disabled and append() does nothing """
+    def __init__(self, path=None, segment_events=SEGMENT_EVENTS, merge_segments=MERGE_SEGMENTS):
+        self.path = None
+        self.segment_events = segment_events
+        self.merge_segments = max(2, merge_segments)
+        self._lock = threading.RLock()
+        # mac -> (timestamps, userids, types) not sealed yet
+        self._tail = {}
+        self._tail_events = 0
+        # number -> Segment
+        self._segments = {}
+        # mac -> the latest status event, a status is only stored when it changed
+        self._status = {}
+        if path:
+            self.open(path)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def open(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.refresh()
+
+    def close(self):
+        with self._lock:
+            if self.path is None:
+                return
+            self.flush()
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+            self.path = None
+
+    def _locked(self):
+        """ serializes writing and merging segments between processes """
+        fd = os.open(os.path.join(self.path, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def refresh(self):
+        """ pick up the segments written by other processes """
+        with self._lock:
+            numbers = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(self.path) if name.endswith(SUFFIX))
+            for number in numbers:
+                if number not in self._segments:
+                    try:
+                        self._segments[number] = Segment(os.path.join(self.path, '%08d%s' % (number, SUFFIX)))
+                    except (OSError, ValueError, RuntimeError) as exp:
+                        # removed by a merge in the meantime or not completely written
+                        LOG.info("Skipping segment %d: %s", number, exp)
+            for number in list(self._segments):
+                if number not in numbers:
+                    self._segments.pop(number).close()
+
+            # segments replaced by a merged segment, left over by an interrupted merge
+            for segment in list(self._segments.values()):
+                for number in [number for number in self._segments if segment.base <= number < segment.number]:
+                    self._segments.pop(number).close()
+
+    def append(self, mac, event_type, userid=NO_USER, timestamp=None):
+        """ add an event. timestamp in seconds since the epoch, default now """
+        if self.path is None:
+            return
+        with self._lock:
+            columns = self._tail.get(mac)
+            if columns is None:
+                columns = self._tail[mac] = (array('I'), bytearray(), bytearray())
+            columns[0].append(int(time.time() if timestamp is None else timestamp))
+            columns[1].append(NO_USER if userid is None else userid)
+            columns[2].append(event_type)
+            self._tail_events += 1
+            if self._tail_events >= self.segment_events:
+                self.flush()
+
+    def ingest(self, mac, message, userid=NO_USER, request=None, timestamp=None):
+        """ add the event of a decoded message (see events_from_message).
+            returns the event type or None when the message isn't an event """
+        event_type = events_from_message(message, request)
+        if event_type is None or self.path is None:
+            return event_type
+        if event_type in STATUS_EVENTS:
+            with self._lock:
+                if mac not in self._status:
+                    self._status[mac] = self._last_status(mac)
+                if self._status[mac] == event_type:
+                    return event_type
+                self._status[mac] = event_type
+        self.append(mac, event_type, userid, timestamp)
+        return event_type
+
+    def _last_status(self, mac):
+        """ the latest status event of a lock stored, from the tail or the index of the newest segment with one """
+        columns = self._tail.get(mac)
+        if columns:
+            status = _last_status(columns[2])
+            if status != NO_STATUS:
+                return status
+        for number in sorted(self._segments, reverse=True):
+            status = self._segments[number].status(mac)
+            if status is not None:
+                return status
+        return None
+
+    def flush(self):
+        """ seal the tail into a segment """
+        with self._lock:
+            if self.path is None or not self._tail_events:
+                return
+            fd = self._locked()
+            try:
+                self.refresh()
+                number = max(self._segments, default=0) + 1
+                path = os.path.join(self.path, '%08d%s' % (number, SUFFIX))
+                write_segment(path, number, self._tail)
+                self._segments[number] = Segment(path)
+                self._tail = {}
+                self._tail_events = 0
+                segments = self._merge_candidates()
+                while segments:
+                    self._merge(segments)
+                    segments = self._merge_candidates()
+            finally:
+                self._unlock(fd)
+
+    def _merge_candidates(self):
+        """ returns the newest segments up to the tier of the newest one, when there are enough of them """
+        segments = [self._segments[number] for number in sorted(self._segments, reverse=True)]
+        if not segments:
+            return None
+        tier = _tier(segments[0].events, self.merge_segments)
+        candidates = []
+        for segment in segments:
+            if _tier(segment.events, self.merge_segments) > tier:
+                break
+            candidates.insert(0, segment)
+        if len(candidates) < self.merge_segments:
+            return None
+        return candidates
+
+    def _merge(self, segments):
+        """ merge the newest segments (sorted by number) into one. Must be called with the file lock held """
+        locks = {}
+        for segment in segments:
+            for mac in segment.index:
+                timestamps, userids, types = segment.lock_events(mac)
+                columns = locks.get(mac)
+                if columns is None:
+                    columns = locks[mac] = (array('I'), bytearray(), bytearray())
+                columns[0].extend(timestamps)
+                columns[1].extend(userids)
+                columns[2].extend(types)
+
+        base = segments[0].base
+        number = segments[-1].number + 1
+        path = os.path.join(self.path, '%08d%s' % (number, SUFFIX))
+        write_segment(path, base, locks)
+        self._segments[number] = Segment(path)
+        for segment in segments:
+            del self._segments[segment.number]
+            segment.close()
+            os.remove(segment.path)
+
+    def __len__(self):
+        with self._lock:
+            return self._tail_events + sum(segment.events for segment in self._segments.values())
+
+    def macs(self):
+        with self._lock:
+            macs = set(self._tail)
+            for segment in self._segments.values():
+                macs.update(segment.index)
+        return sorted(macs)
+
+    def query(self, mac=None, start=0, end=None, userid=None, types=None):
+        """ returns the events sorted by time.
+
+            :param mac a lock or None for all locks
+            :param start, end seconds since the epoch, start <= timestamp < end
+            :param userid only events of this user
+            :param types only events of these types (e.g. [EVENT_COMMAND | fsm.COMMAND_OPEN]) """
+        end = 0x100000000 if end is None else end
+        types = set(types) if types is not None else None
+        events = []
+        with self._lock:
+            macs = [mac] if mac else self.macs()
+            for _mac in macs:
+                for segment in self._segments.values():
+                    for row in segment.rows(_mac, start, end):
+                        if userid is not None and segment.userids[row] != userid:
+                            continue
+                        if types is not None and segment.types[row] not in types:
+                            continue
+                        events.append(Event(_mac, segment.timestamps[row], segment.userids[row], segment.types[row]))
+
+                columns = self._tail.get(_mac)
+                if columns:
+                    for timestamp, _userid, _type in zip(*columns):
+                        if not start <= timestamp < end:
+                            continue
+                        if userid is not None and _userid != userid:
+                            continue
+                        if types is not None and _type not in types:
+                            continue
+                        events.append(Event(_mac, timestamp, _userid, _type))
+        events.sort(key=lambda event: event.timestamp)
+        return events
+
+    def last(self, mac, types=None, userid=None):
+        """ returns the latest event of a lock or None """
+        events = self.query(mac, userid=userid, types=types)
+        return events[-1] if events else None
+
+# the events recorded by the devices of this process, disabled until opened
+EVENTS = EventStore()
+
+def _parse_time(value):
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the keyble event store')
+    parser.add_argument('path', help='The event store directory')
+    parser.add_argument('--device', dest='device', help='Only events of this lock')
+    parser.add_argument('--since', dest='since', help='ISO date/time, e.g. 2020-01-31 or 2020-01-31T08:00')
+    parser.add_argument('--until', dest='until', help='ISO date/time')
+    parser.add_argument('--user-id', dest='userid', type=int, help='Only events of this user')
+    args = parser.parse_args()
+
+    store = EventStore(args.path)
+    for event in store.query(args.device, _parse_time(args.since) or 0, _parse_time(args.until), args.userid):
+        userid = '-' if event.userid == NO_USER else event.userid
+        print("%s %s %3s %s" % (datetime.fromtimestamp(event.timestamp).isoformat(), event.mac,
+                                userid, event_name(event.type)))
+
+if __name__ == '__main__':
+    main()
+
+def test_event_store():
+    import tempfile
+    from messages import LOCK_STATUS_LOCKED
+    door = '00:1a:22:00:00:0c'
+    other = '00:1a:22:00:00:0d'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = EventStore(tmpdir, merge_segments=2)
+        # out of order, like downloaded logs
+        store.append(door, EVENT_COMMAND | 2, 3, timestamp=2000)
+        store.append(door, EVENT_COMMAND | 2, 4, timestamp=1000)
+        store.append(other, EVENT_COMMAND | 2, 3, timestamp=1500)
+        assert [event.timestamp for event in store.query(door)] == [1000, 2000]
+        store.flush()
+        assert store.ingest(door, AnswerWithSecurity(0x01), 3, CommandMessage(0), timestamp=3000) == EVENT_COMMAND
+        assert store.ingest(door, StatusInfoMessage(bytearray([0, 0x80, 3, 0, 0, 0])), timestamp=3001) == \
+            EVENT_STATUS | LOCK_STATUS_LOCKED
+        assert store.ingest(door, CommandMessage(0)) is None
+        # unchanged status
+        store.ingest(door, StatusInfoMessage(bytearray([0, 0x80, 3, 0, 0, 0])), timestamp=3002)
+        store.flush()
+        store.append(other, EVENT_COMMAND_FAILED | 1, timestamp=4000)
+        store.flush()
+        # the first two are merged, the small newest one isn't merged into the bigger one
+        assert sorted(os.listdir(tmpdir)) == ['.lock', '00000003.kev', '00000004.kev']
+
+        store = EventStore(tmpdir)
+        assert len(store) == 6
+        assert store.macs() == [door, other]
+        opened = store.query(door, start=1000, end=3000, types=[EVENT_COMMAND | 2])
+        assert [(event.timestamp, event.userid) for event in opened] == [(1000, 4), (2000, 3)]
+        assert [event.mac for event in store.query(userid=3)] == [other, door, door]
+        assert store.last(door).type == EVENT_STATUS | LOCK_STATUS_LOCKED
+        assert event_name(store.last(door).type) == 'locked'
+        assert store.last(door, types=[EVENT_COMMAND | 0]).userid == 3
+        assert event_name(store.last(other).type) == 'unlock failed'
+        # the last status comes from the segment index
+        segment = store._segments[3]
+        assert segment.status(door) == EVENT_STATUS | LOCK_STATUS_LOCKED
+        assert segment.status(other) is None
+        store.ingest(door, StatusInfoMessage(bytearray([0, 0x80, 3, 0, 0, 0])), timestamp=5000)
+        assert len(store) == 6
+        store.close()
+
+        # disabled store
+        EventStore().append(door, EVENT_COMMAND | 2)
+
+    class _Store(EventStore):
+        rewritten = 0
+
+        def _merge(self, segments):
+            _Store.rewritten += sum(segment.events for segment in segments)
+            EventStore._merge(self, segments)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # a process per event, each seals a segment
+        for index in range(256):
+            store = _Store(tmpdir)
+            store.append(door, EVENT_COMMAND | 2, timestamp=index)
+            store.close()
+        store = EventStore(tmpdir)
+        assert len(store) == 256
+        assert [event.timestamp for event in store.query(door)] == list(range(256))
+        # less than MERGE_SEGMENTS segments per tier
+        assert len(store._segments) <= (MERGE_SEGMENTS - 1) * 5
+        # an event is rewritten once per tier it passes
+        assert _Store.rewritten <= 256 * 4
+        store.close()
@@ -5,3 +5,10 @@ class CouldNotConnect(RuntimeError):
 
 class InvalidData(RuntimeError):
     pass
+
+class QueueFull(RuntimeError):
+    pass
+
+class LockUnreachable(CouldNotConnect):
+    """ the circuit breaker of the lock is open, see health.py """
+    pass
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# A scripted lock behind a fake bluepy Peripheral.
+# It speaks the fragment and message protocol of the eq3 lock, so the complete
+# stack fsm.Device -> LowerLayer can run without a radio.
+#
+# The link is modeled in connection events of `latency` seconds:
+# a write with response costs two events (request, response), a write without response one.
+# The lock answers in the next free event. Each pdu is lost with the probability `loss`.
+
+import logging
+import random
+import threading
+import time
+from struct import unpack_from
+
+from encrypt import encrypt_message, decrypt_message, crypt_data
+from exceptions import InvalidData
+from gattstub import Notifications, Service
+from messages import AnswerWithSecurity, AnswerWithoutSecurity, CommandMessage, ConnectionInfoMessage, \
+    ConnectionRequestMessage, FragmentAck, PairingRequestMessage, StatusInfoMessage, StatusRequestMessage, \
+    UserInfoMessage, UserInfoRequestMessage, UserListInfoMessage, UserListRequestMessage, UserNameSetMessage, \
+    UserRemoveMessage, COMMAND_LOCK, COMMAND_OPEN, COMMAND_UNLOCK, LOCK_STATUS_LOCKED, LOCK_STATUS_OPENED, \
+    LOCK_STATUS_UNLOCKED, decode_fragment, encode_fragment, is_secure
+
+LOG = logging.getLogger("fakelock")
+
+SEND_HANDLE = 0x0411
+RECV_HANDLE = 0x0421
+
+class FakeLock(object):
+    """ the state of a lock. Can be shared between multiple connections """
+    def __init__(self, userkeys=None, cardkey=None, bootloader=0x10, application=0x17, names=None,
+                 write_without_response=True):
+        """ :param write_without_response False for a lock ignoring fragments written without response """
+        # userid -> userkey
+        self.userkeys = dict(userkeys or {})
+        # userid -> name
+        self.names = dict(names or {})
+        self.cardkey = cardkey
+        self.bootloader = bootloader
+        self.application = application
+        self.lock_status = LOCK_STATUS_LOCKED
+        self.battery_low = False
+        # does the lock accept write without response on the send characteristic
+        self.write_without_response = write_without_response
+        self._lock = threading.Lock()
+
+    def status_data(self):
+        return bytearray([
+            0x00,
+            0x80 if self.battery_low else 0x00,
+            self.lock_status,
+            0x00, 0x00, 0x00])
+
+    def command(self, command):
+        with self._lock:
+            if command == COMMAND_LOCK:
+                self.lock_status = LOCK_STATUS_LOCKED
+            elif command == COMMAND_UNLOCK:
+                self.lock_status = LOCK_STATUS_UNLOCKED
+            elif command == COMMAND_OPEN:
+                self.lock_status = LOCK_STATUS_OPENED
+            else:
+                return False
+            return True
+
+class FakePeripheral(object):
+    """ implements the part of bluepy.btle.Peripheral used by the LowerLayer """
+    def __init__(self, lock, latency=0.0075, loss=0.0, connect_time=0.0, seed=None):
+        self.lock = lock
+        self.latency = latency
+        self.loss = loss
+        self.connect_time = connect_time
+        self._random = random.Random(seed)
+        self._delegate = None
+        self._connected = False
+        self._notifications = Notifications()
+        # the link is busy until
+        self._busy_until = 0
+
+        # session state of the lock side
+        self._userid = None
+        self._local_nonce = None
+        self._lock_nonce = None
+        self._lock_counter = 1
+        self._remote_counter = 0
+        self._recv_fragments = []
+        self._send_fragments = []
+
+        # statistics
+        self.writes = 0
+        self.lost = 0
+
+    # bluepy api
+    def setDelegate(self, delegate):
+        self._delegate = delegate
+        return self
+
+    withDelegate = setDelegate
+
+    def connect(self, addr, addrType=None, iface=None, timeout=None):
+        if self.connect_time:
+            time.sleep(self.connect_time)
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def getServices(self):
+        return [Service(self, SEND_HANDLE, RECV_HANDLE)]
+
+    def getServiceByUUID(self, uuid):
+        return Service(self, SEND_HANDLE, RECV_HANDLE)
+
+    def waitForNotifications(self, timeout):
+        notification = self._notifications.wait(timeout)
+        if notification is None:
+            return False
+        if self._delegate:
+            self._delegate.handleNotification(*notification)
+        return True
+
+    def wake(self):
+        """ end waitForNotifications() early, the LowerLayer has something to send """
+        self._notifications.wake()
+
+    # the link
+    def _event(self, count=1):
+        """ occupy the link for count connection events. returns the time the last one ends """
+        now = time.monotonic()
+        start = max(now, self._busy_until)
+        self._busy_until = start + count * self.latency
+        return self._busy_until
+
+    def _lost(self):
+        if self.loss and self._random.random() < self.loss:
+            self.lost += 1
+            return True
+        return False
+
+    def _write(self, handle, data, with_response):
+        if not self._connected:
+            raise RuntimeError("Not connected")
+        if not with_response and not self.lock.write_without_response:
+            # the lock silently ignores the write
+            self._event(1)
+            return None
+
+        self.writes += 1
+        done = self._event(2 if with_response else 1)
+        if not self._lost():
+            self._on_pdu(bytearray(data))
+        if with_response:
+            time.sleep(max(0, done - time.monotonic()))
+        return None
+
+    def _notify(self, pdu):
+        if self._lost():
+            return
+        due = self._event(1)
+        self._notifications.push(due, RECV_HANDLE, pdu)
+
+    # the lock protocol
+    def _on_pdu(self, pdu):
+        # FragmentAck to a fragment of the lock. It's not fragment encoded.
+        if len(pdu) == 2 and pdu[0] == FragmentAck.msgtype:
+            if self._send_fragments:
+                self._notify(self._send_fragments.pop(0))
+            return
+
+        if self._recv_fragments and pdu == self._recv_fragments[-1]:
+            # a retransmission, the FragmentAck got lost
+            self._ack(pdu)
+            return
+
+        self._recv_fragments.append(pdu)
+        try:
+            messages, self._recv_fragments = decode_fragment(self._recv_fragments)
+        except RuntimeError:
+            self._recv_fragments = []
+            return
+
+        if not messages:
+            self._ack(pdu)
+            return
+
+        for message in messages:
+            answer = self._on_message(message)
+            if answer is not None:
+                self._send(answer)
+
+    def _ack(self, fragment):
+        ack = bytearray([0x80, FragmentAck.msgtype, fragment[0]])
+        ack.extend(b'\x00' * 13)
+        self._notify(ack)
+
+    def _send(self, message):
+        fragments = encode_fragment(message)
+        self._notify(fragments[0])
+        # the following fragments are sent when we receive the FragmentAck
+        self._send_fragments = fragments[1:]
+
+    def _encrypt(self, message):
+        pdu = encrypt_message(message, self._local_nonce, self._lock_counter, self.lock.userkeys[self._userid])
+        self._lock_counter += 1
+        return pdu
+
+    def _on_message(self, message):
+        msgtype = message[0]
+        if msgtype == ConnectionRequestMessage.msgtype:
+            self._userid, self._local_nonce = unpack_from('>BQ', message, 1)
+            self._lock_nonce = self._random.getrandbits(64)
+            return ConnectionInfoMessage(self._userid, self._lock_nonce,
+                                         self.lock.bootloader, self.lock.application).encode()
+
+        if msgtype == PairingRequestMessage.msgtype:
+            return self._on_pairing(message)
+
+        if not is_secure(msgtype):
+            return None
+
+        key = self.lock.userkeys.get(self._userid)
+        if key is None:
+            return AnswerWithoutSecurity(0x80).encode()
+
+        # an encrypted message fills its fragments completely, there is no fragment padding
+        try:
+            _msgtype, counter, decrypted = decrypt_message(message, self._lock_nonce, key)
+        except InvalidData:
+            return None
+        if counter <= self._remote_counter:
+            return None
+        self._remote_counter = counter
+
+        if msgtype == CommandMessage.msgtype:
+            success = self.lock.command(CommandMessage.decode(decrypted).command)
+            return self._encrypt(AnswerWithSecurity(0x81 if success else 0x80))
+        if msgtype == StatusRequestMessage.msgtype:
+            return self._encrypt(StatusInfoMessage(self.lock.status_data()))
+        if msgtype == UserListRequestMessage.msgtype:
+            return self._encrypt(UserListInfoMessage(list(self.lock.userkeys)))
+        if msgtype == UserInfoRequestMessage.msgtype:
+            userid = UserInfoRequestMessage.decode(decrypted).userid
+            return self._encrypt(UserInfoMessage(userid, self.lock.names.get(userid, '')))
+        if msgtype == UserNameSetMessage.msgtype:
+            request = UserNameSetMessage.decode(decrypted)
+            self.lock.names[request.userid] = request.name
+            return self._encrypt(AnswerWithSecurity(0x81))
+        if msgtype == UserRemoveMessage.msgtype:
+            userid = UserRemoveMessage.decode(decrypted).userid
+            self.lock.userkeys.pop(userid, None)
+            self.lock.names.pop(userid, None)
+            return self._encrypt(AnswerWithSecurity(0x81))
+        return self._encrypt(AnswerWithSecurity(0x80))
+
+    def _on_pairing(self, message):
+        if not self.lock.cardkey:
+            return AnswerWithoutSecurity(0x80).encode()
+        request = PairingRequestMessage.decode(message)
+        userkey = crypt_data(request.encrypted_pair_key[:16], PairingRequestMessage.msgtype,
+                             self._lock_nonce, request.security_counter, self.lock.cardkey)
+        self.lock.userkeys[request.userid] = bytearray(userkey)
+        return AnswerWithoutSecurity(0x81).encode()
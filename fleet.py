@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Status sweep over a fleet of locks.
+#
+# The fleet file contains one lock per line:
+# <mac> <userid> <userkey as hex>
+# Empty lines and lines starting with # are ignored.
+#
+# All locks are queried concurrently, at most concurrency at the same time.
+# Each result is reported as soon as it arrives.
+
+import binascii
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from messages import LOCK_STATUS_NAMES
+
+LOG = logging.getLogger("fleet")
+
+# how many locks are queried at the same time. A single adapter can not handle many connections.
+DEFAULT_CONCURRENCY = 4
+
+def percentile(values, percent):
+    """ nearest rank percentile of sorted values """
+    if not values:
+        return None
+    rank = max(1, math.ceil(percent / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+class Entry(object):
+    def __init__(self, mac, userid, userkey):
+        self.mac = mac
+        self.userid = userid
+        self.userkey = userkey
+
+def read_fleet(fp):
+    """ read the locks from a file object """
+    entries = []
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        fields = line.replace(',', ' ').split()
+        if len(fields) != 3:
+            raise RuntimeError("Line %d: expecting <mac> <userid> <userkey>" % lineno)
+        try:
+            entries.append(Entry(fields[0], int(fields[1]), fields[2]))
+        except ValueError as exp:
+            raise RuntimeError("Line %d: %s" % (lineno, exp))
+    return entries
+
+def status_one(entry, timeout, adapters=None):
+    """ query the status of a single lock and return the result """
+    from fsm import Device
+
+    result = {
+        'mac': entry.mac,
+        'userid': entry.userid,
+        'success': False,
+        'error': None,
+    }
+
+    start = time.monotonic()
+    device = None
+    try:
+        userkey = binascii.unhexlify(entry.userkey)
+        if len(userkey) != 16:
+            raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
+
+        device = Device(entry.mac, userid=entry.userid, userkey=userkey, adapters=adapters)
+        status = device.status(timeout=timeout)
+        if status is None:
+            result['error'] = "No status from the lock"
+        else:
+            result['success'] = True
+            result['status'] = status.data.hex()
+            result['lock_status'] = LOCK_STATUS_NAMES.get(status.lock_status, status.lock_status)
+            result['battery_low'] = status.battery_low
+            result['adapter'] = device.adapter
+    except Exception as exp:
+        LOG.exception("Status of %s failed", entry.mac)
+        result['error'] = str(exp)
+    finally:
+        if device and device.ll:
+            device.disconnect()
+
+    result['latency'] = round(time.monotonic() - start, 3)
+    return result
+
+def command_one(entry, command, timeout, adapters=None):
+    """ send a command (fsm.COMMAND_*) to a single lock and return the result """
+    from fsm import Device
+
+    result = {
+        'mac': entry.mac,
+        'userid': entry.userid,
+        'success': False,
+        'error': None,
+    }
+
+    start = time.monotonic()
+    device = None
+    try:
+        userkey = binascii.unhexlify(entry.userkey)
+        if len(userkey) != 16:
+            raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
+
+        device = Device(entry.mac, userid=entry.userid, userkey=userkey, adapters=adapters)
+        if device.command(command, timeout=timeout):
+            result['success'] = True
+            result['adapter'] = device.adapter
+        else:
+            result['error'] = "The lock did not accept the command"
+    except Exception as exp:
+        LOG.exception("Command to %s failed", entry.mac)
+        result['error'] = str(exp)
+    finally:
+        if device and device.ll:
+            device.disconnect()
+
+    result['latency'] = round(time.monotonic() - start, 3)
+    return result
+
+def sweep(entries, concurrency=DEFAULT_CONCURRENCY, timeout=10.0, on_result=None, adapters=None):
+    """ query the status of all entries, at most concurrency at the same time.
+        on_result is called with each result as soon as it arrives.
+        returns the list of results in the order of the entries """
+    results = [None] * len(entries)
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(status_one, entry, timeout, adapters): index for index, entry in enumerate(entries)}
+        for future in as_completed(futures):
+            result = future.result()
+            with lock:
+                results[futures[future]] = result
+            if on_result:
+                on_result(result)
+
+    return results
+
+def summarize(results):
+    """ latency and error summary of a sweep """
+    latencies = sorted(result['latency'] for result in results if result['success'])
+    errors = {}
+    for result in results:
+        if not result['success']:
+            errors[result['error']] = errors.get(result['error'], 0) + 1
+
+    return {
+        'locks': len(results),
+        'success': len(latencies),
+        'failed': len(results) - len(latencies),
+        'battery_low': [result['mac'] for result in results if result.get('battery_low')],
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'max': latencies[-1] if latencies else None,
+        },
+        'errors': errors,
+    }
+
+def test_read_fleet():
+    import io
+    entries = read_fleet(io.StringIO(
+        "# building A\n"
+        "\n"
+        "00:1a:22:33:44:55 3 00112233445566778899aabbccddeeff\n"
+        "00:1a:22:33:44:56,4,00112233445566778899aabbccddeeff\n"))
+    assert len(entries) == 2
+    assert entries[0].mac == '00:1a:22:33:44:55'
+    assert entries[1].userid == 4
+
+def test_summarize():
+    results = [
+        {'mac': 'a', 'success': True, 'error': None, 'latency': 1.0, 'battery_low': True},
+        {'mac': 'b', 'success': True, 'error': None, 'latency': 2.0, 'battery_low': False},
+        {'mac': 'c', 'success': False, 'error': "No status from the lock", 'latency': 10.0},
+    ]
+    summary = summarize(results)
+    assert summary['failed'] == 1
+    assert summary['battery_low'] == ['a']
+    assert summary['latency']['max'] == 2.0
+    assert summary['errors'] == {"No status from the lock": 1}
@@ -5,14 +5,27 @@
 
 import logging
 import threading
+import time
 from exceptions import *
 from messages import *
-from encrypt import encrypt_message
+from encrypt import encrypt_message, decrypt_answer, KeystreamCache
 import random
 from lowerlayer import LowerLayer
+from users import USER_CACHE
+from accounting import ACCOUNTING
+from stateboard import BOARD
+from eventstore import EVENTS
+from health import HEALTH
+from capabilities import CAPABILITIES
+from sendqueue import PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND
+from correlation import Correlator, Counter
+from deadline import as_deadline
+from timerwheel import WHEEL, WheelTimeout
+from timing import TIMING
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from bluepy.btle import Peripheral, BTLEException
 from transitions import Machine
-from transitions.extensions.states import add_state_features, Timeout
+from transitions.extensions.states import add_state_features
 
 from datetime import datetime
 
@@ -26,7 +39,13 @@ COMMAND_OPEN = 2
 
 LOG = logging.getLogger("fsm")
 
-@add_state_features(Timeout)
+# precompute keystreams of the common messages in the background
+PRECOMPUTE = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precompute")
+PRECOMPUTE_MESSAGES = [CommandMessage.msgtype, StatusRequestMessage.msgtype]
+# the padded body length of CommandMessage and StatusRequestMessage
+PRECOMPUTE_LENGTH = 8
+
+@add_state_features(WheelTimeout)
 class TimeoutMachine(Machine):
     pass
 
@@ -56,13 +75,40 @@ class Device(object):
             'source': 'authenticate',
             'dest': 'secured',
         },
+        {
+            'trigger': 'ev_disconnected',
+            'source': '*',
+            'dest': 'disconnected',
+        },
     ]
 
-    def __init__(self, mac, userid, userkey=None):
+    def __init__(self, mac, userid, userkey=None, user_cache=None, adapters=None, peripheral_factory=None,
+                 recorder=None, accounting=None, board=None, events=None, health=None, capabilities=None):
         # should it raise Exception on invalid data?
         self.ignore_invalid = False
         self.mac = mac
+        self.user_cache = user_cache or USER_CACHE
+        # the radio usage of the lock
+        self.accounting = accounting or ACCOUNTING
+        # the stateboard.StateBoard to publish the state of the lock
+        self.board = board or BOARD
+        # the eventstore.EventStore keeping status changes and commands
+        self.events = events or EVENTS
+        # the circuit breaker of the lock, see health.py
+        self.health = (health or HEALTH).lock(mac)
+        self.health.set_probe(self._probe)
+        # what the lock accepts (e.g. write without response), learned per lock
+        self.capabilities = capabilities or CAPABILITIES
         self.ll = None
+        # optional adapters.AdapterPool. Without the default adapter is used
+        self.adapters = adapters
+        self._adapter = None
+        # iface -> adapters which failed to connect in this attempt
+        self._failed_adapters = {}
+        # returns a new bluepy Peripheral for each connection. None for bluepy itself
+        self.peripheral_factory = peripheral_factory
+        # optional recorder.Recorder capturing the session
+        self.recorder = recorder
         self.machine = TimeoutMachine(self,
                                       states=Device.states,
                                       transitions=Device.transitions,
@@ -77,7 +123,7 @@ class Device(object):
         # The connection info
         self.connection_info = None
 
-        self.security_counter = 1
+        self._security_counter = Counter(1)
         self.remote_security_counter = 0
 
         self.userid = userid
@@ -85,51 +131,149 @@ class Device(object):
 
         self.ready = threading.Event()
         self.ready.clear()
-
-        # wait for a message
-        self.msg = threading.Event()
-        self.msg.clear()
-        self.msg_type = None
-        self.msg_pdu = None
-
-    def _on_error(self, message):
-        """ entrypoint when received an error from the lower layer """
+        self._connect_lock = threading.Lock()
+        # notified when the setup finished or failed
+        self._setup_cond = threading.Condition()
+        self._connect_error = None
+        # the connect attempt in progress (a failover to another adapter continues it)
+        # and the last attempt counted as failed at the circuit breaker
+        self._attempt = 0
+        self._attempt_failed = 0
+
+        # match answers to the requests
+        self.correlator = Correlator()
+
+        # precomputed keystreams for the next security counters, bound to the remote nonce
+        self.keystream_cache = None
+        self._precompute_pending = False
+        # when the ConnectionRequest was sent (--profile)
+        self._nonce_requested = None
+
+        # the hold timer of a prepared session and when it was prepared
+        self._hold = None
+        self._prepared = None
+        self._last_request = 0.0
+
+    @property
+    def security_counter(self):
+        """ the next security counter """
+        return self._security_counter.value
+
+    @property
+    def adapter(self):
+        """ the name of the adapter used by this session or None for the default adapter """
+        return self._adapter.name if self._adapter else None
+
+    def _on_error(self, message, attempt):
+        """ entrypoint when received an error from the lower layer
+
+            :param attempt the connect attempt of the lower layer """
         LOG.info("Receive error from lower layer %s", message)
+        if not isinstance(message, CouldNotConnect):
+            return
+        if attempt != self._attempt:
+            # the lower layer of an earlier attempt
+            return
+        if self._adapter and attempt != self._attempt_failed:
+            self._failover()
+        else:
+            # a late error of an attempt which timed out already doesn't try the next adapter
+            self._release_adapter()
+            self.ev_disconnected()
+            self._connect_failed(message)
+
+    def _connect_failed(self, error):
+        """ the connection can not be established, wake up the callers """
+        self._count_failed(self._attempt)
+        with self._setup_cond:
+            self._connect_error = error
+            self._setup_cond.notify_all()
+
+    def _count_failed(self, attempt):
+        """ count a failed connect attempt at the circuit breaker, each attempt once.
+            The timeout of an attempt and its late CouldNotConnect are the same failure """
+        with self._setup_cond:
+            if attempt == self._attempt_failed:
+                return
+            self._attempt_failed = attempt
+        self.health.failed()
+
+    def _failover(self):
+        """ the adapter failed to connect, try the next one """
+        failed = self._adapter
+        self._failed_adapters[failed.iface] = failed
+        self._release_adapter()
+        self.ev_disconnected()
+        if len(self._failed_adapters) >= len(self.adapters.adapters):
+            # the lock is unreachable, not the adapters. That's up to the circuit breaker
+            LOG.warning("All adapters failed to connect to %s", self.mac)
+            self._failed_adapters.clear()
+            self._connect_failed(CouldNotConnect("All adapters failed to connect to %s" % self.mac))
+            return
+        LOG.info("Adapter %s failed, trying another adapter", failed.name)
+        # continues the attempt
+        with self._connect_lock:
+            if self.state == 'disconnected':
+                self._connect_ll()
+
+    def _release_adapter(self):
+        if self._adapter:
+            self.adapters.release(self._adapter)
+            self._adapter = None
 
     def _on_receive(self, message):
         """ entrypoint when received a message from the lower layer """
         LOG.info("Receive message %s", message)
+        if isinstance(message, EncryptedMessage):
+            message = self.decrypt_message(message.data)
+            if not message:
+                return
+
         if isinstance(message, ConnectionInfoMessage):
             LOG.info("Receive ConnectionInfoMessage")
             self.remote_nonce = message.remote_session_nonce
             self.remote_nonce_byte = bytearray(pack('>Q', self.remote_nonce))
             self.connection_info = message
+            # a new nonce, drop all precomputed keystreams
+            self.keystream_cache = None
             if self.userid == 0xff:
                 LOG.info("Using new Userid %d" % message.userid)
                 self.userid = message.userid
             self.ev_nonce_received()
-        elif isinstance(message, AnswerWithSecurity):
+        elif self.correlator.resolve(message):
             pass
-        elif isinstance(message, AnswerWithoutSecurity):
-            pass
-        elif isinstance(message, self.msg_type):
-            self.msg_pdu = message
-            self.msg.set()
+        elif isinstance(message, (AnswerWithSecurity, AnswerWithoutSecurity)):
+            LOG.info("Receive unexpected answer %s", message)
         else:
             LOG.info("Unknown message %s", message)
 
-    def _connect(self):
-        if self.state != 'disconnected':
-            return
-
-        self.ll = LowerLayer(self.mac)
+    def _connect(self, deadline=None):
+        with self._connect_lock:
+            if self.state != 'disconnected':
+                return
+            self._attempt += 1
+            self._connect_ll(deadline)
+
+    def _connect_ll(self, deadline=None):
+        iface = None
+        if self.adapters:
+            self._adapter = self.adapters.acquire(self.mac, exclude=self._failed_adapters)
+            iface = self._adapter.iface
+
+        peripheral = self.peripheral_factory() if self.peripheral_factory else None
+        self.ll = LowerLayer(self.mac, iface=iface, peripheral=peripheral, capabilities=self.capabilities)
+        self.ll.set_recorder(self.recorder)
+        self.ll.set_usage(self.accounting.lock(self.mac))
         self.ll.set_on_receive(self._on_receive)
-        self.ll.set_on_error(self._on_error)
-        self.ll.connect()
+        attempt = self._attempt
+        self.ll.set_on_error(lambda message: self._on_error(message, attempt))
+        # before the connect, its error may come back at once
         self.ev_connected()
+        self.ll.connect(deadline)
 
     def on_enter_connected(self):
         # if userid given, go to the next state
+        self._nonce_requested = TIMING.start()
         self.ll.send(ConnectionRequestMessage(self.userid, self.nonce).encode())
 
     def on_enter_authenticate(self):
@@ -138,7 +282,24 @@ class Device(object):
 
     def on_enter_exchanged_nonce(self):
         LOG.info("Exchanged nonce reached")
-        self.ready.set()
+        TIMING.stop('nonce_exchange', self._nonce_requested)
+        if self._adapter:
+            self.adapters.succeeded(self._adapter)
+        # another adapter reached the lock, the failed ones are to blame
+        for adapter in self._failed_adapters.values():
+            self.adapters.failed(adapter)
+        self._failed_adapters.clear()
+        if self.userkey:
+            self.keystream_cache = KeystreamCache(self.userkey, self.remote_nonce)
+            self._schedule_precompute()
+        self.health.succeeded()
+        with self._setup_cond:
+            self.ready.set()
+            self._setup_cond.notify_all()
+
+    def on_enter_disconnected(self):
+        self.ready.clear()
+        self.correlator.cancel_all()
 
     def on_enter_secured(self):
         pass
@@ -149,45 +310,166 @@ class Device(object):
     def encrypt_message(self, message):
         """ :param message a Message object
         """
-        pdu = encrypt_message(message, self.remote_nonce, self.security_counter, self.userkey)
-        self.security_counter += 1
+        start = TIMING.start()
+        pdu = encrypt_message(message, self.remote_nonce, self._security_counter.next(), self.userkey,
+                              self.keystream_cache)
+        TIMING.stop('encrypt', start)
+        self._schedule_precompute()
         return pdu
 
-    def decrypt_message(self, data):
-        """ a message is [1 byte id][x byte cryptdata][2 byte counter][4 byte auth] """
-        # check message_security_counter
-        # check authenticate_value
-
-        if len(data) < 7:
-            raise InvalidData("Message to short")
-
-        message_id = data[0:1]
-        message_counter = unpack('>H', data[-6, -4])
-        message_auth = unpack_from('>Q', data[-4:])
-        if message_counter <= self.remote_security_counter:
-            log.info("Invalid message counter")
-            return False
+    def _schedule_precompute(self):
+        """ precompute the keystreams for the next security counters while the session is idle """
+        if self.keystream_cache is None or self._precompute_pending:
+            return
+        self._precompute_pending = True
+        PRECOMPUTE.submit(self._precompute, self.keystream_cache)
+
+    def _precompute(self, cache):
+        self._precompute_pending = False
+        cache.precompute(PRECOMPUTE_MESSAGES, PRECOMPUTE_LENGTH, self._security_counter.value)
 
+    def decrypt_message(self, data):
+        """ a message is [1 byte id][x byte cryptdata][2 byte counter][4 byte auth]
+            returns the decoded message or None """
+        start = TIMING.start()
+        try:
+            message_type, message_counter, pdu = decrypt_answer(data, self.nonce, self.userkey,
+                                                                self.remote_security_counter)
+        except InvalidData as exp:
+            LOG.info("Invalid message %s", exp)
+            return None
+        finally:
+            TIMING.stop('decrypt', start)
         self.remote_security_counter = message_counter
-        pdu = crypt_data(data[1:-6], message_id, self.local_nonce, self.remote_security_counter, self.userkey)
-        computed_authentication_value = compute_authentication_value(pdu, message_id, self.local_nonce, self.remote_security_counter, self.userkey)
-        if compute_authentication_value != message_auth:
-            log.info("Invalid message auth")
-            return False
 
-        return pdu
+        if not message_type in MESSAGES:
+            LOG.info("Can not find Message 0x%x", message_type)
+            return None
+
+        try:
+            return MESSAGES[message_type].decode(pdu)
+        except InvalidData as exp:
+            LOG.info("Can not decode message 0x%x: %s", message_type, exp)
+            return None
+
+    def _setup(self, timeout):
+        """ connect and exchange the nonce. returns False on timeout or when the connection failed.
+            Raise LockUnreachable when the circuit breaker of the lock is open
+
+            :param timeout seconds or the deadline.Deadline of the operation """
+        deadline = as_deadline(timeout)
+        if self.ready.is_set():
+            return True
+        self.health.check()
+
+        deadline.enter('connect')
+        with self._setup_cond:
+            self._connect_error = None
+        if self.state == 'disconnected':
+            self._connect(deadline)
+        attempt = self._attempt
+
+        error = self._wait_ready(deadline)
+        if self.ready.is_set():
+            deadline.done()
+            return True
+
+        LOG.warning("Failed to setup the connection: %s, %s", error or "timeout", deadline)
+        if error is None:
+            # connected, but the nonce exchange never finished
+            self._count_failed(attempt)
+        return False
+
+    def _wait_ready(self, deadline):
+        """ wait until the nonce is exchanged or the connect failed. returns the CouldNotConnect or None """
+        with self._setup_cond:
+            self._setup_cond.wait_for(lambda: self.ready.is_set() or self._connect_error is not None,
+                                      deadline.remaining())
+            return self._connect_error
+
+    def _probe(self):
+        """ the background probe of the circuit breaker """
+        if self.prepare(hold=1.0, wait=10.0):
+            return True
+        # counts a timeout, a failed connect is counted already
+        self._count_failed(self._attempt)
+        return False
+
+    def _submit(self, pdu, answer_types, timeout, priority):
+        """ enqueue a pdu (or a callable creating the pdu) and return a Future of the answer.
+            The request is registered at the correlator when it goes on air, so the
+            answers are matched in the order the lock received the requests.
+
+            :param timeout seconds or the deadline.Deadline of the operation """
+        deadline = as_deadline(timeout)
+        future = Future()
+
+        def _on_air():
+            _pdu = pdu() if callable(pdu) else pdu
+            self.correlator.sent(answer_types, future)
+            return _pdu
+
+        self._last_request = time.monotonic()
+        deadline.enter('queued')
+        future.handle = self.ll.send(_on_air, priority, deadline, deadline.remaining())
+        return future
+
+    def request(self, message, answer_types, timeout=10.0, priority=PRIORITY_NORMAL):
+        """ send an encrypted message. Can be called from multiple threads.
+            The message is encrypted when it goes on air, so the security counter
+            follows the order of sending, even when a message with a higher priority overtakes it.
+
+            :param answer_types a message class or a tuple of classes resolving the request
+            :param timeout seconds or the deadline.Deadline of the operation, shared by the connect and the request
+            returns a concurrent.futures.Future resolved with the answer.
+            Raise CouldNotConnect when the connection can not be established,
+            LockUnreachable (a CouldNotConnect) when the circuit breaker of the lock is open and
+            QueueFull when the lower layer is busy. """
+        deadline = as_deadline(timeout)
+        if not self._setup(deadline):
+            raise CouldNotConnect("Failed to setup the connection to %s" % self.mac)
+
+        return self._submit(lambda: self.encrypt_message(message), answer_types, deadline, priority)
+
+    def _result(self, future, timeout):
+        """ wait for the answer of a request. returns the answer or None """
+        deadline = as_deadline(timeout)
+        try:
+            answer = future.result(deadline.remaining())
+            deadline.done()
+            return answer
+        except FutureTimeout:
+            future.handle.cancel()
+            self.correlator.discard(future)
+        except Exception as exp:
+            LOG.info("Request failed %s", exp)
+        return None
+
+    def _request(self, message, answer_type, timeout, priority=PRIORITY_NORMAL):
+        """ send an encrypted message and wait for the answer of answer_type.
+            returns the answer or None on timeout """
+        deadline = as_deadline(timeout)
+        try:
+            future = self.request(message, answer_type, deadline, priority)
+        except LockUnreachable:
+            raise
+        except CouldNotConnect:
+            return None
+        return self._result(future, deadline)
 
     # interface
-    def pair(self, userkey, cardkey):
+    def pair(self, userkey, cardkey, timeout=10.0):
         """ :param user_key as bytearray (128 bit / 16 byte)
             :param card_Key the key from the card as bytearray (128 bit / 16 byte)
 
             a userid must be also given via the device class.
+            returns True when the lock accepted the pairing.
             """
         LOG.info("Starting to pair")
 
-        self._connect()
-        self.ready.wait()
+        deadline = as_deadline(timeout)
+        if not self._setup(deadline):
+            return False
         LOG.info("userkey: %s %s" % (userkey, str(type(userkey))))
         _userkey = bytearray(userkey)
         _cardkey = bytearray(cardkey)
@@ -196,101 +478,420 @@ class Device(object):
             self.userid,
             _userkey,
             self.remote_nonce,
-            self.security_counter,
+            self._security_counter.next(),
             _cardkey).encode()
-        self.ll.send(pdu)
-        return True
-
-    def wait_for(self, msg_type):
-        self.msg_type = msg_type
-        self.msg.clear()
+        answer = self._result(self._submit(pdu, AnswerWithoutSecurity, deadline, PRIORITY_INTERACTIVE), deadline)
+        if answer is None:
+            LOG.warning("Failed to get the PairingRequest answer, %s", deadline)
+            return False
 
-    def wait(self, timeout=None):
-        self.msg.wait(timeout)
+        return answer.success
 
-    def discover(self):
+    def discover(self, timeout=10.0):
         """ return bootloader and application info """
         if self.userid is None:
             raise RuntimeError("Missing user id!")
 
-        self._connect()
-        self.ready.wait()
+        if not self._setup(timeout):
+            raise CouldNotConnect("Failed to setup the connection to %s" % self.mac)
         self.disconnect()
         return {"bootloader": self.connection_info.bootloader,
                 "application": self.connection_info.application,}
 
-    def disconnect(self):
-        self.ll.disconnect()
+    def prepare(self, hold=10.0, wait=None):
+        """ connect and exchange the nonce ahead of an expected command (a button press,
+            a person approaching), so the command takes a single round trip.
+            The session is dropped after hold seconds unless a request was sent meanwhile.
+            Preparing again restarts the hold time.
 
-    def status(self, timeout=10.0):
-        """ returns the status of the lock or raise an exception """
-        self.require_autenticate = True
+            :param wait seconds to wait until the session is ready, None to return at once
+            returns True when the session is ready """
+        prepared = time.monotonic()
+        hold_timer, self._hold = self._hold, WHEEL.schedule(hold, self._drop_prepared, prepared)
+        self._prepared = prepared
+        if hold_timer is not None:
+            hold_timer.cancel()
 
         if self.state == 'disconnected':
+            with self._setup_cond:
+                self._connect_error = None
             self._connect()
+        if wait:
+            self._wait_ready(as_deadline(wait))
+        return self.ready.is_set()
+
+    def _drop_prepared(self, prepared):
+        """ the hold time of a prepared session is over. Runs on the timer wheel """
+        if self._prepared != prepared:
+            # prepared again
+            return
+        self._hold = None
+        self._prepared = None
+        if self._last_request >= prepared:
+            return
+        LOG.info("Dropping the unused prepared session to %s", self.mac)
+        self.disconnect()
 
-        if not self.ready.wait(timeout):
-            LOG.warning("Failed to setup the connection")
-            return False
+    def disconnect(self):
+        if not self.ll:
+            return
+        self.ll.disconnect()
+        self._release_adapter()
+        if self.state != 'disconnected':
+            self.ev_disconnected()
 
-        message = StatusRequestMessage(datetime.now())
-        pdu = self.encrypt_message(message)
+    def status(self, timeout=10.0, priority=PRIORITY_NORMAL):
+        """ returns the StatusInfoMessage of the lock or None.
+            Periodic polling should use PRIORITY_BACKGROUND.
+            Raise LockUnreachable when the circuit breaker of the lock is open
 
-        self.wait_for(StatusInfoMessage)
-        self.ll.send(pdu)
-        if not self.wait(timeout):
+            :param timeout seconds or a deadline.Deadline, which tells how far the request got """
+        message = StatusRequestMessage(datetime.now())
+        start = time.monotonic()
+        deadline = as_deadline(timeout)
+        info = self._request(message, StatusInfoMessage, deadline, priority)
+        if info is None:
+            LOG.warning("Failed to get the StatusInfoMessage, %s", deadline)
             self.disconnect()
-            return "failed to get the StatusInfoMessage"
-
-        info = self.decrypt(self.msg_pdu)
-        from pprint import pprint
-        pprint(info)
-
-        return "No Status Yet"
+            return None
+        now = time.time()
+        self.board.update(self.mac, lock_status=info.lock_status, battery_low=info.battery_low,
+                          last_seen=now, last_status=now, latency=time.monotonic() - start)
+        self.events.ingest(self.mac, info, timestamp=now)
+        return info
+
+    def command(self, command, timeout=10.0):
+        """ send a COMMAND_* to the lock. returns True when the lock accepted the command.
+            Raise LockUnreachable when the circuit breaker of the lock is open
+
+            :param timeout seconds or a deadline.Deadline, which tells how far the command got """
+        start = time.monotonic()
+        message = CommandMessage(command)
+        deadline = as_deadline(timeout)
+        answer = self._request(message, AnswerWithSecurity, deadline, PRIORITY_INTERACTIVE)
+        if answer is None:
+            LOG.warning("Failed to get the Command response, %s", deadline)
+            self.board.update(self.mac, last_command=command, last_command_ok=False, last_command_time=time.time())
+            self.disconnect()
+            return False
+        now = time.time()
+        self.board.update(self.mac, last_command=command, last_command_ok=answer.success, last_command_time=now,
+                          last_seen=now, latency=time.monotonic() - start)
+        self.events.ingest(self.mac, answer, self.userid, message, now)
+        return answer.success
 
     def open(self, timeout=10.0):
         """ open it! """
-        if self.state == 'disconnected':
-            self._connect()
-            self.ready.wait()
-
-        message = CommandMessage(COMMAND_OPEN)
-        pdu = self.encrypt_message(message)
-        self.ll.send(pdu)
-        if not self.wait(timeout):
-            self.disconnect()
-            return "failed to get the Command Open response"
-
-        return 'open'
+        return self.command(COMMAND_OPEN, timeout)
 
     def unlock(self, timeout=10.0):
-        if self.state == 'disconnected':
-            self._connect()
-            self.ready.wait()
-
-        message = CommandMessage(COMMAND_UNLOCK)
-        pdu = self.encrypt_message(message)
-        self.ll.send(pdu)
-        if not self.wait(timeout):
-            self.disconnect()
-            return "failed to get the Command Unlock response"
-
-        return 'unlock'
+        return self.command(COMMAND_UNLOCK, timeout)
 
     def lock(self, timeout=10.0):
-        if self.state == 'disconnected':
-            self._connect()
-            self.ready.wait()
-
-        message = CommandMessage(COMMAND_LOCK)
-        pdu = self.encrypt_message(message)
-        self.ll.send(pdu)
-        if not self.wait(timeout):
-            self.disconnect()
-            return "failed to get the Command Lock response"
+        return self.command(COMMAND_LOCK, timeout)
+
+    def _user_cache_version(self):
+        return (self.connection_info.bootloader,
+                self.connection_info.application,
+                self.user_cache.generation(self.mac))
+
+    def users(self, timeout=10.0, refresh=False):
+        """ returns all users of the lock as dict {userid: name} or None on failure.
+            The names are served from the user cache unless refresh is set, as long as the
+            user ids of the lock match the cached ones. A name changed by another tool is
+            only seen when the cache entry expires. """
+        deadline = as_deadline(timeout)
+        if not self._setup(deadline):
+            return None
+
+        cached = None if refresh else self.user_cache.get(self.mac, self._user_cache_version())
+        # a single fragment, the names need a UserInfoRequest per user
+        info = self._request(UserListRequestMessage(), UserListInfoMessage, deadline)
+        if info is None:
+            LOG.warning("Failed to get the UserListInfoMessage")
+            return None
+        if cached is not None and sorted(cached) == sorted(info.userids):
+            LOG.info("Using cached user table")
+            return cached
+
+        users = {}
+        for userid in info.userids:
+            user = self.user_info(userid, deadline)
+            if user is None:
+                return None
+            users[userid] = user.name
+
+        self.user_cache.put(self.mac, self._user_cache_version(), users)
+        return users
+
+    def user_info(self, userid, timeout=10.0):
+        """ returns the UserInfoMessage of a single user or None """
+        info = self._request(UserInfoRequestMessage(userid), UserInfoMessage, timeout)
+        if info is None:
+            LOG.warning("Failed to get the UserInfoMessage of %d", userid)
+        return info
+
+    def set_user_name(self, userid, name, timeout=10.0):
+        """ set the name of a user, the administrator sees this name when listing all users """
+        answer = self._request(UserNameSetMessage(userid, name), AnswerWithSecurity, timeout)
+        if answer is None or not answer.success:
+            return False
+        self.user_cache.set_name(self.mac, userid, name)
+        return True
 
-        return 'lock'
+    def remove_user(self, userid, timeout=10.0):
+        """ remove a user from the lock """
+        answer = self._request(UserRemoveMessage(userid), AnswerWithSecurity, timeout)
+        if answer is None or not answer.success:
+            return False
+        self.user_cache.remove(self.mac, userid)
+        return True
 
     def register(self):
         """ Register a new user to the evlock. It requires the QR code. """
         pass
+
+def test_prepare():
+    from fakelock import FakeLock, FakePeripheral
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+
+    device = Device('00:1a:22:00:00:01', 1, userkey, peripheral_factory=lambda: FakePeripheral(lock, latency=0.001))
+    assert device.prepare(hold=0.2, wait=2.0)
+    assert device.state == 'exchanged_nonce'
+    # the command doesn't wait for the connection
+    assert device.open(timeout=2.0)
+    time.sleep(0.4)
+    assert device.state == 'exchanged_nonce'
+    device.disconnect()
+
+    # unused sessions are dropped after the hold time
+    device = Device('00:1a:22:00:00:02', 1, userkey, peripheral_factory=lambda: FakePeripheral(lock, latency=0.001))
+    assert device.prepare(hold=0.2, wait=2.0)
+    time.sleep(0.4)
+    assert device.state == 'disconnected'
+
+def test_circuit_breaker():
+    from health import HealthTracker, OPEN
+
+    class _Unreachable(object):
+        def setDelegate(self, delegate):
+            pass
+
+        def connect(self, addr, iface=None, timeout=None):
+            raise RuntimeError("out of range")
+
+    health = HealthTracker(threshold=2, reset_timeout=60.0)
+    device = Device('00:1a:22:00:00:03', 1, bytearray(range(16)), peripheral_factory=_Unreachable, health=health)
+    start = time.monotonic()
+    # fails when the connect fails, not after the timeout
+    assert device.status(timeout=5.0) is None
+    assert device.status(timeout=5.0) is None
+    assert health.lock(device.mac).state == OPEN
+    try:
+        device.status(timeout=5.0)
+        assert False
+    except LockUnreachable:
+        pass
+    assert time.monotonic() - start < 2.0
+
+    # the probe returns when the connect fails, not after its wait
+    start = time.monotonic()
+    assert not device._probe()
+    assert time.monotonic() - start < 2.0
+
+def test_adapter_failover():
+    from adapters import AdapterPool
+    from fakelock import FakeLock, FakePeripheral
+    from health import HealthTracker
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+    # ifaces which can't reach the lock
+    dead = set()
+
+    class _Peripheral(FakePeripheral):
+        def connect(self, addr, addrType=None, iface=None, timeout=None):
+            if iface in dead:
+                raise RuntimeError("out of range")
+            return FakePeripheral.connect(self, addr, addrType, iface, timeout)
+
+    def _status(pool, mac):
+        device = Device(mac, 1, userkey, adapters=pool, health=HealthTracker(),
+                        peripheral_factory=lambda: _Peripheral(lock, latency=0.001))
+        status = device.status(timeout=2.0)
+        device.disconnect()
+        return status
+
+    # locks no adapter reaches don't make the adapters unresponsive
+    pool = AdapterPool([0, 1])
+    dead.update([0, 1])
+    for mac in ('00:1a:22:00:01:01', '00:1a:22:00:01:02', '00:1a:22:00:01:03'):
+        assert _status(pool, mac) is None
+    assert all(adapter['responsive'] for adapter in pool.stats())
+
+    # hci0 fails where hci1 reaches the locks
+    dead.discard(1)
+    for mac in ('00:1a:22:00:01:04', '00:1a:22:00:01:05'):
+        assert _status(pool, mac) is not None
+    assert [adapter['responsive'] for adapter in pool.stats()] == [False, True]
+
+def test_circuit_breaker_late_error():
+    from health import HealthTracker
+
+    class _LateFailure(object):
+        def setDelegate(self, delegate):
+            pass
+
+        def connect(self, addr, iface=None, timeout=None):
+            time.sleep(0.3)
+            raise RuntimeError("out of range")
+
+    health = HealthTracker(threshold=3, reset_timeout=60.0)
+    device = Device('00:1a:22:00:00:07', 1, bytearray(range(16)), peripheral_factory=_LateFailure, health=health)
+    assert device.status(timeout=0.1) is None
+    time.sleep(0.5)
+    # the timeout and the late CouldNotConnect are one failed attempt
+    assert health.lock(device.mac).failures == 1
+
+def test_deadline():
+    from deadline import Deadline
+    from fakelock import FakeLock, FakePeripheral
+    from health import HealthTracker
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+
+    # the connect takes longer than the budget
+    device = Device('00:1a:22:00:00:04', 1, userkey, health=HealthTracker(),
+                    peripheral_factory=lambda: FakePeripheral(lock, latency=0.001, connect_time=0.5))
+    deadline = Deadline(0.2)
+    start = time.monotonic()
+    assert device.status(deadline) is None
+    assert time.monotonic() - start < 0.3
+    report = deadline.report()
+    assert report['expired'] and report['pending'] == 'connect'
+
+    # one budget for the connect and the request
+    device = Device('00:1a:22:00:00:05', 1, userkey, health=HealthTracker(),
+                    peripheral_factory=lambda: FakePeripheral(lock, latency=0.001))
+    deadline = Deadline(2.0)
+    assert device.status(deadline) is not None
+    report = deadline.report()
+    assert report['pending'] is None and not report['expired']
+    phases = [entry['phase'] for entry in report['completed']]
+    assert phases[:3] == ['connect', 'services', 'nonce_exchange']
+    assert phases[-1] == 'answer_wait'
+    device.disconnect()
+
+def test_write_without_response():
+    from capabilities import Capabilities, WRITE_WITHOUT_RESPONSE
+    from fakelock import FakeLock, FakePeripheral
+    userkey = bytearray(range(16))
+
+    for accepted in (True, False):
+        lock = FakeLock({1: userkey}, write_without_response=accepted)
+        capabilities = Capabilities()
+        mac = '00:1a:22:00:00:06'
+        # a lock not accepting it is remembered after the second failed probe
+        for known in ((True, True, True) if accepted else (None, False, False)):
+            device = Device(mac, 1, userkey, capabilities=capabilities,
+                            peripheral_factory=lambda: FakePeripheral(lock, latency=0.001))
+            start = time.monotonic()
+            assert device.status(timeout=5.0) is not None
+            device.disconnect()
+            assert capabilities.get(mac, WRITE_WITHOUT_RESPONSE) is known
+        # the last session knows it, no fallback
+        assert time.monotonic() - start < 0.5
+
+def test_write_without_response_late():
+    import lowerlayer
+    from capabilities import Capabilities, WRITE_WITHOUT_RESPONSE
+    from fakelock import FakeLock, FakePeripheral
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+    capabilities = Capabilities()
+    mac = '00:1a:22:00:00:08'
+
+    # the reply comes after the probe timeout
+    probe_timeout, lowerlayer.PROBE_TIMEOUT = lowerlayer.PROBE_TIMEOUT, 0.1
+    try:
+        device = Device(mac, 1, userkey, capabilities=capabilities,
+                        peripheral_factory=lambda: FakePeripheral(lock, latency=0.15))
+        assert device.status(timeout=5.0) is not None
+        device.disconnect()
+    finally:
+        lowerlayer.PROBE_TIMEOUT = probe_timeout
+    # a single late reply is not stored
+    assert capabilities.get(mac, WRITE_WITHOUT_RESPONSE) is None
+
+def test_deadline_bluepy_130():
+    from deadline import Deadline
+    from fakelock import FakeLock, FakePeripheral
+    from health import HealthTracker
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+
+    class _Peripheral130(FakePeripheral):
+        # the signature of bluepy 1.3.0, without a timeout
+        def connect(self, addr, addrType=None, iface=None):
+            return FakePeripheral.connect(self, addr, addrType, iface)
+
+    device = Device('00:1a:22:00:00:07', 1, userkey, health=HealthTracker(),
+                    peripheral_factory=lambda: _Peripheral130(lock, latency=0.001))
+    assert device.status(Deadline(2.0)) is not None
+    device.disconnect()
+
+def test_lost_answer():
+    import lowerlayer
+    from fakelock import FakeLock, FakePeripheral
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey})
+
+    class _LossyPeripheral(FakePeripheral):
+        """ loses the answer to the first encrypted request """
+        sent = 0
+
+        def _send(self, message):
+            self.sent += 1
+            if self.sent == 2:
+                return
+            FakePeripheral._send(self, message)
+
+    peripheral = _LossyPeripheral(lock, latency=0.001)
+    state_timeout = lowerlayer.LowerLayer.state_timeout
+    lowerlayer.LowerLayer.state_timeout = lambda self, state, timeout: min(0.2, state_timeout(self, state, timeout))
+    try:
+        device = Device('00:1a:22:00:00:09', 1, userkey, peripheral_factory=lambda: peripheral)
+        # the retransmission would be dropped as a replay, the request is sent with a fresh security counter
+        assert device.status(timeout=2.0) is not None
+        assert device.status(timeout=2.0) is not None
+        device.disconnect()
+    finally:
+        lowerlayer.LowerLayer.state_timeout = state_timeout
+    assert peripheral.sent == 4
+
+def test_users_cache():
+    from fakelock import FakeLock, FakePeripheral
+    from users import UserCache
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey}, names={1: 'admin'})
+    requests = []
+
+    class _CountingPeripheral(FakePeripheral):
+        def _on_message(self, message):
+            requests.append(message[0])
+            return FakePeripheral._on_message(self, message)
+
+    device = Device('00:1a:22:00:00:0b', 1, userkey, user_cache=UserCache(max_age=None),
+                    peripheral_factory=lambda: _CountingPeripheral(lock, latency=0.001))
+    assert device.users(timeout=2.0) == {1: 'admin'}
+    assert requests.count(UserInfoRequestMessage.msgtype) == 1
+    # the user ids match, the names come from the cache
+    lock.names[1] = 'renamed elsewhere'
+    assert device.users(timeout=2.0) == {1: 'admin'}
+    assert requests.count(UserInfoRequestMessage.msgtype) == 1
+    # a user added by another tool
+    lock.userkeys[2] = userkey
+    lock.names[2] = 'guest'
+    assert device.users(timeout=2.0) == {1: 'renamed elsewhere', 2: 'guest'}
+    assert requests.count(UserInfoRequestMessage.msgtype) == 3
+    device.disconnect()
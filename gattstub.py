@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# The GATT objects of the lock service for peripherals without a radio.
+# The LowerLayer only looks up the send and the receive characteristic of the
+# lock service and writes to the send characteristic. The fake lock and the
+# replay of a recording implement the bluepy Peripheral on top of these.
+# Their notifications are due at a time, waiting for them is ended early by
+# wake(), like the LowerLayer wakes up bluepy through its self-pipe.
+
+import heapq
+import itertools
+import threading
+import time
+
+LOCK_SEND_CHAR = '3141dd40-15db-11e6-a24b-0002a5d5c51b'
+LOCK_RECV_CHAR = '359d4820-15db-11e6-82bd-0002a5d5c51b'
+
+class Characteristic(object):
+    """ a characteristic of the lock service. Writes go to peripheral._write(handle, data, with_response) """
+    def __init__(self, peripheral, handle):
+        self._peripheral = peripheral
+        self._handle = handle
+
+    def getHandle(self):
+        return self._handle
+
+    def write(self, data, withResponse=False):
+        return self._peripheral._write(self._handle, data, withResponse)
+
+class Service(object):
+    """ the lock service with its send and receive characteristic """
+    def __init__(self, peripheral, send_handle, recv_handle):
+        self._chars = {
+            LOCK_SEND_CHAR: [Characteristic(peripheral, send_handle)],
+            LOCK_RECV_CHAR: [Characteristic(peripheral, recv_handle)],
+        }
+
+    def getCharacteristics(self, uuid):
+        return self._chars[uuid]
+
+class Notifications(object):
+    """ the pending notifications of a peripheral, ordered by the time they are due """
+    def __init__(self):
+        self._cond = threading.Condition()
+        # (due, seq, handle, data)
+        self._pending = []
+        self._seq = itertools.count()
+        self._woken = False
+
+    def push(self, due, handle, data):
+        """ due time.monotonic() """
+        with self._cond:
+            heapq.heappush(self._pending, (due, next(self._seq), handle, bytes(data)))
+            self._cond.notify()
+
+    def wake(self):
+        """ end the current (or the next) wait() early """
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """ returns the next notification (handle, data) or None after timeout or when woken up """
+        end = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._pending and self._pending[0][0] <= now:
+                    _due, _seq, handle, data = heapq.heappop(self._pending)
+                    return handle, data
+                if self._woken:
+                    self._woken = False
+                    return None
+                wait = end - now
+                if self._pending:
+                    wait = min(wait, self._pending[0][0] - now)
+                if wait <= 0:
+                    return None
+                self._cond.wait(wait)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Per lock circuit breaker.
+#
+# A lock out of range costs every caller the full timeout and occupies the adapter.
+# After `threshold` connect or nonce exchange failures in a row the breaker opens:
+# the calls fail at once with LockUnreachable. After `reset_timeout` seconds a
+# single probe is let through (half open), in the background when the Device
+# registered a probe, else the next call. A success closes the breaker, a failure
+# opens it again for twice the time, up to `max_reset_timeout`.
+# The state is kept across restarts when a path is given.
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from exceptions import LockUnreachable
+from timerwheel import WHEEL
+
+LOG = logging.getLogger("health")
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 30.0
+DEFAULT_MAX_RESET_TIMEOUT = 600.0
+
+# runs the background probes, the timer wheel must not block
+PROBES = ThreadPoolExecutor(max_workers=2, thread_name_prefix="probe")
+
+class LockHealth(object):
+    """ the circuit breaker of one lock """
+    def __init__(self, mac, tracker=None, threshold=DEFAULT_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 max_reset_timeout=DEFAULT_MAX_RESET_TIMEOUT):
+        self.mac = mac
+        self.threshold = threshold
+        self.min_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._tracker = tracker
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        # failures in a row
+        self.failures = 0
+        # time.time() the breaker opened
+        self.opened = None
+        self.reset_timeout = reset_timeout
+        # callable() -> bool, connects to the lock in the background
+        self._probe = None
+        self._timer = None
+
+    def as_dict(self):
+        return {
+            'state': OPEN if self.state == HALF_OPEN else self.state,
+            'failures': self.failures,
+            'opened': self.opened,
+            'reset_timeout': self.reset_timeout,
+        }
+
+    def restore(self, entry):
+        self.state = entry.get('state', CLOSED)
+        self.failures = entry.get('failures', 0)
+        self.opened = entry.get('opened')
+        self.reset_timeout = entry.get('reset_timeout', self.min_reset_timeout)
+
+    def retry_in(self):
+        """ seconds until the next probe, 0 when closed """
+        if self.state == CLOSED:
+            return 0.0
+        return max(0.0, self.opened + self.reset_timeout - time.time())
+
+    def allow(self):
+        """ returns True when a call may try the lock. Lets a single probe through when the breaker is open """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN:
+                # the probe is running
+                return False
+            if time.time() < self.opened + self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            return True
+
+    def check(self):
+        """ raise LockUnreachable when the calls must fail fast """
+        if not self.allow():
+            raise LockUnreachable("%s is unreachable, next try in %.0f s" % (self.mac, self.retry_in()))
+
+    def succeeded(self):
+        with self._lock:
+            if self.state == CLOSED and not self.failures:
+                return
+            if self.state != CLOSED:
+                LOG.info("%s is reachable again", self.mac)
+            self.state = CLOSED
+            self.failures = 0
+            self.opened = None
+            self.reset_timeout = self.min_reset_timeout
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self._save()
+
+    def failed(self):
+        """ a connect or the nonce exchange failed """
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+                opened = True
+            else:
+                opened = self.state == CLOSED and self.failures >= self.threshold
+            if opened:
+                LOG.warning("%s is unreachable, failing fast for %.0f s", self.mac, self.reset_timeout)
+                self.state = OPEN
+                self.opened = time.time()
+        self._save()
+        if opened:
+            self._schedule_probe()
+
+    def set_probe(self, probe):
+        """ probe() connects to the lock and returns True on success """
+        self._probe = probe
+        if self.state == OPEN and self._timer is None:
+            self._schedule_probe()
+
+    def _schedule_probe(self):
+        if self._probe is None:
+            return
+        self._timer = WHEEL.schedule(self.retry_in(), PROBES.submit, self._run_probe)
+
+    def _run_probe(self):
+        self._timer = None
+        if not self.allow() or self.state == CLOSED:
+            return
+        LOG.info("Probing %s", self.mac)
+        try:
+            reachable = self._probe()
+        except Exception as exp:
+            LOG.info("Probe of %s failed: %s", self.mac, exp)
+            reachable = False
+        if reachable:
+            self.succeeded()
+        elif self.state == HALF_OPEN:
+            self.failed()
+
+    def _save(self):
+        if self._tracker:
+            self._tracker.save()
+
+class HealthTracker(object):
+    """ the LockHealth of all locks """
+    def __init__(self, path=None, **kwargs):
+        self._path = path
+        # passed to each LockHealth
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        # mac -> LockHealth
+        self._locks = {}
+        # mac -> stored state of locks not used yet
+        self._stored = {}
+        if path and os.path.exists(path):
+            self._stored = self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as exp:
+            LOG.warning("Can not load the lock health %s: %s", self._path, exp)
+            return {}
+
+    def set_path(self, path):
+        """ persist into path. The locks not used yet take the state stored in path """
+        with self._lock:
+            self._path = path
+            if os.path.exists(path):
+                self._stored = self._load()
+                for mac, entry in self._stored.items():
+                    if mac in self._locks:
+                        self._locks[mac].restore(entry)
+
+    def lock(self, mac):
+        """ returns the LockHealth of a lock """
+        with self._lock:
+            health = self._locks.get(mac)
+            if health is None:
+                health = self._locks[mac] = LockHealth(mac, self, **self._kwargs)
+                if mac in self._stored:
+                    health.restore(self._stored[mac])
+            return health
+
+    def states(self):
+        """ returns {mac: state} of all locks """
+        with self._lock:
+            locks = list(self._locks.values())
+            stored = dict(self._stored)
+        stored.update({health.mac: health.as_dict() for health in locks})
+        return stored
+
+    def save(self):
+        if not self._path:
+            return
+
+        states = self.states()
+        with self._lock:
+            try:
+                fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self._path) + '.',
+                                           dir=os.path.dirname(self._path) or '.')
+                try:
+                    with os.fdopen(fd, 'w') as fp:
+                        json.dump(states, fp, indent=2)
+                    os.replace(tmp, self._path)
+                except OSError:
+                    os.unlink(tmp)
+                    raise
+            except OSError as exp:
+                LOG.warning("Can not save the lock health %s: %s", self._path, exp)
+
+# the lock health shared by all devices of this process
+HEALTH = HealthTracker()
+
+def test_circuit_breaker():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'health.json')
+        tracker = HealthTracker(path, reset_timeout=0.1)
+        health = tracker.lock('mac')
+        probed = threading.Event()
+        results = [False, True]
+
+        def _probe():
+            probed.set()
+            return results.pop(0)
+
+        health.failed()
+        health.failed()
+        health.check()
+        health.failed()
+        assert health.state == OPEN
+        try:
+            health.check()
+            assert False
+        except LockUnreachable:
+            pass
+        # restored by another process
+        assert HealthTracker(path).lock('mac').state == OPEN
+
+        # the first probe fails, the breaker opens for twice the time
+        health.set_probe(_probe)
+        assert probed.wait(2.0)
+        time.sleep(0.05)
+        assert health.state == OPEN
+        assert health.reset_timeout == 0.2
+        probed.clear()
+        assert probed.wait(2.0)
+        time.sleep(0.05)
+        assert health.state == CLOSED
+        assert health.reset_timeout == 0.1
+        assert HealthTracker(path).lock('mac').state == CLOSED
+        # a path which can't be written is logged
+        HealthTracker(os.path.join(tmpdir, 'missing', 'health.json')).lock('mac').failed()
+        assert sorted(os.listdir(tmpdir)) == ['health.json']
+
+        # without a probe the next call after the reset timeout is the probe
+        other = HealthTracker(reset_timeout=0.05, threshold=1).lock('other')
+        other.failed()
+        assert not other.allow()
+        time.sleep(0.06)
+        assert other.allow()
+        assert not other.allow()
+        other.failed()
+        assert other.state == OPEN
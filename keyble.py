@@ -3,26 +3,76 @@
 # 2019 Alexander 'lynxis' Couzens <lynxis@fe80.eu>
 # GPLv3
 
+# first, to time the imports (--profile)
+from timing import TIMING
+
 import argparse
 import binascii
+import json
 import logging
-import re
 import sys
 import os
-import threading
-import time
 import traceback
 
 from bluepy.btle import Scanner, DefaultDelegate
 from fsm import Device
+from adapters import AdapterPool, find_adapters
+from provision import parse_qrdata, read_jobs, provision, DEFAULT_CONCURRENCY as PROVISION_CONCURRENCY
+from fleet import read_fleet, sweep, summarize, DEFAULT_CONCURRENCY
+from planner import Planner
+from recorder import Recorder
+from tracebuffer import TRACE
+from accounting import ACCOUNTING
+from timerwheel import WHEEL
+from stateboard import BOARD
+from eventstore import EVENTS
+from health import HEALTH
+from capabilities import CAPABILITIES
+from users import USER_CACHE, DEFAULT_PATH as DEFAULT_USER_CACHE
+from exceptions import LockUnreachable
+from deadline import Deadline
+
+TIMING.imported()
+
+def _exit(code):
+    """ exit without waiting for the lower layer threads """
+    EVENTS.flush()
+    ACCOUNTING.save()
+    TIMING.finish()
+    os._exit(code)
 
 # exit on any exception
 def global_exception_hook(ex_type, ex, trace):
+    if isinstance(ex, LockUnreachable):
+        print(str(ex), file=sys.stderr)
+        _exit(1)
     traceback.print_exception(ex_type, ex, trace)
-    os._exit(1)
+    TRACE.error(0)
+    _exit(1)
 
 sys.excepthook = global_exception_hook
 
+# adapters.AdapterPool when using multiple adapters (--adapters)
+ADAPTERS = None
+# recorder.Recorder when recording the sessions (--record)
+RECORDER = None
+# deadline.Deadline of the operation (--timeout)
+DEADLINE = None
+# the operations without a deadline are killed this long after the --timeout
+TIMEOUT_GRACE = 1.0
+
+def _timeout(default=10.0):
+    """ the budget of a device operation """
+    return DEADLINE or default
+
+def _failed(message):
+    """ report how far the operation got and exit 2 when the --timeout passed, else raise """
+    if DEADLINE is not None and DEADLINE.expired():
+        print("%s: %s" % (message, DEADLINE), file=sys.stderr)
+        TRACE.error(0)
+        _exit(2)
+    raise RuntimeError(message)
+
 def filter_keyble(devices):
     """ return only keyble locks """
     keyble = []
@@ -34,8 +84,11 @@ def filter_keyble(devices):
 
 def scan():
     """ scan via BLE for locks """
-    scanner = Scanner()
-    devices = scanner.scan(10.0)
+    if ADAPTERS:
+        devices = ADAPTERS.scan(10.0).values()
+    else:
+        scanner = Scanner()
+        devices = scanner.scan(10.0)
     return filter_keyble(devices)
 
 def ui_scan():
@@ -47,10 +100,13 @@ def ui_scan():
     print("Found keyble devices")
     for dev in devices:
         print("{}".format(dev.addr))
+    if ADAPTERS:
+        for stats in ADAPTERS.stats():
+            print("{adapter}: {locks}".format(**stats))
 
 def ui_discover(device, userid=1):
-    device = Device(device, userid=userid)
-    infos = device.discover()
+    device = Device(device, userid=userid, adapters=ADAPTERS, recorder=RECORDER)
+    infos = device.discover(_timeout())
     print(infos)
 
 def ui_pair(device, userid, userkey, cardkey):
@@ -64,46 +120,135 @@ def ui_pair(device, userid, userkey, cardkey):
     _cardkey = binascii.unhexlify(cardkey)
     if len(_cardkey) != 16:
         raise RuntimeError("Cardkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
-    device = Device(device, userid=userid)
-    device.pair(_userkey, _cardkey)
+    device = Device(device, userid=userid, adapters=ADAPTERS, recorder=RECORDER)
+    if not device.pair(_userkey, _cardkey, _timeout()):
+        _failed("The lock did not accept the pairing")
+    print("paired as user %d" % device.userid)
+
+def ui_provision(path, manifest, concurrency):
+    with open(path, 'r') as fp:
+        jobs = read_jobs(fp)
+
+    def _on_result(result):
+        state = "paired" if result['success'] else "FAILED"
+        print("%s %s %s %s" % (result['serial'], result['mac'], state, result['error'] or ""))
+
+    results = provision(jobs, concurrency=concurrency, manifest=manifest, on_result=_on_result, adapters=ADAPTERS)
+    failed = [result for result in results if not result['success']]
+    print("%d of %d locks paired" % (len(results) - len(failed), len(results)))
+    if failed:
+        _exit(1)
+
+def ui_sweep(path, concurrency):
+    """ print the status of each lock as json line, the summary to stderr """
+    if path == '-':
+        entries = read_fleet(sys.stdin)
+    else:
+        with open(path, 'r') as fp:
+            entries = read_fleet(fp)
+
+    def _on_result(result):
+        print(json.dumps(result), flush=True)
+
+    results = sweep(entries, concurrency=concurrency, on_result=_on_result, adapters=ADAPTERS)
+    summary = summarize(results)
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    if summary['failed']:
+        _exit(1)
+
+def ui_monitor(path, concurrency):
+    """ poll the status of all locks forever, print each result as json line """
+    with open(path, 'r') as fp:
+        entries = read_fleet(fp)
+
+    def _on_result(result):
+        print(json.dumps(result), flush=True)
+
+    Planner(entries, concurrency=concurrency, adapters=ADAPTERS, on_result=_on_result).run()
+
+def ui_usage(device=None):
+    """ print the radio usage of all locks or a single lock """
+    totals = ACCOUNTING.totals()
+    if device:
+        totals = {device: totals[device]} if device in totals else {}
+    print(json.dumps(totals, indent=2))
 
 def ui_command(device, userid, userkey, command):
     _userkey = binascii.unhexlify(userkey)
     if len(_userkey) != 16:
         raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
 
-    device = Device(device, userid=userid, userkey=_userkey)
+    device = Device(device, userid=userid, userkey=_userkey, adapters=ADAPTERS, recorder=RECORDER)
 
+    result = False
     if command == "open":
-        device.open()
+        result = device.open(_timeout())
     elif command == "unlock":
-        device.unlock()
+        result = device.unlock(_timeout())
     elif command == "lock":
-        device.lock()
+        result = device.lock(_timeout())
 
+    if not result:
+        if DEADLINE is not None and DEADLINE.expired():
+            _failed("device %s failed" % str(command))
+        print("device %s failed" % str(command), file=sys.stderr)
+        _exit(1)
     print("device %s" % str(command))
-    os._exit(0)
+    _exit(0)
 
 def ui_status(device, userid, userkey):
     _userkey = binascii.unhexlify(userkey)
     if len(_userkey) != 16:
         raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
 
-    device = Device(device, userid=userid, userkey=_userkey)
-    status = device.status()
+    device = Device(device, userid=userid, userkey=_userkey, adapters=ADAPTERS, recorder=RECORDER)
+    status = device.status(_timeout())
     if not status:
-        raise RuntimeError("Can not get the status")
-    print("device status = %s" % str(status))
+        _failed("Can not get the status")
+    print("device status = %s" % status.data.hex())
+
+def ui_users(device, userid, userkey, refresh=False):
+    _userkey = binascii.unhexlify(userkey)
+    if len(_userkey) != 16:
+        raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
+
+    device = Device(device, userid=userid, userkey=_userkey, adapters=ADAPTERS, recorder=RECORDER)
+    users = device.users(_timeout(), refresh=refresh)
+    if users is None:
+        _failed("Can not get the user list")
+    for _userid, name in sorted(users.items()):
+        print("%3d %s" % (_userid, name))
+
+def ui_set_user_name(device, userid, userkey, target, name):
+    _userkey = binascii.unhexlify(userkey)
+    if len(_userkey) != 16:
+        raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
+    if not name:
+        raise RuntimeError("You need to specify --user-name")
+
+    device = Device(device, userid=userid, userkey=_userkey, adapters=ADAPTERS, recorder=RECORDER)
+    if not device.set_user_name(target, name, _timeout()):
+        _failed("Can not set the user name")
+    print("user %d name = %s" % (target, name))
+
+def ui_remove_user(device, userid, userkey, target):
+    _userkey = binascii.unhexlify(userkey)
+    if len(_userkey) != 16:
+        raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
+
+    device = Device(device, userid=userid, userkey=_userkey, adapters=ADAPTERS, recorder=RECORDER)
+    if not device.remove_user(target, _timeout()):
+        _failed("Can not remove the user")
+    print("user %d removed" % target)
 
 def set_timeout(timeout):
     """ exit after timeout seconds """
 
     def _timeouter():
-        time.sleep(timeout)
         print("Operation timed out! Exit 2", file=sys.stderr)
-        os._exit(2)
-    thr = threading.Thread(target=_timeouter)
-    thr.start()
+        TRACE.error(0)
+        _exit(2)
+    WHEEL.schedule(timeout, _timeouter)
 
 def main():
     parser = argparse.ArgumentParser(description='keybtle')
@@ -119,8 +264,29 @@ def main():
     parser.add_argument('--register', dest='register', action='store_true', help='Register a new user. Require --qrdata, optional --user-name')
     parser.add_argument('--user-name', dest='username', help='The administrator will see this name when listing all users')
     parser.add_argument('--qrdata', dest='qrdata', help='The QR Code as data. This contains the mac,cardkey,serial.')
+    parser.add_argument('--provision', dest='provision', help='Pair all locks listed in the file. One "<qrdata> <userkey> [userid] [user name]" per line.')
+    parser.add_argument('--manifest', dest='manifest', help='Write the results of --provision as json into this file.')
+    parser.add_argument('--jobs', dest='jobs', help='How many locks are handled at the same time. Default: %d for --provision, %d for --sweep and --monitor.' % (PROVISION_CONCURRENCY, DEFAULT_CONCURRENCY), type=int)
+    parser.add_argument('--sweep', dest='sweep', help='Query the status of all locks listed in the file (- for stdin). One "<mac> <userid> <userkey>" per line. Prints one json line per lock.')
+    parser.add_argument('--monitor', dest='monitor', help='Poll the status of all locks listed in the file (like --sweep) forever. Busy locks are polled more often than idle ones.')
+    parser.add_argument('--users', dest='users', action='store_true', help='List all users. Require --user-id --user-key --device.')
+    parser.add_argument('--refresh', dest='refresh', action='store_true', help='Bypass the local user cache when listing all users.')
+    parser.add_argument('--user-cache', dest='user_cache', default=DEFAULT_USER_CACHE, help='Keep the user tables of the locks in this file. Default: %s' % DEFAULT_USER_CACHE)
+    parser.add_argument('--set-user-name', dest='set_user_name', help='Set the name of the given user id. Require --user-name --user-id --user-key --device.', type=int)
+    parser.add_argument('--remove-user', dest='remove_user', help='Remove the given user id. Require --user-id --user-key --device.', type=int)
+    parser.add_argument('--adapters', dest='adapters', help='Comma separated list of hci interfaces to use (e.g. 0,1) or "all". Default: the default adapter.')
+    parser.add_argument('--record', dest='record', help='Record all BLE traffic into this file. Replay it with recorder.py.')
+    parser.add_argument('--trace-dump', dest='trace_dump', help='Dump the protocol trace into this file on errors. Decode it with tracebuffer.py.')
+    parser.add_argument('--accounting', dest='accounting', help='Keep the radio usage per lock (connects, fragments, airtime) in this file.')
+    parser.add_argument('--usage', dest='usage', action='store_true', help='Show the radio usage of all locks or of --device. Require --accounting.')
+    parser.add_argument('--state-board', dest='state_board', help='Publish the state of the locks into this memory mapped file (e.g. /dev/shm/keyble). Read it with stateboard.py.')
+    parser.add_argument('--profile', dest='profile', nargs='?', const='-', help='Time the phases (connect, nonce exchange, fragment acks, ...) of this invocation. Prints a summary to stderr or writes a json report into the given file. Print the report with timing.py.')
+    parser.add_argument('--cprofile', dest='cprofile', action='store_true', help='Run cProfile on the BLE worker thread and add the slowest functions to the --profile report.')
+    parser.add_argument('--events', dest='events', help='Keep the status changes and commands of the locks in this directory. Query it with eventstore.py.')
+    parser.add_argument('--health', dest='health', help='Keep the circuit breaker state of the locks in this file. Calls to a lock which failed repeatedly fail at once.')
+    parser.add_argument('--capabilities', dest='capabilities', help='Keep what each lock accepts (write without response) in this file, so it is not tried again on every run.')
     parser.add_argument('--verbose', dest='verbose', action='store_true', help='Enable debug logging.')
-    parser.add_argument('--timeout', dest='timeout', help='Exit after x seconds even when the operation hasn\'t finished.', type=float)
+    parser.add_argument('--timeout', dest='timeout', help='The time budget of the operation in seconds (connect, nonce exchange and answer). Exits with 2 and shows how far the operation got when the budget is spent.', type=float)
 
     args = parser.parse_args()
     if args.verbose:
@@ -128,8 +294,39 @@ def main():
     else:
         logging.basicConfig(format="%(asctime)-15s %(levelname)-8s %(name)-22s %(message)s", level=logging.ERROR)
 
+    if args.profile or args.cprofile:
+        TIMING.enable(None if args.profile in (None, '-') else args.profile, args.cprofile)
+
+    global ADAPTERS
+    if args.adapters == 'all':
+        ADAPTERS = AdapterPool(find_adapters())
+    elif args.adapters:
+        ADAPTERS = AdapterPool([int(iface.strip().replace('hci', '')) for iface in args.adapters.split(',')])
+
+    if args.trace_dump:
+        TRACE.dump_on_error(args.trace_dump)
+    if args.accounting:
+        ACCOUNTING.set_path(args.accounting)
+    if args.state_board:
+        BOARD.open(args.state_board)
+    if args.events:
+        EVENTS.open(args.events)
+    if args.health:
+        HEALTH.set_path(args.health)
+    if args.capabilities:
+        CAPABILITIES.set_path(args.capabilities)
+    if args.user_cache:
+        USER_CACHE.set_path(args.user_cache)
+
+    global RECORDER
+    if args.record:
+        RECORDER = Recorder(args.record)
+
     if args.timeout:
-        set_timeout(args.timeout)
+        global DEADLINE
+        DEADLINE = Deadline(args.timeout)
+        # the operations without a deadline (scan, provision, sweep, ...)
+        set_timeout(args.timeout + TIMEOUT_GRACE)
     if args.scan:
         ui_scan()
     if args.status:
@@ -142,24 +339,29 @@ def main():
         ui_command(args.device, args.userid, args.userkey, "unlock")
     if args.discover:
         ui_discover(args.device)
+    if args.users:
+        ui_users(args.device, args.userid, args.userkey, args.refresh)
+    if args.set_user_name is not None:
+        ui_set_user_name(args.device, args.userid, args.userkey, args.set_user_name, args.username)
+    if args.remove_user is not None:
+        ui_remove_user(args.device, args.userid, args.userkey, args.remove_user)
     if args.register:
         if not args.qrdata:
             raise RuntimeError("You need to specify --qrdata")
 
-        # M001234556678K01234567890ABCDEF023456789ABCDEF0123456789
-        rex = re.compile(r'^M([0-9A-F]{12})K([0-9A-F]{32})([0-9A-Z]{10})$')
-        match = rex.match(args.qrdata)
-        if not match:
-            raise RuntimeError("Invalid QR Data")
-        smac, cardkey, serial = match.groups()
-        mac = ""
-        for i in range(len(smac) >> 1):
-            mac += smac[i*2]
-            mac += smac[i*2+1]
-            mac += ":"
-        mac = mac[0:-1]
-
+        mac, cardkey, serial = parse_qrdata(args.qrdata)
         ui_pair(mac, args.userid, args.userkey, cardkey)
+    if args.provision:
+        ui_provision(args.provision, args.manifest, args.jobs or PROVISION_CONCURRENCY)
+    if args.sweep:
+        ui_sweep(args.sweep, args.jobs or DEFAULT_CONCURRENCY)
+    if args.monitor:
+        ui_monitor(args.monitor, args.jobs or DEFAULT_CONCURRENCY)
+    if args.usage:
+        ui_usage(args.device)
+    EVENTS.flush()
+    ACCOUNTING.save()
+    TIMING.finish()
 
 if __name__ == '__main__':
     main()
@@ -6,16 +6,27 @@
 # Create a Thread as lower layer to communicate with the BLE
 # Communicate with Queues
 
+import inspect
 import logging
+import os
+import select
 import threading
 import time
 from queue import Queue
 from bluepy.btle import Peripheral
 from transitions import Machine
-from transitions.extensions.states import add_state_features, Timeout
+from transitions.extensions.states import add_state_features
 
+from capabilities import CAPABILITIES, WRITE_WITHOUT_RESPONSE
+from deadline import Deadline
+from dispatch import OrderedDispatcher
 from exceptions import *
 from messages import *
+from sendqueue import SendQueue, PRIORITY_NORMAL
+from timerwheel import WheelTimeout
+from timing import TIMING
+from tracebuffer import TRACE, DIR_RX, DIR_TX, EV_ACK, EV_CONNECT, EV_DISCONNECT, EV_FRAGMENT, EV_GIVE_UP, \
+    EV_INVALID, EV_MESSAGE, EV_RETRY
 
 LOG = logging.getLogger("lowerlayer")
 
@@ -36,18 +47,83 @@ LOCK_RECV_CHAR = '359d4820-15db-11e6-82bd-0002a5d5c51b'
 
 MSG_CONNECT = 0
 MSG_DISCONNECT = 1
-MSG_SEND = 2
-
-@add_state_features(Timeout)
+MSG_TIMEOUT = 2
+
+# retransmissions of a fragment before giving up
+SEND_RETRIES = 3
+# the lock acks a fragment in the next connection events. A lost fragment or FragmentAck
+# is retransmitted after ACK_TIMEOUT, so a lost answer can still be requested again in the deadline
+ACK_TIMEOUT = 1.0
+# how long to wait for the lock to react on a fragment written without response,
+# before falling back to write with response, while it's not known whether the lock accepts it
+PROBE_TIMEOUT = 1.0
+# failed probes in a row until the lock is remembered as not accepting write without response.
+# A single one might be a lost or late reply
+PROBE_CONFIRM = 2
+# a fragment written without response is waiting for the reaction of the lock
+PROBE_SENT = 'sent'
+# no reaction, the fragment was written again with response
+PROBE_FALLBACK = 'fallback'
+# the worker waits at most this long for a notification, a control message or a message to send.
+# They wake it up, it's only a safety net
+IDLE_TIMEOUT = 5.0
+
+@add_state_features(WheelTimeout)
 class TimeoutMachine(Machine):
     pass
 
+# peripheral class -> does its connect() take a timeout. bluepy 1.3.0 doesn't
+_CONNECT_TIMEOUT = {}
+
+def connect_takes_timeout(peripheral):
+    """ returns True when peripheral.connect() accepts a timeout keyword """
+    cls = type(peripheral)
+    if cls not in _CONNECT_TIMEOUT:
+        try:
+            parameters = inspect.signature(peripheral.connect).parameters
+        except (TypeError, ValueError):
+            parameters = {}
+        _CONNECT_TIMEOUT[cls] = 'timeout' in parameters or \
+            any(param.kind == param.VAR_KEYWORD for param in parameters.values())
+    return _CONNECT_TIMEOUT[cls]
+
+def notification_fd(peripheral):
+    """ returns the file descriptor bluepy reads the notifications from (the stdout of its helper) or None """
+    helper = getattr(peripheral, '_helper', None)
+    stdout = getattr(helper, 'stdout', None)
+    if stdout is None:
+        return None
+    return stdout.fileno()
+
+def acked_fragment(data):
+    """ returns the status byte of the fragment a FragmentAck of the lock confirms, None for any other pdu """
+    if len(data) > 2 and data[0] == 0x80 and data[1] == FragmentAck.msgtype:
+        return data[2]
+    return None
+
+class FragmentReceiver(object):
+    """ reassembles the messages of the lock from its fragments. Used by the LowerLayer and compact.SessionHost """
+    def __init__(self):
+        self.fragments = []
+
+    def receive(self, data):
+        """ add a fragment (not a FragmentAck).
+            returns (message, None) when the message is complete,
+            otherwise (None, the FragmentAck pdu to send) """
+        self.fragments.append(data)
+        messages, self.fragments = decode_fragment(self.fragments)
+        if not messages:
+            return None, FragmentAck(data[0]).encode()
+        if len(messages) > 1:
+            raise RuntimeError("To many messages received")
+        return messages[0], None
+
 class LowerLayer(object):
     states = [
         {'name': 'disconnected'}, # no state is present with the device
         {'name': 'connected', 'on_enter': 'on_enter_connected', 'timeout': 5.0, 'on_timeout': 'on_enter_connected'}, # connected on BLE level
         {'name': 'send', 'on_enter': 'on_enter_send'}, # send a pdu
-        {'name': 'wait_ack', 'on_enter': 'on_enter_wait_ack', 'timeout': 5.0, 'on_timeout': 'on_timeout_wait_ack'},
+        {'name': 'wait_ack', 'on_enter': 'on_enter_wait_ack', 'timeout': ACK_TIMEOUT, 'on_timeout': 'on_timeout_wait_ack'},
         {'name': 'wait_answer', 'on_enter': 'on_enter_wait_answer', 'timeout': 5.0, 'on_timeout': 'on_timeout_wait_answer'},
         {'name': 'error', 'on_enter': 'on_enter_error'}, # error state without any further operation
         {'name': 'disconnect'}, # error state without any further operation
@@ -89,6 +165,26 @@ class LowerLayer(object):
             'source': 'send',
             'dest': 'connected'
         },
+        {
+            'trigger': 'ev_retry', # re-enter the state to restart the timeout
+            'source': 'wait_ack',
+            'dest': 'wait_ack'
+        },
+        {
+            'trigger': 'ev_retry',
+            'source': 'wait_answer',
+            'dest': 'wait_answer'
+        },
+        {
+            'trigger': 'ev_resend', # send the request again with a fresh security counter
+            'source': 'wait_answer',
+            'dest': 'send'
+        },
+        {
+            'trigger': 'ev_give_up', # no answer after all retries
+            'source': 'wait_answer',
+            'dest': 'connected'
+        },
         {
             'trigger': 'ev_disconnect',
             'source': '*',
@@ -101,20 +197,31 @@ class LowerLayer(object):
         },
     ]
 
-    def __init__(self, mac):
+    def __init__(self, mac, iface=None, queue_size=8, peripheral=None, dispatcher=None, capabilities=None):
         self.state = None
         self.machine = TimeoutMachine(self,
                                       states=LowerLayer.states,
                                       transitions=LowerLayer.transitions,
                                       initial='disconnected')
 
-        self.timeout = 1
+        # the worker waits on the notifications of bluepy and on _wake_fds at the same time,
+        # a new message wakes it up. Peripherals without a bluepy helper (the fake lock, a replay)
+        # are woken up through their wake(). timeout is the shortest wait for the lock
+        self.timeout = 0.05
+        self._wake_fds = os.pipe()
+        os.set_blocking(self._wake_fds[1], False)
+        self._wake_lock = threading.Lock()
         # should it raise Exception on invalid data?
         self.ignore_invalid = False
 
         # ble
         self._mac = mac
-        self._ble_node = Peripheral()
+        # the hci interface number, None for the default adapter
+        self._iface = iface
+        # a bluepy Peripheral or something behaving like it (e.g. fakelock.FakePeripheral)
+        start = TIMING.start()
+        self._ble_node = peripheral or Peripheral()
+        TIMING.stop('peripheral', start)
         self._ble_node.setDelegate(self)
         # the ble service
         self._ble_service = None
@@ -122,21 +229,49 @@ class LowerLayer(object):
         self._ble_recv = None
         self._ble_send = None
 
-        self._recv_fragments = []
+        self._receiver = FragmentReceiver()
         self._recv_fragment_index = 0
         self._recv_fragment_try = 1
 
         self._send_fragments = []
         self._send_fragment_index = 0
         self._send_fragment_try = 1
-
-        self._send_messages = Queue()
+        # the SendHandle of the message currently sent
+        self._send_handle = None
+        # the SendHandle of the message waiting for its answer and how often it was sent
+        self._answer_handle = None
+        self._answer_try = 1
+        # when the fragment waiting for its FragmentAck and the last fragment were sent (--profile)
+        self._fragment_sent = None
+        self._last_fragment_sent = None
+        # the deadline.Deadline of the message currently sent or None
+        self._send_budget = None
+
+        # The fragments are written without response, the FragmentAcks and the answers of
+        # the lock confirm them. Saves the round trip of the ATT write response per fragment.
+        # True, False or None while not known whether the lock accepts it.
+        self._capabilities = capabilities or CAPABILITIES
+        self.write_without_response = self._capabilities.get(mac, WRITE_WITHOUT_RESPONSE)
+        # None, PROBE_SENT or PROBE_FALLBACK while finding out
+        self._probe = None
+
+        self._send_messages = SendQueue(queue_size)
         self._control = Queue()
 
         # The receive callback of the user
         self._recv_cb = None
         # The error callback of the user
         self._error_cb = None
+        # runs the user callbacks in order, off this thread
+        self._dispatcher = dispatcher or OrderedDispatcher()
+        # optional recorder.Recorder capturing all pdus
+        self._recorder = None
+        # the session id in the trace buffer
+        self._trace = TRACE.session(mac)
+        # optional accounting.LockUsage counting the radio usage
+        self._usage = None
+        self._connected_since = None
+        self._idle_since = None
 
         self._running = True
         self._thread = threading.Thread(target=self.work, name="lowerlayer")
@@ -145,94 +280,148 @@ class LowerLayer(object):
     def handleNotification(self, handle, data):
         """ called by the ble stack """
 
-        LOG.info("Received on %x data : %s", handle, data)
+        if self._recorder:
+            self._recorder.received(handle, data)
         if not self._ble_recv:
             return
         if handle != self._ble_recv.getHandle():
             return
         if not data:
             return
+        if self._usage:
+            self._usage.received(len(data))
+        TRACE.record(self._trace, EV_FRAGMENT, DIR_RX, data[1] if data[0] & 0x80 and len(data) > 1 else 0,
+                     data[0], self.state, len(data))
 
         # TODO: split between Fragment/FragmentAck. Are there more messages to receive here?
         try:
             fragment = Fragment.decode(data)
         except InvalidData:
+            TRACE.record(self._trace, EV_INVALID, DIR_RX, state=self.state, length=len(data))
             if self.ignore_invalid:
                 return
             raise
 
-        # FragmentAck?
-        # FIXME: hack
-        if fragment.status == 0x80 and fragment.payload[0] == 0x00:
-            if fragment.payload[1] != self._send_fragments[self._send_fragment_index][0]:
-                LOG.err("Received unknown FragmentAck")
+        acked = acked_fragment(data)
+        if acked is not None:
+            TRACE.record(self._trace, EV_ACK, DIR_RX, FragmentAck.msgtype, acked, self.state)
+            if acked != self._send_fragments[self._send_fragment_index][0]:
+                LOG.error("Received unknown FragmentAck")
                 return
-            else:
-                LOG.info("Received correct FragmentAck")
+            TIMING.stop('fragment_ack', self._fragment_sent)
+            self._fragment_sent = None
+            self._write_confirmed()
             self.ev_ack_received()
             return
 
-        self.ev_received()
+        if self.state == 'wait_answer':
+            TIMING.stop('answer_wait', self._last_fragment_sent)
+            self._last_fragment_sent = None
+            self._write_confirmed()
+            self.ev_received()
 
-        self._recv_fragments += [data]
-        message, self._recv_fragments = decode_fragment(self._recv_fragments)
+        message, ack = self._receiver.receive(data)
 
         # this is not the last fragment, send an ack
-        if not message:
-            LOG.debug("Sending FragmentAck")
-            self._send_pdu(FragmentAck(fragment.status).encode())
+        if ack is not None:
+            TRACE.record(self._trace, EV_ACK, DIR_TX, FragmentAck.msgtype, fragment.status, self.state)
+            self._send_pdu(ack)
             return
 
-        if len(message) > 1:
-            raise RuntimeError("To many messages received")
-
         # try to decode message
-        message = message[0]
-        raw = message
         message_type = message[0]
-        LOG.info("Received message type 0x%x", message_type)
+        TRACE.record(self._trace, EV_MESSAGE, DIR_RX, message_type, 0, self.state, len(message))
         try:
-            if not message_type in MESSAGES:
+            if is_secure(message_type):
+                # only the device knows the keys to decrypt it
+                message = EncryptedMessage.decode(message)
+            elif not message_type in MESSAGES:
                 self._error("Can not find Message")
                 return
-            message_cls = MESSAGES[message_type]
-            message = message_cls.decode(message)
-            LOG.info("Received decoded message %s <- %s", message, raw.hex())
+            else:
+                message_cls = MESSAGES[message_type]
+                message = message_cls.decode(message)
         except Exception as exp:
+            TRACE.record(self._trace, EV_INVALID, DIR_RX, message_type, state=self.state)
             LOG.info("Receive exception %s", exp)
             if self.ignore_invalid:
                 return
 
         if self._recv_cb:
-            self._recv_cb(message)
+            # keep this thread free for the next fragment and its ack
+            self._dispatcher.submit(self._recv_cb, message)
 
-    def _send_pdu(self, pdu):
+    def _send_pdu(self, pdu, retransmit=False):
         """ send a pdu (a byte array) """
         if not self._ble_send:
             raise RuntimeError("Can not send a message without a Connection")
 
-        return self._ble_send.write(pdu, True)
+        if self._usage:
+            self._usage.sent(len(pdu), retransmit)
+        if self._recorder:
+            self._recorder.sent(self._ble_send.getHandle(), pdu)
+        # retransmissions are written with response, the lock might not accept it without.
+        # While it's not known, only the probe is written without response
+        without_response = self.write_without_response or self._probe == PROBE_SENT
+        return self._ble_send.write(pdu, retransmit or not without_response)
+
+    def _write_confirmed(self):
+        """ the lock reacted on the fragment in flight """
+        if self._probe is None:
+            return
+        supported = self._probe == PROBE_SENT
+        self._probe = None
+        if supported:
+            self.write_without_response = True
+            self._capabilities.put(self._mac, WRITE_WITHOUT_RESPONSE, True)
+        elif self._capabilities.failed(self._mac, WRITE_WITHOUT_RESPONSE, PROBE_CONFIRM):
+            self.write_without_response = False
+        else:
+            # probe again with the next message
+            self.write_without_response = None
+
+    def _probe_failed(self):
+        """ no reaction on a fragment written without response. Try again with response """
+        if self._probe != PROBE_SENT:
+            return
+        LOG.info("%s doesn't react on write without response, falling back", self._mac)
+        self._probe = PROBE_FALLBACK
+        self.write_without_response = False
 
     def _error(self, error):
+        TRACE.error(self._trace, self.state)
         if self._error_cb:
-            self._error_cb(error)
+            self._dispatcher.submit(self._error_cb, error)
 
     def on_enter_connected(self):
+        # the state is re-entered on its timeout, keep counting the idle time
+        if self._idle_since is None:
+            self._idle_since = time.monotonic()
         # reset send fragments
         self._send_fragments = []
         self._send_fragment_index = 0
         self._send_fragment_try = 1
+        self._send_budget = None
+        self._answer_handle = None
+        self._answer_try = 1
 
 
     def on_enter_send(self):
         """ send the next fragment """
         # TODO: set timeout
+        self._count_idle()
         if not self._send_fragments:
-            LOG.debug("OnSend: No fragment, try generating fragments")
-            if not self._send_messages.empty():
-                self._send_fragments = encode_fragment(self._send_messages.get())
+            # skips cancelled and expired messages
+            handle = self._send_messages.get()
+            if handle:
+                self._send_handle = handle
+                self._answer_handle = handle
+                self._send_budget = handle.budget
+                self._progress('send')
+                pdu = handle.pdu()
+                self._send_fragments = encode_fragment(pdu)
                 self._send_fragment_index = -1
-                LOG.debug("OnSend: Encoded %d fragments", len(self._send_fragments))
+                TRACE.record(self._trace, EV_MESSAGE, DIR_TX, pdu[0], len(self._send_fragments), self.state, len(pdu))
             else:
                 # No message or fragment left
                 self.ev_nothing_to_send()
@@ -241,36 +430,100 @@ class LowerLayer(object):
         self._send_fragment_index += 1
         self._send_fragment_try = 0
 
-        LOG.debug("send_fragment %d %d", len(self._send_fragments), self._send_fragment_index)
+        fragment = self._send_fragments[self._send_fragment_index]
+        if self.write_without_response is None and self._probe is None and is_secure(self._send_fragments[0][1]):
+            # find out with this fragment. The lock drops the retransmission of an encrypted message
+            # when it received the probe, a second ConnectionRequest would change the nonce
+            self._probe = PROBE_SENT
+        TRACE.record(self._trace, EV_FRAGMENT, DIR_TX, self._send_fragments[0][1], fragment[0], self.state, len(fragment))
 
         if len(self._send_fragments) <= self._send_fragment_index + 1:
+            self._last_fragment_sent = TIMING.start()
+            self._progress('answer_wait')
             self._send_pdu(self._send_fragments[self._send_fragment_index])
+            if self._send_handle:
+                self._send_handle._finish()
+                self._send_handle = None
             # last message
             self.ev_finished()
         else:
             # when not the last message, we're expecting an FragmentAck
+            self._progress('fragment_ack')
             self.ev_send_fragment()
+            self._fragment_sent = TIMING.start()
             self._send_pdu(self._send_fragments[self._send_fragment_index])
 
     def on_timeout_wait_ack(self):
         # resend
-        if self._send_fragment_try <= 3:
-            self._send_pdu(self._send_fragments[self._send_fragment_index])
+        self._send_fragment_try += 1
+        self._probe_failed()
+        if self._send_fragment_try <= SEND_RETRIES:
+            TRACE.record(self._trace, EV_RETRY, DIR_TX, self._send_fragments[0][1], self._send_fragment_try, self.state)
+            self._send_pdu(self._send_fragments[self._send_fragment_index], retransmit=True)
+            self.ev_retry()
         else:
             self._error("Lock is not sending FragmentAcks!")
             self.ev_error()
 
     def on_timeout_wait_answer(self):
-        """ when waiting for an answer, we might even have to re-send the last fragment """
-        LOG.error("Timeout occured in wait answer, resending last fragment")
-        if self._send_fragment_try <= 3:
-            self._send_pdu(self._send_fragments[self._send_fragment_index])
+        """ when waiting for an answer, we might even have to re-send the last fragment.
+            The lock drops a retransmitted encrypted message as a replay, the request is encrypted again instead """
+        self._send_fragment_try += 1
+        if self._send_budget is not None and self._send_budget.expired():
+            # the caller doesn't wait anymore
+            LOG.info("Timeout occured in wait answer, the deadline of the message passed")
+            TRACE.record(self._trace, EV_GIVE_UP, DIR_TX, self._send_fragments[0][1], self._send_fragment_try, self.state)
+            self.ev_give_up()
+            return
+        LOG.error("Timeout occured in wait answer, resending")
+        self._probe_failed()
+        if is_secure(self._send_fragments[0][1]):
+            self._answer_try += 1
+            # only a message encrypted when it goes on air gets a fresh security counter
+            if self._answer_try <= SEND_RETRIES and callable(self._answer_handle.message):
+                TRACE.record(self._trace, EV_RETRY, DIR_TX, self._send_fragments[0][1], self._answer_try, self.state)
+                self._send_fragments = encode_fragment(self._answer_handle.pdu())
+                self._send_fragment_index = -1
+                self.ev_resend()
+                return
+            TRACE.record(self._trace, EV_GIVE_UP, DIR_TX, self._send_fragments[0][1], self._answer_try, self.state)
+            self.ev_give_up()
+        elif self._send_fragment_try <= SEND_RETRIES:
+            TRACE.record(self._trace, EV_RETRY, DIR_TX, self._send_fragments[0][1], self._send_fragment_try, self.state)
+            self._send_pdu(self._send_fragments[self._send_fragment_index], retransmit=True)
+            self.ev_retry()
+        else:
+            # the request is lost, the caller will time out. Continue with the next message.
+            TRACE.record(self._trace, EV_GIVE_UP, DIR_TX, self._send_fragments[0][1], self._send_fragment_try, self.state)
+            self.ev_give_up()
+
+    def state_timeout(self, state, timeout):
+        """ called by WheelTimeout when entering a state. Waiting for the answer ends with the deadline of the message.
+            A fragment written without response to a lock which might not accept it is retried sooner """
+        if state not in ('wait_ack', 'wait_answer'):
+            return timeout
+        if self._probe == PROBE_SENT:
+            timeout = min(timeout, PROBE_TIMEOUT)
+        if state == 'wait_answer' and self._send_budget is not None:
+            timeout = max(self.timeout, self._send_budget.remaining(timeout))
+        return timeout
+
+    def _progress(self, phase):
+        if self._send_budget is not None:
+            self._send_budget.enter(phase)
 
     def on_enter_wait_answer(self):
         self._recv_fragment_index = 0
         self._recv_fragment_try = 1
 
     def on_enter_disconnect(self):
+        TRACE.record(self._trace, EV_DISCONNECT, state=self.state)
+        self._count_idle()
+        if self._usage and self._connected_since is not None:
+            self._usage.disconnected(time.monotonic() - self._connected_since)
+            self._connected_since = None
+        if self._recorder:
+            self._recorder.disconnected()
         self._ble_node.disconnect()
         self._ble_service = None
         self._ble_send = None
@@ -281,55 +534,233 @@ class LowerLayer(object):
     def on_enter_wait_ack(self):
         pass
 
-    def _connect(self):
-        self._ble_node.connect(self._mac)
+    def on_enter_error(self):
+        LOG.error("Lower layer of %s failed", self._mac)
+
+    def _count_idle(self):
+        if self._idle_since is None:
+            return
+        if self._usage:
+            self._usage.idle(time.monotonic() - self._idle_since)
+        self._idle_since = None
+
+    def _connect(self, deadline=None):
+        """ :param deadline the deadline.Deadline of the operation connecting or None """
+        start = time.monotonic()
+        phase = TIMING.start()
+        if deadline is not None:
+            deadline.enter('connect')
+            if connect_takes_timeout(self._ble_node):
+                self._ble_node.connect(self._mac, iface=self._iface, timeout=max(self.timeout, deadline.remaining()))
+            else:
+                # the caller stops waiting at the deadline, Device._setup
+                self._ble_node.connect(self._mac, iface=self._iface)
+            deadline.enter('services')
+        else:
+            self._ble_node.connect(self._mac, iface=self._iface)
+        TIMING.stop('connect', phase)
+        phase = TIMING.start()
         self._ble_node.getServices()
         self._ble_service = self._ble_node.getServiceByUUID(LOCK_SERVICE)
         self._ble_send = self._ble_service.getCharacteristics(LOCK_SEND_CHAR)[0]
         self._ble_recv = self._ble_service.getCharacteristics(LOCK_RECV_CHAR)[0]
+        TIMING.stop('services', phase)
+        if deadline is not None:
+            # the device sends the ConnectionRequest next
+            deadline.enter('nonce_exchange')
+        self._connected_since = time.monotonic()
+        if self._usage:
+            self._usage.connected(self._connected_since - start)
+        if self._recorder:
+            self._recorder.connected(self._mac)
+        TRACE.record(self._trace, EV_CONNECT, state=self.state)
         self.ev_connected()
 
     def work(self):
         """ runs in a seperate thread """
+        TIMING.profile_thread()
         try:
             while self._running:
                 if not self._control.empty():
                     control, payload = self._control.get()
                     if control == MSG_CONNECT:
                         LOG.debug("Connecting to BLE")
-                        self._connect()
+                        try:
+                            self._connect(payload)
+                        except Exception as e:
+                            if self._usage:
+                                self._usage.connect_failed()
+                            self._error(CouldNotConnect("Can not connect to %s: %s" % (self._mac, e)))
+                            break
                     elif control == MSG_DISCONNECT:
                         LOG.debug("Disconnecting to BLE")
                         self.ev_disconnect()
+                        self._send_messages.clear()
                         break
-                    elif control == MSG_SEND:
-                        LOG.debug("Sending message to BLE")
-                        self._send_messages.put(payload)
-                        self.ev_enqueue_message()
-                if self.state != "disconnected":
-                    self._ble_node.waitForNotifications(self.timeout)
-                else:
-                    time.sleep(0.1)
+                    elif control == MSG_TIMEOUT:
+                        payload()
+                if self.state == "connected" and not self._send_messages.empty():
+                    self.ev_enqueue_message()
+                self._wait()
         except Exception as e:
             self._error("Exception occured %s" % e)
+        finally:
+            with self._wake_lock:
+                wake_fds, self._wake_fds = self._wake_fds, None
+            for fd in wake_fds:
+                os.close(fd)
+
+    def _wake(self):
+        """ wake up the worker, a control message or a message to send is pending """
+        with self._wake_lock:
+            if self._wake_fds is None:
+                # the worker is gone
+                return
+            try:
+                os.write(self._wake_fds[1], b'\0')
+            except BlockingIOError:
+                # woken up already
+                pass
+        wake = getattr(getattr(self, '_ble_node', None), 'wake', None)
+        if wake is not None:
+            wake()
+
+    def _wait(self):
+        """ wait for a notification, a control message or a message to send """
+        if not self._control.empty() or (self.state == "connected" and not self._send_messages.empty()):
+            return
+        fds = [self._wake_fds[0]]
+        if self.state != "disconnected":
+            fd = notification_fd(self._ble_node)
+            if fd is None:
+                # a peripheral without a radio, _wake() ends the wait through its wake()
+                self._ble_node.waitForNotifications(IDLE_TIMEOUT)
+                return
+            fds.append(fd)
+        readable, _, _ = select.select(fds, [], [], IDLE_TIMEOUT)
+        if self._wake_fds[0] in readable:
+            os.read(self._wake_fds[0], 4096)
+        if len(fds) > 1 and fds[1] in readable:
+            # returns at once, the notification is there
+            self._ble_node.waitForNotifications(self.timeout)
+
+    def timeout_dispatch(self, callback):
+        """ called by the timer wheel, the state timeouts run in the worker thread """
+        self._control.put((MSG_TIMEOUT, callback))
+        self._wake()
 
     # user api functions
     def disconnect(self):
         self._control.put((MSG_DISCONNECT, None))
-
-    def connect(self):
-        self._control.put((MSG_CONNECT, None))
-
-    def send(self, message):
-        """ send messages. "Big" (> 31byte) messages must be splitted into multiple fragments """
-        self._control.put((MSG_SEND, message))
+        self._wake()
+
+    def connect(self, deadline=None):
+        """ :param deadline the deadline.Deadline of the operation, limits the connect and records its progress """
+        self._control.put((MSG_CONNECT, deadline))
+        self._wake()
+
+    def send(self, message, priority=PRIORITY_NORMAL, deadline=None, timeout=None):
+        """ send messages. "Big" (> 31byte) messages must be splitted into multiple fragments
+
+            :param message a bytearray or a callable returning the bytearray when it's sent
+            :param priority one of the sendqueue.PRIORITY_*
+            :param deadline time.monotonic() after which the message is dropped instead of sent
+                   or a deadline.Deadline, which also ends the wait for the answer and records the progress
+            :param timeout how long to block when the send queue is full. Raise QueueFull afterwards.
+            returns a sendqueue.SendHandle to cancel the message """
+        budget = None
+        if isinstance(deadline, Deadline):
+            budget, deadline = deadline, deadline.expires
+        handle = self._send_messages.put(message, priority, deadline, timeout, budget)
+        self._wake()
+        return handle
 
     def set_on_receive(self, callback):
         """ sets the callback when a message has been received.
-        The callback must have the signature callback(message), while message is a list of byte of one message. """
+        The callback must have the signature callback(message), while message is a list of byte of one message.
+        The callbacks run in order on the dispatcher, not on the BLE thread. """
         self._recv_cb = callback
 
     def set_on_error(self, callback):
         """ sets the callback when a message has been received.
         The callback must have the signature callback(error). """
         self._error_cb = callback
+
+    def set_usage(self, usage):
+        """ count the radio usage into an accounting.LockUsage """
+        self._usage = usage
+
+    def set_recorder(self, recorder):
+        """ record all sent pdus and received notifications into a recorder.Recorder """
+        self._recorder = recorder
+
+def test_wake_up():
+    from types import SimpleNamespace
+    from fakelock import FakeLock, FakePeripheral
+
+    class _HelperPeripheral(FakePeripheral):
+        """ signals each notification on a pipe, like the stdout of the bluepy helper """
+        def __init__(self, lock):
+            FakePeripheral.__init__(self, lock, latency=0.001)
+            self._pipe = os.pipe()
+            self._helper = SimpleNamespace(stdout=os.fdopen(self._pipe[0], 'rb', buffering=0))
+            self.waits = 0
+
+        # bluepy has no wake(), the pipe wakes the worker
+        wake = None
+
+        def _notify(self, pdu):
+            FakePeripheral._notify(self, pdu)
+            os.write(self._pipe[1], b'\0')
+
+        def waitForNotifications(self, timeout):
+            self.waits += 1
+            os.read(self._pipe[0], 1)
+            return FakePeripheral.waitForNotifications(self, timeout)
+
+    peripheral = _HelperPeripheral(FakeLock())
+    ll = LowerLayer('00:1a:22:00:00:0a', peripheral=peripheral)
+    received = threading.Event()
+    ll.set_on_receive(lambda message: received.set())
+    ll.connect()
+    start = time.monotonic()
+    while ll.state != 'connected' and time.monotonic() - start < 2.0:
+        time.sleep(0.01)
+    # an idle session doesn't wake up
+    time.sleep(0.3)
+    assert peripheral.waits == 0
+
+    start = time.monotonic()
+    ll.send(ConnectionRequestMessage(1, 0x1122334455667788).encode())
+    assert received.wait(1.0)
+    assert time.monotonic() - start < 0.1
+    ll.disconnect()
+
+    # the fake lock has no helper, its wake() ends the wait instead of a slice of timeout
+    peripheral = FakePeripheral(FakeLock(), latency=0.001)
+    ll = LowerLayer('00:1a:22:00:00:0a', peripheral=peripheral)
+    received = threading.Event()
+    ll.set_on_receive(lambda message: received.set())
+    ll.connect()
+    start = time.monotonic()
+    while ll.state != 'connected' and time.monotonic() - start < 2.0:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    start = time.monotonic()
+    ll.send(ConnectionRequestMessage(1, 0x1122334455667788).encode())
+    assert received.wait(1.0)
+    assert time.monotonic() - start < ll.timeout
+    ll.disconnect()
+
+def test_fragment_receiver():
+    message = bytearray(range(40))
+    fragments = encode_fragment(message)
+    receiver = FragmentReceiver()
+    assert receiver.receive(fragments[0]) == (None, FragmentAck(fragments[0][0]).encode())
+    assert receiver.receive(fragments[1]) == (None, FragmentAck(fragments[1][0]).encode())
+    received, ack = receiver.receive(fragments[2])
+    assert ack is None
+    assert received[:len(message)] == message
+
+    assert acked_fragment(bytearray([0x80, FragmentAck.msgtype, fragments[0][0]])) == fragments[0][0]
+    assert acked_fragment(fragments[0]) is None
@@ -10,6 +10,7 @@ import logging
 from struct import pack, unpack_from, calcsize
 # local imports
 from encrypt import compute_authentication_value, encrypt_message, crypt_data
+from datetime import datetime
 
 MESSAGE_FRAGMENT_ACK = 0x01
 MESSAGE_ANSWER_WITHOUT_SECURITY = 0x01
@@ -22,8 +23,17 @@ MESSAGE_ANSWER_WITH_SECURITY = 0x81
 MESSAGE_STATUS_REQUEST = 0x82
 MESSAGE_STATUS_INFO = 0x83
 MESSAGE_COMMAND = 0x87
+MESSAGE_USER_LIST_REQUEST = 0x8b
+MESSAGE_USER_LIST_INFO = 0x8c
+MESSAGE_USER_REMOVE = 0x8d
+MESSAGE_USER_INFO_REQUEST = 0x8e
 MESSAGE_USER_INFO = 0x8f
 MESSAGE_USER_NAME_SET = 0x90
+MESSAGE_USER_OPTIONS_SET = 0x91
+
+# the lock has 256 user slots, a name is up to 20 byte utf-8
+USER_SLOTS = 256
+USER_NAME_LENGTH = 20
 
 COMMAND_LOCK = 0
 COMMAND_UNLOCK = 1
@@ -59,12 +69,9 @@ def encode_fragment(message):
         end = (i + 1) * 15
         pdu.extend(message[start:end])
 
-        LOG.debug("Before pad len pdu %d", len(pdu))
-
         # padding
         if len(pdu) < 16:
             pdu.extend((16 - (len(pdu) % 16)) * b'\x00')
-        LOG.debug("After pad len pdu %d", len(pdu))
 
         fragments += [pdu]
     return fragments
@@ -182,8 +189,13 @@ class AnswerWithoutSecurity(Send, Recv):
             raise InvalidData("answer does not fit into a byte")
         self.answer = answer
 
+    @property
+    def success(self):
+        """ 0x81 is success, 0x80 failed """
+        return bool(self.answer & 0x01)
+
     def encode(self):
-        return pack('>BB', FragmentAck.msgtype, self.answer)
+        return pack('>BB', AnswerWithoutSecurity.msgtype, self.answer)
 
     @classmethod
     def decode(cls, data):
@@ -198,16 +210,21 @@ class AnswerWithSecurity(Send, Recv):
     msgtype = 0x81
     def __init__(self, answer):
         # uint8
-        if answer:
+        if answer > 255:
             raise InvalidData("answer does not fit into a byte")
         self.answer = answer
 
+    @property
+    def success(self):
+        """ 0x81 is success, 0x80 failed """
+        return bool(self.answer & 0x01)
+
     def encode(self):
-        return pack('>BB', FragmentAck.msgtype, self.answer)
+        return pack('>BB', AnswerWithSecurity.msgtype, self.answer)
 
     @classmethod
     def decode(cls, data):
-        if data[0] != AnswerWithoutSecurity.msgtype:
+        if data[0] != AnswerWithSecurity.msgtype:
             raise InvalidData("Wrong msgtype")
 
         _msgtype, answer = unpack_from('>BB', data)
@@ -266,7 +283,7 @@ class ConnectionRequestMessage(Send, Recv):
         if data[0] != cls.msgtype:
             raise InvalidData("Wrong msgtype")
 
-        _msgtype, userid, nonce = unpack_from('>BBQBB', data)
+        _msgtype, userid, nonce = unpack_from('>BBQ', data)
         return cls(userid, nonce)
 
 class StatusRequestMessage(Send, Recv):
@@ -284,8 +301,6 @@ class StatusRequestMessage(Send, Recv):
         # -> hour
         # -> minutes
         # -> seconds
-        print(self.date)
-        print(type(self.date))
         return pack(
             StatusRequestMessage.packformat,
             StatusRequestMessage.msgtype,
@@ -309,6 +324,19 @@ class StatusRequestMessage(Send, Recv):
 
         return cls(date)
 
+# StatusInfoMessage lock status (data[2] & 0x07)
+LOCK_STATUS_MOVING = 1
+LOCK_STATUS_UNLOCKED = 2
+LOCK_STATUS_LOCKED = 3
+LOCK_STATUS_OPENED = 4
+
+LOCK_STATUS_NAMES = {
+    LOCK_STATUS_MOVING: 'moving',
+    LOCK_STATUS_UNLOCKED: 'unlocked',
+    LOCK_STATUS_LOCKED: 'locked',
+    LOCK_STATUS_OPENED: 'opened',
+}
+
 class StatusInfoMessage(Send):
     """ messages sent to the Smart Lock, informing the current date/time, and requesting status information
         date => datetime.datetime object
@@ -339,6 +367,15 @@ class StatusInfoMessage(Send):
 
         return cls(data[1:7])
 
+    @property
+    def lock_status(self):
+        """ one of LOCK_STATUS_* """
+        return self.data[2] & 0x07
+
+    @property
+    def battery_low(self):
+        return bool(self.data[1] & 0x80)
+
 class StatusChangedMessage(Send):
     msgtype = 0x05
     def __init__(self, userid, nonce):
@@ -438,6 +475,163 @@ class CommandMessage(Send):
         _msgtype, command = unpack_from('>BB', data)
         return cls(command)
 
+class EncryptedMessage(Recv):
+    """ a message with security (msgtype & 0x80) as received from the lock.
+        The lower layer does not know the session keys, the device must decrypt it.
+        [1 byte id][x byte cryptdata][2 byte counter][4 byte auth]
+    """
+    def __init__(self, msgtype, data):
+        self.msgtype = msgtype
+        self.data = data
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 7:
+            raise InvalidData("Input to short")
+
+        return cls(data[0], bytearray(data))
+
+def is_secure(msgtype):
+    """ messages >= 0x80 are encrypted and authenticated """
+    return bool(msgtype & 0x80)
+
+def _encode_name(name):
+    """ encode a user name into the fixed 20 byte field """
+    if isinstance(name, str):
+        name = name.encode('utf-8')
+    if len(name) > USER_NAME_LENGTH:
+        raise InvalidData("User name longer than %d byte" % USER_NAME_LENGTH)
+    return bytes(name) + b'\x00' * (USER_NAME_LENGTH - len(name))
+
+def _decode_name(data):
+    return bytes(data).split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+
+class UserListRequestMessage(Send, Recv):
+    """ request the list of occupied user slots """
+    msgtype = 0x8b
+    def __init__(self):
+        pass
+
+    def encode(self):
+        return pack('>B', UserListRequestMessage.msgtype)
+
+    @classmethod
+    def decode(cls, data):
+        if data[0] != cls.msgtype:
+            raise InvalidData("Wrong msgtype")
+
+        return cls()
+
+class UserListInfoMessage(Send, Recv):
+    """ the answer to the UserListRequestMessage.
+        A bitmap with one bit per user slot, a set bit is an occupied slot. (32 byte)
+    """
+    msgtype = 0x8c
+    bitmap_length = USER_SLOTS // 8
+
+    def __init__(self, userids):
+        self.userids = sorted(userids)
+
+    def encode(self):
+        bitmap = bytearray(UserListInfoMessage.bitmap_length)
+        for userid in self.userids:
+            bitmap[userid >> 3] |= 1 << (userid & 0x7)
+        return pack('>B', UserListInfoMessage.msgtype) + bitmap
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 1 + cls.bitmap_length:
+            raise InvalidData("Input to short")
+
+        if data[0] != cls.msgtype:
+            raise InvalidData("Wrong msgtype")
+
+        bitmap = data[1:1 + cls.bitmap_length]
+        userids = [i for i in range(USER_SLOTS) if bitmap[i >> 3] & (1 << (i & 0x7))]
+        return cls(userids)
+
+class UserRemoveMessage(Send, Recv):
+    msgtype = 0x8d
+    def __init__(self, userid):
+        # uint8
+        self.userid = userid
+
+    def encode(self):
+        return pack('>BB', UserRemoveMessage.msgtype, self.userid)
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 2:
+            raise InvalidData("Input to short")
+
+        if data[0] != cls.msgtype:
+            raise InvalidData("Wrong msgtype")
+
+        _msgtype, userid = unpack_from('>BB', data)
+        return cls(userid)
+
+class UserInfoRequestMessage(Send, Recv):
+    msgtype = 0x8e
+    def __init__(self, userid):
+        # uint8
+        self.userid = userid
+
+    def encode(self):
+        return pack('>BB', UserInfoRequestMessage.msgtype, self.userid)
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 2:
+            raise InvalidData("Input to short")
+
+        if data[0] != cls.msgtype:
+            raise InvalidData("Wrong msgtype")
+
+        _msgtype, userid = unpack_from('>BB', data)
+        return cls(userid)
+
+class UserInfoMessage(Send, Recv):
+    """ [1 byte id][1 byte userid][20 byte name] """
+    msgtype = 0x8f
+    def __init__(self, userid, name):
+        self.userid = userid
+        self.name = name
+
+    def encode(self):
+        return pack('>BB', UserInfoMessage.msgtype, self.userid) + _encode_name(self.name)
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 2 + USER_NAME_LENGTH:
+            raise InvalidData("Input to short")
+
+        if data[0] != cls.msgtype:
+            raise InvalidData("Wrong msgtype")
+
+        _msgtype, userid = unpack_from('>BB', data)
+        return cls(userid, _decode_name(data[2:2 + USER_NAME_LENGTH]))
+
+class UserNameSetMessage(Send, Recv):
+    """ [1 byte id][1 byte userid][20 byte name] """
+    msgtype = 0x90
+    def __init__(self, userid, name):
+        self.userid = userid
+        self.name = name
+
+    def encode(self):
+        return pack('>BB', UserNameSetMessage.msgtype, self.userid) + _encode_name(self.name)
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 2 + USER_NAME_LENGTH:
+            raise InvalidData("Input to short")
+
+        if data[0] != cls.msgtype:
+            raise InvalidData("Wrong msgtype")
+
+        _msgtype, userid = unpack_from('>BB', data)
+        return cls(userid, _decode_name(data[2:2 + USER_NAME_LENGTH]))
+
 MESSAGES = {
         0x00: FragmentAck,
         0x01: AnswerWithoutSecurity,
@@ -449,8 +643,27 @@ MESSAGES = {
         0x82: StatusRequestMessage,
         0x83: StatusInfoMessage,
         0x87: CommandMessage,
+        0x8b: UserListRequestMessage,
+        0x8c: UserListInfoMessage,
+        0x8d: UserRemoveMessage,
+        0x8e: UserInfoRequestMessage,
+        0x8f: UserInfoMessage,
+        0x90: UserNameSetMessage,
 }
 
+def test_user_list_info():
+    info = UserListInfoMessage([0, 1, 9, 255])
+    encoded = info.encode()
+    assert len(encoded) == 33
+    assert UserListInfoMessage.decode(encoded).userids == [0, 1, 9, 255]
+
+def test_user_name_set():
+    encoded = UserNameSetMessage(3, 'Front desk').encode()
+    assert len(encoded) == 22
+    decoded = UserNameSetMessage.decode(encoded)
+    assert decoded.userid == 3
+    assert decoded.name == 'Front desk'
+
 def test_pairing_request():
     from pprint import pprint
     request = PairingRequestMessage.create(
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Adaptive status polling of a fleet of locks.
+#
+# Polling every lock on a fixed interval wastes airtime and battery on idle doors
+# and notices changes of busy doors late. The planner learns how often the state of
+# each lock changes and polls it so that a change is missed with at most the
+# probability `miss`: interval = -ln(1 - miss) / rate, bounded by min_interval and
+# max_interval. The rate is estimated from the polls where the lock_status differed
+# from the previous poll, older observations decay with `half_life`.
+#
+# Polls are spread on a grid of `spacing` seconds, a slot holds as many polls as
+# there are adapters, so polls don't collide on the adapter. Unreachable locks are
+# polled with exponential backoff. Each interval gets a random jitter.
+
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fleet import DEFAULT_CONCURRENCY, status_one
+
+LOG = logging.getLogger("planner")
+
+# the probability to miss a change between two polls
+DEFAULT_MISS = 0.1
+DEFAULT_MIN_INTERVAL = 30.0
+DEFAULT_MAX_INTERVAL = 3600.0
+# seconds between two polls on one adapter, about the time of a status request
+DEFAULT_SPACING = 2.0
+DEFAULT_JITTER = 0.1
+# the first retry of an unreachable lock, doubled on each failure
+DEFAULT_BACKOFF = 60.0
+DEFAULT_MAX_BACKOFF = 3600.0
+# observations older than this count half
+DEFAULT_HALF_LIFE = 86400.0
+# a new lock is assumed to change once in PRIOR_TIME seconds
+PRIOR_CHANGES = 1.0
+PRIOR_TIME = 600.0
+
+class LockPlan(object):
+    """ what the planner knows about one lock """
+    def __init__(self, entry):
+        self.entry = entry
+        self.mac = entry.mac
+        # the lock_status of the last successful poll
+        self.state = None
+        self.last_poll = None
+        # decayed number of changes seen and seconds observed
+        self.changes = 0.0
+        self.observed = 0.0
+        # failed polls in a row
+        self.failures = 0
+        self.interval = None
+        self.due = None
+        self.polls = 0
+
+    def rate(self):
+        """ the estimated state changes per second """
+        return (self.changes + PRIOR_CHANGES) / (self.observed + PRIOR_TIME)
+
+class Planner(object):
+    """ polls the status of the entries (fleet.Entry) forever, see run().
+
+        :param poll callable(entry, timeout) -> result dict like fleet.status_one
+        :param on_result called with each result, the result contains the next interval
+        :param adapters optional adapters.AdapterPool, each adapter takes a poll per slot """
+    def __init__(self, entries=(), poll=None, concurrency=DEFAULT_CONCURRENCY, timeout=10.0, adapters=None,
+                 on_result=None, miss=DEFAULT_MISS, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, spacing=DEFAULT_SPACING, jitter=DEFAULT_JITTER,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, half_life=DEFAULT_HALF_LIFE,
+                 seed=None):
+        self.poll = poll or (lambda entry, timeout: status_one(entry, timeout, adapters))
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.on_result = on_result
+        self.miss = miss
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.spacing = spacing
+        self.capacity = len(adapters.adapters) if adapters else 1
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.half_life = half_life
+        self._random = random.Random(seed)
+
+        self._cond = threading.Condition()
+        # (due, seq, mac)
+        self._heap = []
+        self._seq = itertools.count()
+        # slot -> polls planned into the slot
+        self._slots = {}
+        # mac -> LockPlan
+        self._plans = {}
+        self._workers = threading.Semaphore(self.concurrency)
+        self._stopped = False
+
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self._plans)
+
+    def plan(self, mac):
+        """ returns the LockPlan of a lock """
+        return self._plans[mac]
+
+    def add(self, entry, now=None):
+        """ add a lock, it's polled in the next free slot """
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            plan = self._plans[entry.mac] = LockPlan(entry)
+            self._schedule(plan, now)
+
+    def _reserve(self, due):
+        """ returns the start of the first slot not before due with room left. Must be called with the lock held """
+        slot = math.ceil(due / self.spacing)
+        while self._slots.get(slot, 0) >= self.capacity:
+            slot += 1
+        self._slots[slot] = self._slots.get(slot, 0) + 1
+        return slot * self.spacing
+
+    def _release(self, due):
+        slot = round(due / self.spacing)
+        count = self._slots.get(slot, 0) - 1
+        if count > 0:
+            self._slots[slot] = count
+        else:
+            self._slots.pop(slot, None)
+
+    def _schedule(self, plan, due):
+        plan.due = self._reserve(due)
+        heapq.heappush(self._heap, (plan.due, next(self._seq), plan.mac))
+        self._cond.notify()
+
+    def next_interval(self, plan):
+        """ the interval until the next poll without jitter """
+        if plan.failures:
+            return min(self.max_backoff, self.backoff * 2 ** (plan.failures - 1))
+        interval = -math.log(1.0 - self.miss) / plan.rate()
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def observe(self, mac, result, now=None):
+        """ learn from a poll result and schedule the next poll. returns the interval """
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            plan = self._plans[mac]
+            plan.polls += 1
+            if result['success']:
+                plan.failures = 0
+                state = result.get('lock_status')
+                if plan.last_poll is not None:
+                    elapsed = now - plan.last_poll
+                    # two changes between polls look like none, the rate is a lower bound
+                    decay = 0.5 ** (elapsed / self.half_life)
+                    plan.changes = plan.changes * decay + (1.0 if state != plan.state else 0.0)
+                    plan.observed = plan.observed * decay + elapsed
+                plan.state = state
+                plan.last_poll = now
+            else:
+                plan.failures += 1
+
+            interval = self.next_interval(plan)
+            interval *= 1.0 + self._random.uniform(-self.jitter, self.jitter)
+            plan.interval = interval
+            self._schedule(plan, now + interval)
+        return interval
+
+    def _poll(self, plan):
+        try:
+            try:
+                result = self.poll(plan.entry, self.timeout)
+            except Exception as exp:
+                LOG.exception("Polling %s failed", plan.mac)
+                result = {'mac': plan.mac, 'success': False, 'error': str(exp)}
+            result['next_poll'] = round(self.observe(plan.mac, result), 1)
+            if self.on_result:
+                self.on_result(result)
+        finally:
+            self._workers.release()
+
+    def run(self):
+        """ poll until stop() is called. Blocks, at most concurrency polls at the same time """
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="planner") as executor:
+            while True:
+                # a poll due while all workers are busy waits for a worker, not in the executor queue
+                self._workers.acquire()
+                with self._cond:
+                    while not self._stopped:
+                        timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                        if timeout is not None and timeout <= 0:
+                            break
+                        self._cond.wait(timeout)
+                    if self._stopped:
+                        self._workers.release()
+                        return
+                    due, _, mac = heapq.heappop(self._heap)
+                    self._release(due)
+                    plan = self._plans[mac]
+                executor.submit(self._poll, plan)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """ returns the plan of each lock as dict """
+        with self._cond:
+            return [{
+                'mac': plan.mac,
+                'polls': plan.polls,
+                'rate': plan.rate(),
+                'interval': plan.interval,
+                'failures': plan.failures,
+            } for plan in self._plans.values()]
+
+def test_planner_learning():
+    from fleet import Entry
+    planner = Planner(jitter=0.0, spacing=1.0, seed=1)
+    busy = Entry('00:1a:22:00:00:01', 1, None)
+    idle = Entry('00:1a:22:00:00:02', 1, None)
+    gone = Entry('00:1a:22:00:00:03', 1, None)
+    for entry in [busy, idle, gone]:
+        planner.add(entry, now=0.0)
+    # the first polls are spread over the slots
+    assert sorted(planner.plan(entry.mac).due for entry in [busy, idle, gone]) == [0.0, 1.0, 2.0]
+
+    now = 0.0
+    for poll in range(20):
+        now += 60.0
+        planner.observe(busy.mac, {'success': True, 'lock_status': poll % 2}, now)
+        planner.observe(idle.mac, {'success': True, 'lock_status': 3}, now)
+    assert planner.plan(busy.mac).interval == planner.min_interval
+    assert planner.plan(idle.mac).interval > 5 * planner.min_interval
+
+    intervals = [planner.observe(gone.mac, {'success': False}, now) for _ in range(8)]
+    assert intervals[:3] == [60.0, 120.0, 240.0]
+    assert intervals[-1] == planner.max_backoff
+
+    # a poll planned into an occupied slot moves to the next one
+    planner.add(Entry('00:1a:22:00:00:04', 1, None), now=0.0)
+    assert planner.plan('00:1a:22:00:00:04').due == 3.0
+
+def test_planner_run():
+    from fleet import Entry
+    polled = []
+    done = threading.Event()
+
+    def _poll(entry, timeout):
+        polled.append(entry.mac)
+        if len(polled) >= 6:
+            done.set()
+        return {'mac': entry.mac, 'success': True, 'lock_status': 3}
+
+    entries = [Entry('00:1a:22:00:00:%02x' % index, 1, None) for index in range(3)]
+    planner = Planner(entries, poll=_poll, min_interval=0.05, max_interval=0.1, spacing=0.01, concurrency=2)
+    runner = threading.Thread(target=planner.run)
+    runner.start()
+    assert done.wait(5.0)
+    planner.stop()
+    runner.join(2.0)
+    assert not runner.is_alive()
+    assert set(polled) == set(entry.mac for entry in entries)
+    assert all(stats['polls'] for stats in planner.stats())
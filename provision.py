@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# bulk pairing of many locks from a file of QR codes.
+#
+# The job file contains one lock per line:
+# <qrdata> <userkey as hex> [userid] [user name]
+# Empty lines and lines starting with # are ignored.
+
+import binascii
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+LOG = logging.getLogger("provision")
+
+# M001234556678K01234567890ABCDEF023456789ABCDEF0123456789
+QRDATA_REX = re.compile(r'^M([0-9A-F]{12})K([0-9A-F]{32})([0-9A-Z]{10})$')
+
+# how many locks are paired at the same time. A single adapter can not handle many connections.
+DEFAULT_CONCURRENCY = 2
+
+def parse_qrdata(qrdata):
+    """ returns (mac, cardkey, serial) of the QR code data or raise a RuntimeError """
+    match = QRDATA_REX.match(qrdata)
+    if not match:
+        raise RuntimeError("Invalid QR Data")
+    smac, cardkey, serial = match.groups()
+    mac = ":".join(smac[i:i+2] for i in range(0, len(smac), 2))
+    return mac, cardkey, serial
+
+class Job(object):
+    def __init__(self, qrdata, userkey, userid=None, username=None):
+        self.mac, self.cardkey, self.serial = parse_qrdata(qrdata)
+        self.userkey = userkey
+        self.userid = userid
+        self.username = username
+
+def read_jobs(fp):
+    """ read the jobs from a file object """
+    jobs = []
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        fields = line.split(None, 3)
+        if len(fields) < 2:
+            raise RuntimeError("Line %d: expecting <qrdata> <userkey> [userid] [user name]" % lineno)
+
+        userid = int(fields[2]) if len(fields) > 2 else None
+        username = fields[3] if len(fields) > 3 else None
+        try:
+            jobs.append(Job(fields[0], fields[1], userid, username))
+        except RuntimeError as exp:
+            raise RuntimeError("Line %d: %s" % (lineno, exp))
+    return jobs
+
+def pair_one(job, timeout, adapters=None):
+    """ pair a single lock and return the manifest entry """
+    from fsm import Device
+
+    result = {
+        'serial': job.serial,
+        'mac': job.mac,
+        'userid': job.userid,
+        'success': False,
+        'error': None,
+    }
+
+    start = time.monotonic()
+    device = None
+    try:
+        userkey = binascii.unhexlify(job.userkey)
+        cardkey = binascii.unhexlify(job.cardkey)
+        if len(userkey) != 16:
+            raise RuntimeError("Userkey is too short or too long. Expecting 16 byte encode as hex (32 characters)")
+
+        userid = job.userid if job.userid is not None else 0xff
+        device = Device(job.mac, userid=userid, adapters=adapters)
+        if not device.pair(userkey, cardkey, timeout=timeout):
+            result['error'] = "Pairing rejected or no answer from the lock"
+        else:
+            result['success'] = True
+            result['userid'] = device.userid
+            result['adapter'] = device.adapter
+            if job.username and not device.set_user_name(device.userid, job.username, timeout=timeout):
+                result['error'] = "Paired, but setting the user name failed"
+    except Exception as exp:
+        LOG.exception("Pairing %s failed", job.mac)
+        result['error'] = str(exp)
+    finally:
+        if device and device.ll:
+            device.disconnect()
+
+    result['duration'] = round(time.monotonic() - start, 3)
+    return result
+
+def write_manifest(path, results):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    os.replace(tmp, path)
+
+def provision(jobs, concurrency=DEFAULT_CONCURRENCY, timeout=20.0, manifest=None, on_result=None, adapters=None):
+    """ pair all jobs, at most concurrency at the same time.
+        The manifest is rewritten after every lock, so an aborted run still leaves a record.
+        returns the list of results in the order of the jobs """
+    results = [None] * len(jobs)
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(pair_one, job, timeout, adapters): index for index, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            result = future.result()
+            with lock:
+                results[futures[future]] = result
+                if manifest:
+                    write_manifest(manifest, [res for res in results if res])
+            if on_result:
+                on_result(result)
+
+    return results
+
+def test_parse_qrdata():
+    mac, cardkey, serial = parse_qrdata('M001A22334455K0123456789ABCDEF0123456789ABCDEFKEQ0123456')
+    assert mac == '00:1A:22:33:44:55'
+    assert cardkey == '0123456789ABCDEF0123456789ABCDEF'
+    assert serial == 'KEQ0123456'
+
+def test_read_jobs():
+    import io
+    jobs = read_jobs(io.StringIO(
+        "# building A\n"
+        "\n"
+        "M001A22334455K0123456789ABCDEF0123456789ABCDEFKEQ0123456 00112233445566778899aabbccddeeff 3 Front door\n"))
+    assert len(jobs) == 1
+    assert jobs[0].mac == '00:1A:22:33:44:55'
+    assert jobs[0].userid == 3
+    assert jobs[0].username == 'Front door'
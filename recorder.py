@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Record and replay BLE sessions at the LowerLayer boundary.
+#
+# The Recorder captures every pdu written by LowerLayer._send_pdu and every
+# notification delivered to LowerLayer.handleNotification into a session file.
+# ReplayPeripheral plays a recording back as a bluepy Peripheral, so the stack
+# runs the recorded traffic without a radio, at the recorded speed or faster.
+#
+# File format (big endian):
+#   header: 'KBLEREC' version(1 byte) start(double, unix time)
+#   record: kind(1 byte) delta(uint32, microseconds since the previous record) handle(uint16) length(uint8) data
+
+import argparse
+import binascii
+import logging
+import sys
+import threading
+import time
+from collections import namedtuple
+from struct import pack, unpack, calcsize
+
+from encrypt import decrypt_message
+from exceptions import CouldNotConnect, InvalidData
+from gattstub import Notifications, Service
+from messages import AnswerWithSecurity, AnswerWithoutSecurity, CommandMessage, ConnectionInfoMessage, \
+    ConnectionRequestMessage, FragmentAck, MESSAGES, PairingRequestMessage, StatusInfoMessage, StatusRequestMessage, \
+    UserInfoMessage, UserInfoRequestMessage, UserListInfoMessage, UserListRequestMessage, UserNameSetMessage, \
+    UserRemoveMessage, decode_fragment, is_secure
+from sendqueue import PRIORITY_NORMAL
+
+LOG = logging.getLogger("recorder")
+
+MAGIC = b'KBLEREC'
+VERSION = 1
+HEADER_FORMAT = '>7sBd'
+RECORD_FORMAT = '>BIHB'
+
+KIND_CONNECT = 0
+KIND_SEND = 1
+KIND_NOTIFY = 2
+KIND_DISCONNECT = 3
+
+KIND_NAMES = {
+    KIND_CONNECT: 'connect',
+    KIND_SEND: 'send',
+    KIND_NOTIFY: 'notify',
+    KIND_DISCONNECT: 'disconnect',
+}
+
+# the answer of each request, used to replay the requests through a Device
+ANSWERS = {
+    PairingRequestMessage.msgtype: AnswerWithoutSecurity,
+    CommandMessage.msgtype: AnswerWithSecurity,
+    StatusRequestMessage.msgtype: StatusInfoMessage,
+    UserListRequestMessage.msgtype: UserListInfoMessage,
+    UserInfoRequestMessage.msgtype: UserInfoMessage,
+    UserNameSetMessage.msgtype: AnswerWithSecurity,
+    UserRemoveMessage.msgtype: AnswerWithSecurity,
+}
+
+# time relative to the start of the recording in seconds
+Record = namedtuple('Record', ['kind', 'time', 'handle', 'data'])
+
+class ReplayMismatch(RuntimeError):
+    pass
+
+class Recorder(object):
+    """ writes a session file. Can be shared by multiple LowerLayers """
+    def __init__(self, path=None, fp=None):
+        self._fp = fp or open(path, 'wb')
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+        self._fp.write(pack(HEADER_FORMAT, MAGIC, VERSION, time.time()))
+        self._fp.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _record(self, kind, handle, data):
+        data = bytes(data)
+        with self._lock:
+            now = time.monotonic()
+            delta = min(int((now - self._last) * 1000000), 0xffffffff)
+            self._last = now
+            self._fp.write(pack(RECORD_FORMAT, kind, delta, handle, len(data)) + data)
+            # keyble.py leaves with os._exit(), don't loose the recording
+            self._fp.flush()
+
+    def connected(self, mac):
+        self._record(KIND_CONNECT, 0, mac.encode('ascii'))
+
+    def sent(self, handle, pdu):
+        self._record(KIND_SEND, handle, pdu)
+
+    def received(self, handle, data):
+        self._record(KIND_NOTIFY, handle, data)
+
+    def disconnected(self):
+        self._record(KIND_DISCONNECT, 0, b'')
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+class Recording(object):
+    def __init__(self, records, start=None):
+        self.records = records
+        # unix time of the start of the recording
+        self.start = start
+
+    @property
+    def mac(self):
+        for record in self.records:
+            if record.kind == KIND_CONNECT:
+                return record.data.decode('ascii')
+        return None
+
+    def handles(self):
+        """ returns the handles (send, recv) used in the recording """
+        send = recv = None
+        for record in self.records:
+            if record.kind == KIND_SEND and send is None:
+                send = record.handle
+            elif record.kind == KIND_NOTIFY and recv is None:
+                recv = record.handle
+        return send, recv
+
+    def sessions(self):
+        """ split the recording into one Recording per connection """
+        sessions = []
+        for record in self.records:
+            if record.kind == KIND_CONNECT or not sessions:
+                sessions.append([])
+            sessions[-1].append(record)
+        return [Recording(records, self.start) for records in sessions]
+
+    def _messages(self, kind):
+        """ reassemble the messages of one direction. returns [(time, message)] """
+        fragments = []
+        messages = []
+        for record in self.records:
+            if record.kind != kind:
+                continue
+            data = bytearray(record.data)
+            if kind == KIND_SEND and len(data) == 2 and data[0] == FragmentAck.msgtype:
+                continue
+            if kind == KIND_NOTIFY and data[0] == 0x80 and data[1] == FragmentAck.msgtype:
+                continue
+            fragments.append(data)
+            try:
+                decoded, fragments = decode_fragment(fragments)
+            except RuntimeError:
+                fragments = []
+                continue
+            for message in decoded:
+                messages.append((record.time, message))
+        return messages
+
+    def sent_messages(self):
+        return self._messages(KIND_SEND)
+
+    def received_messages(self):
+        return self._messages(KIND_NOTIFY)
+
+def read_recording(fp):
+    """ read a session file written by the Recorder """
+    header = fp.read(calcsize(HEADER_FORMAT))
+    if len(header) != calcsize(HEADER_FORMAT):
+        raise InvalidData("Recording too short")
+    magic, version, start = unpack(HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise InvalidData("Not a recording")
+    if version != VERSION:
+        raise InvalidData("Unsupported recording version %d" % version)
+
+    records = []
+    now = 0.0
+    size = calcsize(RECORD_FORMAT)
+    while True:
+        head = fp.read(size)
+        if not head:
+            break
+        if len(head) != size:
+            raise InvalidData("Truncated record")
+        kind, delta, handle, length = unpack(RECORD_FORMAT, head)
+        data = fp.read(length)
+        if len(data) != length:
+            raise InvalidData("Truncated record")
+        now += delta / 1000000.0
+        records.append(Record(kind, now, handle, data))
+    return Recording(records, start)
+
+def load(path):
+    with open(path, 'rb') as fp:
+        return read_recording(fp)
+
+class ReplayPeripheral(object):
+    """ implements the part of bluepy.btle.Peripheral used by the LowerLayer.
+        Every write is answered with the notifications which followed the same write in the recording.
+
+        :param speed 1.0 for the recorded timing, 10.0 ten times faster, 0 without any delay
+        :param strict raise ReplayMismatch when a write differs from the recording """
+    def __init__(self, recording, speed=1.0, strict=False):
+        self.recording = recording
+        self.speed = speed
+        self.strict = strict
+        self._send_handle, self._recv_handle = recording.handles()
+        self._delegate = None
+        self._connected = False
+        self._notifications = Notifications()
+
+        # [(recorded write, [(delay, notification)])]
+        self._script = []
+        self._initial = []
+        last = None
+        for record in recording.records:
+            if record.kind == KIND_SEND:
+                last = record
+                self._script.append((record, []))
+            elif record.kind == KIND_NOTIFY:
+                if last is None:
+                    self._initial.append((0.0, record))
+                else:
+                    self._script[-1][1].append((record.time - last.time, record))
+        self._index = 0
+
+        # statistics
+        self.writes = 0
+        self.mismatches = 0
+
+    # bluepy api
+    def setDelegate(self, delegate):
+        self._delegate = delegate
+        return self
+
+    withDelegate = setDelegate
+
+    def connect(self, addr, addrType=None, iface=None, timeout=None):
+        self._connected = True
+        self._schedule(self._initial)
+
+    def disconnect(self):
+        self._connected = False
+
+    def getServices(self):
+        return [self.getServiceByUUID(None)]
+
+    def getServiceByUUID(self, uuid):
+        return Service(self, self._send_handle, self._recv_handle)
+
+    def waitForNotifications(self, timeout):
+        notification = self._notifications.wait(timeout)
+        if notification is None:
+            return False
+        if self._delegate:
+            self._delegate.handleNotification(*notification)
+        return True
+
+    def wake(self):
+        """ end waitForNotifications() early, the LowerLayer has something to send """
+        self._notifications.wake()
+
+    @property
+    def finished(self):
+        """ all recorded writes have been replayed """
+        return self._index >= len(self._script)
+
+    def _schedule(self, notifications):
+        now = time.monotonic()
+        for delay, record in notifications:
+            due = now + delay / self.speed if self.speed else now
+            self._notifications.push(due, record.handle, record.data)
+
+    def _write(self, handle, data, with_response):
+        if not self._connected:
+            raise RuntimeError("Not connected")
+        self.writes += 1
+        if self._index >= len(self._script):
+            LOG.warning("Write %s beyond the end of the recording", bytes(data).hex())
+            self.mismatches += 1
+            if self.strict:
+                raise ReplayMismatch("Write beyond the end of the recording")
+            return None
+
+        record, notifications = self._script[self._index]
+        self._index += 1
+        if bytes(data) != record.data:
+            LOG.warning("Write %d differs: %s != %s", self._index, bytes(data).hex(), record.data.hex())
+            self.mismatches += 1
+            if self.strict:
+                raise ReplayMismatch("Write %d differs from the recording" % self._index)
+        self._schedule(notifications)
+        return None
+
+class ReplayResult(object):
+    def __init__(self):
+        self.duration = None
+        self.requests = 0
+        self.answers = 0
+        self.failed = 0
+        # seconds of each request
+        self.latencies = []
+        self.writes = 0
+        self.mismatches = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def replay_lowerlayer(recording, speed=1.0, strict=False, timeout=10.0):
+    """ send the recorded messages of one session through a LowerLayer.
+        Doesn't need any key, the messages are sent as recorded. """
+    from lowerlayer import LowerLayer
+
+    result = ReplayResult()
+    peripheral = ReplayPeripheral(recording, speed, strict)
+    received = []
+    cond = threading.Condition()
+
+    def _on_receive(message):
+        with cond:
+            received.append(message)
+            cond.notify_all()
+
+    # how many messages arrived after each sent message
+    sent = recording.sent_messages()
+    answers = recording.received_messages()
+    expected = []
+    for index, (sent_time, _message) in enumerate(sent):
+        next_time = sent[index + 1][0] if index + 1 < len(sent) else float('inf')
+        expected.append(len([1 for answer_time, _answer in answers if sent_time <= answer_time < next_time]))
+
+    ll = LowerLayer(recording.mac, peripheral=peripheral)
+    ll.set_on_receive(_on_receive)
+    start = time.monotonic()
+    try:
+        ll.connect()
+        count = 0
+        for (_time, message), answers in zip(sent, expected):
+            count += answers
+            request_start = time.monotonic()
+            ll.send(message)
+            result.requests += 1
+            with cond:
+                if not cond.wait_for(lambda: len(received) >= count, timeout):
+                    result.failed += 1
+                    continue
+            result.latencies.append(time.monotonic() - request_start)
+    finally:
+        result.duration = time.monotonic() - start
+        ll.disconnect()
+
+    result.answers = len(received)
+    result.writes = peripheral.writes
+    result.mismatches = peripheral.mismatches
+    return result
+
+def replay_device(recording, userid, userkey, speed=1.0, strict=False, timeout=10.0):
+    """ replay the requests of one session through a Device.
+        The requests are decrypted with the userkey and issued again. The local nonce is taken
+        from the recording, so the Device encrypts exactly the recorded pdus. """
+    from fsm import Device
+
+    result = ReplayResult()
+    sent = [message for _time, message in recording.sent_messages()]
+    received = [message for _time, message in recording.received_messages()]
+    if not sent or sent[0][0] != ConnectionRequestMessage.msgtype:
+        raise InvalidData("The recording doesn't start with a ConnectionRequest")
+    if not received or received[0][0] != ConnectionInfoMessage.msgtype:
+        raise InvalidData("The recording doesn't contain the ConnectionInfo")
+    local_nonce = ConnectionRequestMessage.decode(sent[0]).nonce
+    remote_nonce = ConnectionInfoMessage.decode(received[0]).remote_session_nonce
+
+    peripheral = ReplayPeripheral(recording, speed, strict)
+    device = Device(recording.mac, userid, bytearray(userkey), peripheral_factory=lambda: peripheral)
+    device.nonce = local_nonce
+    device.nonce_byte = bytearray(pack('>Q', local_nonce))
+
+    start = time.monotonic()
+    try:
+        if not device._setup(timeout):
+            raise CouldNotConnect("Replay failed to exchange the nonce")
+        for message in sent[1:]:
+            answer_type = ANSWERS.get(message[0])
+            if answer_type is None:
+                LOG.info("Skipping message 0x%x", message[0])
+                continue
+
+            result.requests += 1
+            request_start = time.monotonic()
+            if is_secure(message[0]):
+                _type, _counter, decrypted = decrypt_message(message, remote_nonce, userkey)
+                answer = device._request(MESSAGES[message[0]].decode(decrypted), answer_type, timeout)
+            else:
+                answer = device._result(device._submit(message, answer_type, timeout, PRIORITY_NORMAL), timeout)
+            if answer is None:
+                result.failed += 1
+                continue
+            result.answers += 1
+            result.latencies.append(time.monotonic() - request_start)
+    finally:
+        result.duration = time.monotonic() - start
+        device.disconnect()
+
+    result.writes = peripheral.writes
+    result.mismatches = peripheral.mismatches
+    return result
+
+def dump(recording, fp=sys.stdout):
+    for record in recording.records:
+        print("%10.6f %-10s %04x %s" % (record.time, KIND_NAMES.get(record.kind, record.kind),
+                                        record.handle, record.data.hex()), file=fp)
+
+def main():
+    parser = argparse.ArgumentParser(description='dump and replay keyble session recordings')
+    parser.add_argument('command', choices=['dump', 'replay'])
+    parser.add_argument('recording', help='The session file written by keyble.py --record')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 0 to replay without any delay')
+    parser.add_argument('--strict', action='store_true', help='Fail when the stack writes something else than recorded')
+    parser.add_argument('--user-id', dest='userid', type=int, help='Replay through a Device. Require --user-key.')
+    parser.add_argument('--user-key', dest='userkey', help='The user key to decrypt the recorded requests')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='Enable debug logging.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)-15s %(levelname)-8s %(name)-22s %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    recording = load(args.recording)
+    if args.command == 'dump':
+        dump(recording)
+        return
+
+    failed = False
+    for index, session in enumerate(recording.sessions()):
+        if args.userkey:
+            result = replay_device(session, args.userid, binascii.unhexlify(args.userkey), args.speed, args.strict)
+        else:
+            result = replay_lowerlayer(session, args.speed, args.strict)
+        latencies = sorted(result.latencies)
+        print("session %d %s: %d requests, %d failed, %d mismatches, %.1f ms, max request %.1f ms" % (
+            index, session.mac, result.requests, result.failed, result.mismatches,
+            result.duration * 1000, latencies[-1] * 1000 if latencies else 0))
+        failed = failed or result.failed or result.mismatches
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
+
+def test_recording_roundtrip():
+    import io
+    fp = io.BytesIO()
+    recorder = Recorder(fp=fp)
+    recorder.connected('00:1a:22:00:00:01')
+    recorder.sent(0x411, b'\x80\x01\x02')
+    recorder.received(0x421, b'\x80\x03')
+    recorder.disconnected()
+    fp.seek(0)
+
+    recording = read_recording(fp)
+    assert recording.mac == '00:1a:22:00:00:01'
+    assert [record.kind for record in recording.records] == [KIND_CONNECT, KIND_SEND, KIND_NOTIFY, KIND_DISCONNECT]
+    assert recording.records[1].data == b'\x80\x01\x02'
+    assert recording.handles() == (0x411, 0x421)
+    assert len(recording.sessions()) == 1
+
+def test_replay_fake_lock():
+    import io
+    from fakelock import FakeLock, FakePeripheral
+    from fsm import Device
+
+    userkey = bytearray(range(16))
+    lock = FakeLock({1: userkey}, names={1: 'admin'})
+    fp = io.BytesIO()
+    recorder = Recorder(fp=fp)
+    device = Device('00:1a:22:00:00:01', 1, userkey, peripheral_factory=lambda: FakePeripheral(lock, latency=0.001),
+                    recorder=recorder)
+    assert device.open(5.0)
+    assert device.status(5.0) is not None
+    device.disconnect()
+    time.sleep(0.2)
+    fp.seek(0)
+
+    recording = read_recording(fp)
+    result = replay_device(recording, 1, userkey, speed=0, strict=True, timeout=5.0)
+    assert (result.requests, result.failed, result.mismatches) == (2, 0, 0)
+    result = replay_lowerlayer(recording, speed=0, strict=True, timeout=5.0)
+    assert (result.requests, result.failed, result.mismatches) == (3, 0, 0)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# The outbound message queue of the lower layer.
+# A bounded priority queue. Each entry has a deadline and can be cancelled by the caller.
+# Expired or cancelled entries are dropped before they are sent.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from exceptions import QueueFull
+
+LOG = logging.getLogger("sendqueue")
+
+# interactive commands (open/lock/unlock) by a user
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+# housekeeping like periodic status requests
+PRIORITY_BACKGROUND = 2
+
+DROPPED_CANCELLED = 'cancelled'
+DROPPED_EXPIRED = 'expired'
+DROPPED_EVICTED = 'evicted'
+
+class SendHandle(object):
+    """ returned by SendQueue.put(). The caller can cancel the message or wait until it was sent """
+    def __init__(self, message, priority, deadline, budget=None):
+        # a bytearray or a callable returning the bytearray when it's going to be sent.
+        # A callable allows to encrypt a message with the security counter in the order of sending.
+        self.message = message
+        self.priority = priority
+        # time.monotonic() based, None for no deadline
+        self.deadline = deadline
+        # the deadline.Deadline of the operation sending the message, records its progress
+        self.budget = budget
+        self.cancelled = False
+        # the reason why the message was dropped or None
+        self.dropped = None
+        self._done = threading.Event()
+
+    def cancel(self):
+        """ cancel the message. Has no effect if the message is already on air """
+        self.cancelled = True
+
+    def expired(self, now=None):
+        if self.deadline is None:
+            return False
+        return (now or time.monotonic()) >= self.deadline
+
+    def pdu(self):
+        if callable(self.message):
+            return self.message()
+        return self.message
+
+    @property
+    def sent(self):
+        return self._done.is_set() and self.dropped is None
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ wait until the message was sent or dropped. returns True when sent """
+        self._done.wait(timeout)
+        return self.sent
+
+    def _finish(self, dropped=None):
+        self.dropped = dropped
+        self._done.set()
+
+class SendQueue(object):
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def empty(self):
+        return len(self) == 0
+
+    def _evict(self, priority):
+        """ drop the newest entry with a lower priority than priority. returns True on success """
+        victims = [entry for entry in self._heap if entry[0] > priority]
+        if not victims:
+            return False
+        victim = max(victims)
+        self._heap.remove(victim)
+        heapq.heapify(self._heap)
+        LOG.info("Evicting message with priority %d", victim[0])
+        victim[2]._finish(DROPPED_EVICTED)
+        return True
+
+    def _purge(self, now):
+        """ drop all expired and cancelled entries """
+        alive = []
+        for entry in self._heap:
+            handle = entry[2]
+            if handle.cancelled:
+                handle._finish(DROPPED_CANCELLED)
+            elif handle.expired(now):
+                handle._finish(DROPPED_EXPIRED)
+            else:
+                alive.append(entry)
+        if len(alive) != len(self._heap):
+            self._heap = alive
+            heapq.heapify(self._heap)
+
+    def put(self, message, priority=PRIORITY_NORMAL, deadline=None, timeout=None, budget=None):
+        """ enqueue a message. When the queue is full, a lower priority message is evicted
+            or the caller blocks up to timeout seconds (0 to not block at all).
+            Raise QueueFull when there is no space.
+            returns a SendHandle """
+        handle = SendHandle(message, priority, deadline, budget)
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._heap) >= self.maxsize:
+                self._purge(time.monotonic())
+                if len(self._heap) < self.maxsize or self._evict(priority):
+                    break
+                now = time.monotonic()
+                remaining = None if end is None else end - now
+                if deadline is not None:
+                    remaining = deadline - now if remaining is None else min(remaining, deadline - now)
+                if remaining is not None and remaining <= 0:
+                    raise QueueFull("Send queue is full")
+                self._cond.wait(remaining)
+            heapq.heappush(self._heap, (priority, next(self._seq), handle))
+        return handle
+
+    def get(self):
+        """ returns the next SendHandle which is neither cancelled nor expired or None """
+        now = time.monotonic()
+        with self._cond:
+            while self._heap:
+                _priority, _seq, handle = heapq.heappop(self._heap)
+                self._cond.notify()
+                if handle.cancelled:
+                    handle._finish(DROPPED_CANCELLED)
+                elif handle.expired(now):
+                    LOG.info("Dropping expired message")
+                    handle._finish(DROPPED_EXPIRED)
+                else:
+                    return handle
+        return None
+
+    def clear(self):
+        with self._cond:
+            for entry in self._heap:
+                entry[2]._finish(DROPPED_CANCELLED)
+            self._heap = []
+            self._cond.notify_all()
+
+def test_send_queue_priority():
+    queue = SendQueue()
+    queue.put(b'status', PRIORITY_BACKGROUND)
+    queue.put(b'normal')
+    queue.put(b'open', PRIORITY_INTERACTIVE)
+    assert queue.get().message == b'open'
+    assert queue.get().message == b'normal'
+    assert queue.get().message == b'status'
+    assert queue.get() is None
+
+def test_send_queue_drop():
+    queue = SendQueue()
+    expired = queue.put(b'late', deadline=time.monotonic() - 1)
+    cancelled = queue.put(b'cancelled')
+    cancelled.cancel()
+    queue.put(b'ok')
+    assert queue.get().message == b'ok'
+    assert expired.dropped == DROPPED_EXPIRED
+    assert cancelled.dropped == DROPPED_CANCELLED
+    assert not expired.sent
+
+def test_send_queue_backpressure():
+    queue = SendQueue(maxsize=1)
+    background = queue.put(b'status', PRIORITY_BACKGROUND)
+    # an interactive message evicts the background message
+    queue.put(b'open', PRIORITY_INTERACTIVE)
+    assert background.dropped == DROPPED_EVICTED
+    try:
+        queue.put(b'status', PRIORITY_BACKGROUND, timeout=0)
+    except QueueFull:
+        pass
+    else:
+        assert False
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# A memory mapped board of the state of every lock, shared by local processes.
+#
+# The process owning the session of a lock writes the record of the lock, any number
+# of processes read it by mapping the same file (e.g. in /dev/shm) without any IPC
+# or radio traffic. Each record is protected by a seqlock: the writer makes the sequence
+# odd while writing, a reader retries until it read the same even sequence before and after.
+#
+# Layout (little endian):
+#   header: 'KBLESTB' version(uint8) slots(uint32) record size(uint32)
+#   record: seq(uint32) mac(6 byte) used(uint8) lock_status(uint8) battery_low(uint8)
+#           last_command(uint8) last_command_ok(uint8) pad
+#           last_seen(double) last_status(double) last_command_time(double) latency(float)
+
+import fcntl
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+from struct import Struct
+
+MAGIC = b'KBLESTB'
+VERSION = 1
+HEADER = Struct('<7sBII')
+RECORD = Struct('<I6sBBBBBxdddf20x')
+SEQ = Struct('<I')
+DEFAULT_SLOTS = 256
+
+NO_COMMAND = 0xff
+# a reader gives up when a record is written for that long
+READ_ATTEMPTS = 10000
+
+FIELDS = ['lock_status', 'battery_low', 'last_command', 'last_command_ok',
+          'last_seen', 'last_status', 'last_command_time', 'latency']
+
+def _mac_bytes(mac):
+    return bytes(int(part, 16) for part in mac.split(':'))
+
+def _mac_str(mac):
+    return ':'.join('%02x' % byte for byte in mac)
+
+class StateBoard(object):
+    """ without a path the board is disabled and update() does nothing """
+    def __init__(self, path=None, slots=DEFAULT_SLOTS, writable=True):
+        self._path = None
+        self._fd = None
+        self._map = None
+        self._slots = 0
+        self._writable = writable
+        # mac -> slot
+        self._index = {}
+        self._lock = threading.Lock()
+        if path:
+            self.open(path, slots, writable)
+
+    @property
+    def enabled(self):
+        return self._map is not None
+
+    def open(self, path, slots=DEFAULT_SLOTS, writable=True):
+        """ map the board, create it when it doesn't exist yet """
+        size = HEADER.size + slots * RECORD.size
+        flags = os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY
+        fd = os.open(path, flags, 0o644)
+        if writable:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, VERSION, slots, RECORD.size), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        magic, version, slots, record_size = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            os.close(fd)
+            raise RuntimeError("%s is not a state board" % path)
+
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(fd, HEADER.size + slots * RECORD.size, access=access)
+        self._fd = fd
+        self._path = path
+        self._slots = slots
+        self._writable = writable
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
+
+    def _offset(self, slot):
+        return HEADER.size + slot * RECORD.size
+
+    def _find(self, mac):
+        """ returns the slot of the mac or None """
+        slot = self._index.get(mac)
+        if slot is not None:
+            return slot
+        wanted = _mac_bytes(mac)
+        for slot in range(self._slots):
+            offset = self._offset(slot) + SEQ.size
+            if self._map[offset:offset + 7] == wanted + b'\x01':
+                self._index[mac] = slot
+                return slot
+        return None
+
+    def _allocate(self, mac):
+        """ returns the slot of the mac, allocates a free one. Serialized between processes by flock """
+        slot = self._find(mac)
+        if slot is not None:
+            return slot
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            slot = self._find(mac)
+            if slot is not None:
+                return slot
+            for slot in range(self._slots):
+                offset = self._offset(slot)
+                if not self._map[offset + SEQ.size + 6]:
+                    RECORD.pack_into(self._map, offset, 0, _mac_bytes(mac), 1,
+                                     0, 0, NO_COMMAND, 0, 0.0, 0.0, 0.0, 0.0)
+                    self._index[mac] = slot
+                    return slot
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        raise RuntimeError("The state board is full")
+
+    def update(self, mac, **fields):
+        """ update fields (see FIELDS) of the record of a lock. Only the session owner may write it """
+        if self._map is None:
+            return
+        with self._lock:
+            slot = self._allocate(mac)
+            offset = self._offset(slot)
+            record = dict(zip(['seq', 'mac', 'used'] + FIELDS, RECORD.unpack_from(self._map, offset)))
+            for name, value in fields.items():
+                if name not in FIELDS:
+                    raise KeyError(name)
+                record[name] = NO_COMMAND if name == 'last_command' and value is None else value
+            # odd: write in progress. A writer which died in the middle left it odd already
+            seq = record['seq'] | 1
+            SEQ.pack_into(self._map, offset, seq)
+            RECORD.pack_into(self._map, offset, seq, record['mac'], 1,
+                             *[record[name] for name in FIELDS])
+            SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+
+    def _read_slot(self, slot):
+        offset = self._offset(slot)
+        for attempt in range(READ_ATTEMPTS):
+            seq, = SEQ.unpack_from(self._map, offset)
+            if not seq & 1:
+                data = self._map[offset:offset + RECORD.size]
+                if SEQ.unpack_from(self._map, offset)[0] == seq:
+                    break
+            # let the writer finish
+            time.sleep(0)
+        else:
+            raise RuntimeError("The record of slot %d is locked, did the writer die?" % slot)
+        values = RECORD.unpack(data)
+        record = dict(zip(FIELDS, values[3:]))
+        record['mac'] = _mac_str(values[1])
+        record['battery_low'] = bool(record['battery_low'])
+        record['last_command_ok'] = bool(record['last_command_ok'])
+        if record['last_command'] == NO_COMMAND:
+            record['last_command'] = None
+        return record
+
+    def read(self, mac):
+        """ returns the record of a lock as dict or None """
+        if self._map is None:
+            return None
+        slot = self._find(mac)
+        if slot is None:
+            return None
+        return self._read_slot(slot)
+
+    def records(self):
+        """ returns the records of all locks """
+        if self._map is None:
+            return []
+        records = []
+        for slot in range(self._slots):
+            if self._map[self._offset(slot) + SEQ.size + 6]:
+                records.append(self._read_slot(slot))
+        return records
+
+# the board written by the devices of this process, disabled until opened
+BOARD = StateBoard()
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("Usage: %s <state board> [mac]" % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    board = StateBoard(sys.argv[1], writable=False)
+    if len(sys.argv) == 3:
+        print(json.dumps(board.read(sys.argv[2])))
+        return
+    for record in board.records():
+        print(json.dumps(record))
+
+if __name__ == '__main__':
+    main()
+
+def test_state_board():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'board')
+        writer = StateBoard(path, slots=4)
+        writer.update('00:1a:22:00:00:01', lock_status=3, battery_low=True, last_seen=1.5)
+        writer.update('00:1a:22:00:00:02', last_command=2, last_command_ok=True, latency=0.25)
+        writer.update('00:1a:22:00:00:01', last_status=2.0)
+
+        reader = StateBoard(path, writable=False)
+        record = reader.read('00:1a:22:00:00:01')
+        assert record['lock_status'] == 3
+        assert record['battery_low']
+        assert record['last_seen'] == 1.5
+        assert record['last_status'] == 2.0
+        assert record['last_command'] is None
+        assert reader.read('00:1a:22:00:00:02')['last_command'] == 2
+        assert reader.read('00:1a:22:00:00:03') is None
+        assert len(reader.records()) == 2
+
+        # a writer died in the middle of an update, the next one ends the write
+        offset = writer._offset(writer._find('00:1a:22:00:00:02'))
+        SEQ.pack_into(writer._map, offset, SEQ.unpack_from(writer._map, offset)[0] + 1)
+        writer.update('00:1a:22:00:00:02', latency=0.5)
+        assert reader.read('00:1a:22:00:00:02')['latency'] == 0.5
+        reader.close()
+        writer.close()
+
+        # disabled board
+        StateBoard().update('00:1a:22:00:00:01', lock_status=3)
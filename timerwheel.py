@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# One timer thread for all protocol timeouts of all sessions.
+#
+# A hashed timer wheel: a timer is put into the slot of its due tick, a slot holds
+# the timers of every `slots` ticks (the rounds). Schedule and cancel are O(1).
+# The thread only wakes up every tick while timers are pending and sleeps when there are none.
+#
+# Callbacks run on the timer thread and must not block. A state machine with blocking
+# timeout callbacks passes them to its own thread (see WheelTimeout and timeout_dispatch).
+
+import logging
+import math
+import threading
+import time
+
+from transitions.extensions.states import Timeout
+
+LOG = logging.getLogger("timerwheel")
+
+class TimerHandle(object):
+    __slots__ = ['due', 'callback', 'args', 'cancelled', '_wheel']
+
+    def __init__(self, wheel, due, callback, args):
+        self._wheel = wheel
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ cancel the timer. Can be called multiple times and after it fired """
+        self._wheel.cancel(self)
+
+class TimerWheel(object):
+    def __init__(self, tick=0.05, slots=256, name="timerwheel"):
+        self.tick = tick
+        self.slots = slots
+        self.name = name
+        # each slot is a dict used as ordered set of TimerHandles
+        self._wheel = [{} for _ in range(slots)]
+        self._cond = threading.Condition()
+        self._start = time.monotonic()
+        # the last tick processed
+        self._current = 0
+        self._pending = 0
+        self._thread = None
+
+    def __len__(self):
+        return self._pending
+
+    def _due(self, delay):
+        return max(self._current + 1, math.ceil((time.monotonic() + delay - self._start) / self.tick))
+
+    def schedule(self, delay, callback, *args):
+        """ call callback(*args) after delay seconds on the timer thread. returns a TimerHandle """
+        with self._cond:
+            if not self._pending:
+                # the wheel stood still while there were no timers
+                self._current = int((time.monotonic() - self._start) / self.tick) - 1
+            handle = TimerHandle(self, self._due(delay), callback, args)
+            self._wheel[handle.due % self.slots][handle] = None
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            elif self._pending == 1:
+                self._cond.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self._cond:
+            if handle.cancelled:
+                return
+            handle.cancelled = True
+            slot = self._wheel[handle.due % self.slots]
+            if handle in slot:
+                del slot[handle]
+                self._pending -= 1
+
+    def _expire(self, tick):
+        """ returns the handles due until tick. Must be called with the lock held """
+        expired = []
+        # each slot once is enough, when the thread is late
+        for current in range(max(self._current + 1, tick - self.slots + 1), tick + 1):
+            slot = self._wheel[current % self.slots]
+            if not slot:
+                continue
+            for handle in [handle for handle in slot if handle.due <= current]:
+                del slot[handle]
+                expired.append(handle)
+        self._pending -= len(expired)
+        self._current = max(self._current, tick)
+        return expired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                tick = int((time.monotonic() - self._start) / self.tick)
+                expired = self._expire(tick)
+                for handle in expired:
+                    # a cancel from now on has no effect
+                    handle.cancelled = True
+
+            for handle in expired:
+                try:
+                    handle.callback(*handle.args)
+                except Exception:
+                    LOG.exception("Timer callback failed")
+
+            with self._cond:
+                if self._pending:
+                    next_tick = self._start + (self._current + 1) * self.tick
+                    self._cond.wait(max(0, next_tick - time.monotonic()))
+
+# the timer wheel of all sessions of this process
+WHEEL = TimerWheel()
+
+class WheelTimeout(Timeout):
+    """ the transitions Timeout state feature on the shared timer wheel instead of a thread per timeout.
+        When the model has a timeout_dispatch(callable), the timeout callbacks are passed to it
+        to run them on the thread of the model. A timeout is dropped when the state has been
+        left before the callbacks run. When the model has a state_timeout(state, timeout),
+        it may shorten the timeout each time the state is entered. """
+
+    wheel = WHEEL
+
+    def enter(self, event_data):
+        timeout = self.timeout
+        state_timeout = getattr(event_data.model, 'state_timeout', None)
+        if timeout > 0 and state_timeout is not None:
+            timeout = state_timeout(self.name, timeout)
+        if timeout > 0:
+            handle = self.wheel.schedule(timeout, self._dispatch_timeout, event_data)
+            self.runner[id(event_data.model)] = handle
+        # skip Timeout.enter, it would start a Timer thread
+        return super(Timeout, self).enter(event_data)
+
+    def exit(self, event_data):
+        handle = self.runner.pop(id(event_data.model), None)
+        if handle is not None:
+            handle.cancel()
+        return super(Timeout, self).exit(event_data)
+
+    def _dispatch_timeout(self, event_data):
+        model = event_data.model
+        handle = self.runner.get(id(model))
+        dispatch = getattr(model, 'timeout_dispatch', None)
+        if dispatch is None:
+            self._process_timeout(event_data)
+            return
+
+        def _process():
+            # the state was left (or re-entered) since the timer fired
+            if self.runner.get(id(model)) is not handle:
+                return
+            self._process_timeout(event_data)
+        dispatch(_process)
+
+def test_timer_wheel():
+    wheel = TimerWheel(tick=0.01, slots=8)
+    fired = []
+    done = threading.Event()
+    wheel.schedule(0.05, fired.append, 'first')
+    cancelled = wheel.schedule(0.03, fired.append, 'cancelled')
+    # more than one round of the wheel
+    wheel.schedule(0.15, lambda: (fired.append('last'), done.set()))
+    cancelled.cancel()
+    cancelled.cancel()
+    assert len(wheel) == 2
+    assert done.wait(2.0)
+    assert fired == ['first', 'last']
+    assert len(wheel) == 0
+
+def test_wheel_timeout_state():
+    from transitions import Machine
+    from transitions.extensions.states import add_state_features
+
+    @add_state_features(WheelTimeout)
+    class WheelMachine(Machine):
+        pass
+
+    class Model(object):
+        def __init__(self):
+            self.timeouts = threading.Event()
+
+        def on_timeout_waiting(self):
+            self.timeouts.set()
+
+    model = Model()
+    machine = WheelMachine(model, states=[
+        {'name': 'idle'},
+        {'name': 'waiting', 'timeout': 0.05, 'on_timeout': 'on_timeout_waiting'},
+    ], initial='idle')
+    machine.add_transition('wait', 'idle', 'waiting')
+    machine.add_transition('stop', 'waiting', 'idle')
+
+    model.wait()
+    model.stop()
+    assert not model.timeouts.wait(0.2)
+    model.wait()
+    assert model.timeouts.wait(1.0)
+    assert len([thread for thread in threading.enumerate() if isinstance(thread, threading.Timer)]) == 0
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Wall clock timings of the phases of one keyble.py invocation.
+#
+# keyble.py --profile shows where the time of a slow door action goes: interpreter start,
+# imports, creating the Peripheral, connect, getServices, nonce exchange, encryption,
+# waiting for FragmentAcks and waiting for the answer. The LowerLayer worker thread
+# can run under cProfile (--cprofile). The JSON report (--profile FILE) is printed with
+# python3 timing.py <report>
+#
+# Disabled by default, then start() returns None and stop() returns immediately.
+
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+
+# the order of the phases in the report
+PHASES = [
+    'interpreter',
+    'imports',
+    'peripheral',
+    'connect',
+    'services',
+    'nonce_exchange',
+    'encrypt',
+    'fragment_ack',
+    'answer_wait',
+    'decrypt',
+]
+
+# keep the timeline of a single invocation bounded
+MAX_EVENTS = 1000
+# functions of the cProfile in the report
+CPROFILE_FUNCTIONS = 30
+
+def _process_age():
+    """ returns the seconds since the process was started or None when unknown """
+    try:
+        with open('/proc/self/stat', 'r') as fp:
+            stat = fp.read()
+        # the command name might contain spaces, the fields after it don't
+        starttime = int(stat[stat.rindex(')') + 2:].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - starttime / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class Timing(object):
+    def __init__(self):
+        self.enabled = False
+        # everything is relative to the import of this module
+        self._origin = time.monotonic()
+        self._origin_wall = time.time()
+        self._interpreter = _process_age()
+        self._imported = None
+        self._lock = threading.Lock()
+        # name -> [count, total, max]
+        self._phases = {}
+        # (name, start, duration, thread)
+        self._events = []
+        self._path = None
+        self._cprofile = False
+        self._profiler = None
+        self._profiled_thread = None
+        self._finished = False
+
+    def enable(self, path=None, cprofile=False):
+        """ :param path write the JSON report into path, without print a summary to stderr
+            :param cprofile run cProfile on the first LowerLayer worker thread """
+        self._path = path
+        self._cprofile = cprofile
+        self.enabled = True
+
+    def imported(self):
+        """ called by the main script after its imports """
+        if self._imported is None:
+            self._imported = time.monotonic()
+
+    def start(self):
+        """ returns the start of a phase for stop() or None when disabled """
+        if not self.enabled:
+            return None
+        return time.monotonic()
+
+    def stop(self, name, start):
+        """ account the phase name started at start (returned by start()) """
+        if start is None:
+            return
+        self.add(name, time.monotonic() - start, start)
+
+    def add(self, name, duration, start=None):
+        with self._lock:
+            phase = self._phases.get(name)
+            if phase is None:
+                phase = self._phases[name] = [0, 0.0, 0.0]
+            phase[0] += 1
+            phase[1] += duration
+            phase[2] = max(phase[2], duration)
+            if start is not None and len(self._events) < MAX_EVENTS:
+                self._events.append((name, start - self._origin, duration, threading.current_thread().name))
+
+    def profile_thread(self):
+        """ run cProfile on the calling thread, when requested. Only one thread is profiled """
+        if not self._cprofile:
+            return
+        with self._lock:
+            if self._profiler is not None:
+                return
+            self._profiler = cProfile.Profile()
+            self._profiled_thread = threading.current_thread().name
+        self._profiler.enable()
+
+    def _cprofile_report(self):
+        # the worker might still run, the stats are a snapshot
+        stats = pstats.Stats(self._profiler, stream=io.StringIO())
+        functions = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            functions.append({
+                'function': "%s:%d(%s)" % (filename, line, function),
+                'calls': calls,
+                'tottime': tottime,
+                'cumtime': cumtime,
+            })
+        functions.sort(key=lambda entry: entry['cumtime'], reverse=True)
+        return {'thread': self._profiled_thread, 'functions': functions[:CPROFILE_FUNCTIONS]}
+
+    def report(self):
+        """ returns the report as dict """
+        now = time.monotonic()
+        with self._lock:
+            phases = {name: {'count': count, 'total': total, 'max': longest}
+                      for name, (count, total, longest) in self._phases.items()}
+            events = [{'phase': name, 'start': start, 'duration': duration, 'thread': thread}
+                      for name, start, duration, thread in self._events]
+
+        if self._interpreter is not None:
+            phases['interpreter'] = {'count': 1, 'total': self._interpreter, 'max': self._interpreter}
+        if self._imported is not None:
+            imports = self._imported - self._origin
+            phases['imports'] = {'count': 1, 'total': imports, 'max': imports}
+
+        ordered = [name for name in PHASES if name in phases] + sorted(set(phases) - set(PHASES))
+        report = {
+            'argv': sys.argv,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started': self._origin_wall - (self._interpreter or 0.0),
+            'total': now - self._origin + (self._interpreter or 0.0),
+            'phases': {name: phases[name] for name in ordered},
+            'bottleneck': max(ordered, key=lambda name: phases[name]['total']) if ordered else None,
+            'events': sorted(events, key=lambda event: event['start']),
+        }
+        if self._profiler is not None:
+            report['cprofile'] = self._cprofile_report()
+        return report
+
+    def finish(self):
+        """ print or write the report once. Called by keyble.py before exiting """
+        with self._lock:
+            if not self.enabled or self._finished:
+                return
+            self._finished = True
+
+        report = self.report()
+        if self._path:
+            with open(self._path, 'w') as fp:
+                json.dump(report, fp, indent=2)
+        else:
+            print_report(report, sys.stderr)
+
+# the timings of this process
+TIMING = Timing()
+
+def print_report(report, fp=sys.stdout):
+    total = report['total']
+    print("%-16s %6s %10s %10s %6s" % ('phase', 'count', 'total', 'max', 'share'), file=fp)
+    for name, phase in report['phases'].items():
+        print("%-16s %6d %8.1fms %8.1fms %5.1f%%" % (
+            name, phase['count'], phase['total'] * 1000, phase['max'] * 1000,
+            100.0 * phase['total'] / total if total else 0.0), file=fp)
+    print("total %.1fms, bottleneck: %s" % (total * 1000, report['bottleneck']), file=fp)
+    if 'cprofile' in report:
+        print("cProfile of thread %s:" % report['cprofile']['thread'], file=fp)
+        for entry in report['cprofile']['functions']:
+            print("%8.1fms %8.1fms %7d %s" % (entry['cumtime'] * 1000, entry['tottime'] * 1000,
+                                               entry['calls'], entry['function']), file=fp)
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: %s <report>" % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as fp:
+        print_report(json.load(fp))
+
+if __name__ == '__main__':
+    main()
+
+def test_timing():
+    timing = Timing()
+    # disabled
+    assert timing.start() is None
+    timing.stop('connect', None)
+    assert timing.report()['phases'].get('connect') is None
+
+    timing.enable(cprofile=True)
+    timing.imported()
+    start = timing.start()
+    time.sleep(0.01)
+    timing.stop('connect', start)
+    timing.add('encrypt', 0.001)
+    timing.add('encrypt', 0.002)
+
+    def _worker():
+        timing.profile_thread()
+        sum(range(1000))
+    worker = threading.Thread(target=_worker, name="worker")
+    worker.start()
+    worker.join()
+
+    report = timing.report()
+    assert report['phases']['connect']['total'] >= 0.01
+    assert report['phases']['encrypt']['count'] == 2
+    assert report['phases']['encrypt']['max'] == 0.002
+    assert list(report['phases']).index('imports') < list(report['phases']).index('connect')
+    assert report['bottleneck'] is not None
+    assert [event['phase'] for event in report['events']] == ['connect']
+    assert report['cprofile']['thread'] == 'worker'
+    json.dumps(report)
+
+    out = io.StringIO()
+    print_report(report, out)
+    assert 'connect' in out.getvalue()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# Binary ring buffer of protocol events.
+#
+# The hot path (fragments, acks, messages, retries) records fixed size binary events
+# into a preallocated buffer instead of formatting log lines. The buffer is always on
+# and keeps the last `size` events. It can be dumped into a file, e.g. when an error
+# happens (dump_on_error), and decoded offline:
+#
+#   ./tracebuffer.py trace.bin
+#
+# Event (16 byte, little endian):
+#   timestamp(double, monotonic) session(uint16) event(uint8) direction(uint8)
+#   msgtype(uint8) fragment(uint8) state(uint8) length(uint8)
+
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from struct import Struct
+
+LOG = logging.getLogger("tracebuffer")
+
+MAGIC = b'KBLETRC'
+VERSION = 1
+HEADER = Struct('<7sBIQI')
+EVENT = Struct('<dHBBBBBB')
+
+DIR_NONE = 0
+DIR_TX = 1
+DIR_RX = 2
+
+EV_CONNECT = 1
+EV_DISCONNECT = 2
+EV_FRAGMENT = 3
+EV_ACK = 4
+EV_MESSAGE = 5
+EV_RETRY = 6
+EV_GIVE_UP = 7
+EV_DROP = 8
+EV_INVALID = 9
+EV_ERROR = 10
+
+EVENT_NAMES = {
+    EV_CONNECT: 'connect',
+    EV_DISCONNECT: 'disconnect',
+    EV_FRAGMENT: 'fragment',
+    EV_ACK: 'ack',
+    EV_MESSAGE: 'message',
+    EV_RETRY: 'retry',
+    EV_GIVE_UP: 'give_up',
+    EV_DROP: 'drop',
+    EV_INVALID: 'invalid',
+    EV_ERROR: 'error',
+}
+
+DIR_NAMES = {DIR_NONE: '  ', DIR_TX: '->', DIR_RX: '<-'}
+
+# the states of the LowerLayer
+STATES = ['disconnected', 'connected', 'send', 'wait_ack', 'wait_answer', 'error', 'disconnect']
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+STATE_UNKNOWN = 0xff
+
+class TraceBuffer(object):
+    def __init__(self, size=4096):
+        self.size = size
+        self._buffer = bytearray(size * EVENT.size)
+        # next() on a count is atomic, no lock on the hot path
+        self._index = itertools.count()
+        self._written = 0
+        self._session = itertools.count(1)
+        # session id -> name (the mac)
+        self.sessions = {}
+        self._dump_path = None
+        self._dump_lock = threading.Lock()
+
+    def session(self, name):
+        """ returns a new session id for the events of one connection """
+        session = next(self._session) & 0xffff
+        self.sessions[session] = name
+        return session
+
+    def record(self, session, event, direction=DIR_NONE, msgtype=0, fragment=0, state=None, length=0):
+        index = next(self._index)
+        EVENT.pack_into(self._buffer, (index % self.size) * EVENT.size,
+                        time.monotonic(), session, event, direction, msgtype & 0xff, fragment & 0xff,
+                        STATE_CODES.get(state, STATE_UNKNOWN), min(length, 0xff))
+        if index >= self._written:
+            self._written = index + 1
+
+    def events(self):
+        """ returns the events in the buffer, oldest first, as tuples like EVENT """
+        written = self._written
+        buffer = bytes(self._buffer)
+        start = max(0, written - self.size)
+        return [EVENT.unpack_from(buffer, (index % self.size) * EVENT.size) for index in range(start, written)]
+
+    def dump(self, fp):
+        """ write the buffer into a binary file object """
+        events = self.events()
+        sessions = json.dumps(self.sessions).encode('utf-8')
+        fp.write(HEADER.pack(MAGIC, VERSION, len(events), self._written, len(sessions)))
+        fp.write(sessions)
+        for event in events:
+            fp.write(EVENT.pack(*event))
+
+    def dump_on_error(self, path):
+        """ dump the buffer into path when error() is called. None disables it """
+        self._dump_path = path
+
+    def error(self, session, state=None):
+        """ record an error and dump the buffer if dump_on_error is set """
+        self.record(session, EV_ERROR, state=state)
+        if not self._dump_path:
+            return
+        with self._dump_lock:
+            try:
+                with open(self._dump_path, 'wb') as fp:
+                    self.dump(fp)
+            except OSError as exp:
+                LOG.warning("Can not dump the trace buffer: %s", exp)
+
+def load(fp):
+    """ read a dump. returns (sessions, events) """
+    header = fp.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise RuntimeError("Trace dump too short")
+    magic, version, count, _written, sessions_length = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise RuntimeError("Not a trace dump")
+    sessions = {int(session): name for session, name in json.loads(fp.read(sessions_length).decode('utf-8')).items()}
+    events = [EVENT.unpack(fp.read(EVENT.size)) for _ in range(count)]
+    return sessions, events
+
+def format_event(event, sessions, start=0.0):
+    timestamp, session, kind, direction, msgtype, fragment, state, length = event
+    return "%12.6f %-17s %s %-10s type 0x%02x frag 0x%02x len %3d %s" % (
+        timestamp - start,
+        sessions.get(session, session),
+        DIR_NAMES.get(direction, direction),
+        EVENT_NAMES.get(kind, kind),
+        msgtype, fragment, length,
+        STATES[state] if state < len(STATES) else '-')
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: %s <trace dump>" % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    with open(sys.argv[1], 'rb') as fp:
+        sessions, events = load(fp)
+    start = events[0][0] if events else 0.0
+    for event in events:
+        print(format_event(event, sessions, start))
+
+# the trace buffer of all sessions of this process
+TRACE = TraceBuffer()
+
+if __name__ == '__main__':
+    main()
+
+def test_trace_buffer_wraps():
+    import io
+    trace = TraceBuffer(4)
+    session = trace.session('00:1a:22:00:00:01')
+    for fragment in range(6):
+        trace.record(session, EV_FRAGMENT, DIR_TX, 0x87, fragment, 'send', 16)
+    events = trace.events()
+    assert [event[5] for event in events] == [2, 3, 4, 5]
+    assert events[0][6] == STATE_CODES['send']
+
+    fp = io.BytesIO()
+    trace.dump(fp)
+    fp.seek(0)
+    sessions, loaded = load(fp)
+    assert sessions == {session: '00:1a:22:00:00:01'}
+    assert loaded == events
+    assert 'fragment' in format_event(loaded[0], sessions)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# GPLv3
+#
+# local cache of the user table of each lock.
+# Reading the user table needs a UserListRequest and one UserInfoRequest per user,
+# each a multi fragment transfer. Keep the names until the lock changes: the device
+# compares the user ids of the lock (a single fragment) with the cached ones.
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger("users")
+
+# where keyble keeps the user cache across runs, unless --user-cache is given
+DEFAULT_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'keyble', 'users.json')
+
+class UserCache(object):
+    """ cache of the user table per lock (mac)
+
+        An entry is only valid for the version it was stored with.
+        The version is built by the device from the firmware version of the lock and
+        the generation counter of the cache, which is increased by every user change
+        we do through the cache. An entry older than max_age is also dropped,
+        to pick up the names changed by other admin tools.
+    """
+    def __init__(self, path=None, max_age=24 * 3600):
+        self._path = path
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        # mac -> {'version': [..], 'generation': int, 'time': float, 'users': {userid: name}}
+        self._entries = {}
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError) as exp:
+            LOG.warning("Can not load user cache %s: %s", self._path, exp)
+            return
+
+        for mac, entry in entries.items():
+            entry['users'] = {int(userid): name for userid, name in entry['users'].items()}
+            self._entries[mac] = entry
+
+    def _save(self):
+        if not self._path:
+            return
+
+        tmp = self._path + '.tmp'
+        try:
+            if os.path.dirname(self._path):
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp, 'w') as fp:
+                json.dump(self._entries, fp)
+            os.replace(tmp, self._path)
+        except OSError as exp:
+            # it's only a cache
+            LOG.warning("Can not save user cache %s: %s", self._path, exp)
+
+    def set_path(self, path):
+        """ persist into path. Loads the entries stored in path """
+        with self._lock:
+            self._path = path
+            if os.path.exists(path):
+                self._load()
+
+    def generation(self, mac):
+        """ returns the generation counter of the lock """
+        with self._lock:
+            entry = self._entries.get(mac)
+            return entry['generation'] if entry else 0
+
+    def get(self, mac, version):
+        """ returns a copy of the cached users {userid: name} or None when not cached or outdated """
+        with self._lock:
+            entry = self._entries.get(mac)
+            if not entry:
+                return None
+            if entry['version'] != list(version):
+                LOG.debug("User cache of %s outdated by version", mac)
+                return None
+            if entry['users'] is None:
+                return None
+            if self._max_age and time.time() - entry['time'] > self._max_age:
+                LOG.debug("User cache of %s expired", mac)
+                return None
+            return dict(entry['users'])
+
+    def put(self, mac, version, users):
+        with self._lock:
+            entry = self._entries.setdefault(mac, {'generation': 0})
+            entry['version'] = list(version)
+            entry['time'] = time.time()
+            entry['users'] = dict(users)
+            self._save()
+
+    def _modify(self, mac, modify):
+        with self._lock:
+            entry = self._entries.setdefault(mac, {'generation': 0, 'version': None, 'time': 0, 'users': None})
+            entry['generation'] += 1
+            # keep the entry valid for the new generation when we know the content
+            if entry['users'] is not None and entry['version'] is not None:
+                modify(entry['users'])
+                entry['version'][-1] = entry['generation']
+            self._save()
+
+    def set_name(self, mac, userid, name):
+        """ update the cache after a successful UserNameSet """
+        def _set(users):
+            users[userid] = name
+        self._modify(mac, _set)
+
+    def remove(self, mac, userid):
+        """ update the cache after a successful UserRemove """
+        def _remove(users):
+            users.pop(userid, None)
+        self._modify(mac, _remove)
+
+    def invalidate(self, mac):
+        with self._lock:
+            if self._entries.pop(mac, None) is not None:
+                self._save()
+
+# the default cache shared by all devices of this process
+USER_CACHE = UserCache()
+
+def test_user_cache():
+    cache = UserCache(max_age=None)
+    version = (0x10, 0x20, cache.generation('mac'))
+    assert cache.get('mac', version) is None
+
+    cache.put('mac', version, {1: 'admin'})
+    assert cache.get('mac', version) == {1: 'admin'}
+    # firmware changed
+    assert cache.get('mac', (0x10, 0x21, 0)) is None
+
+    cache.set_name('mac', 2, 'guest')
+    version = (0x10, 0x20, cache.generation('mac'))
+    assert cache.get('mac', version) == {1: 'admin', 2: 'guest'}
+
+    cache.remove('mac', 1)
+    assert cache.get('mac', version) is None
+    version = (0x10, 0x20, cache.generation('mac'))
+    assert cache.get('mac', version) == {2: 'guest'}
+
+def test_user_cache_path():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'keyble', 'users.json')
+        cache = UserCache(max_age=None)
+        cache.set_path(path)
+        version = (0x10, 0x20, 0)
+        cache.put('mac', version, {1: 'admin'})
+
+        cache = UserCache(max_age=None)
+        cache.set_path(path)
+        assert cache.get('mac', version) == {1: 'admin'}